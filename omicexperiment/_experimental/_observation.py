@@ -20,7 +20,7 @@ class Observation(object):
         return list(self.experiment.data_df.index)
 
     def top_count(self, n):
-        top_n_obs = self.experiment.data_df.sum(axis=1).sort_values(ascending=False).head(n).index
+        top_n_obs = self.experiment.counts_stats.observation_sums.sort_values(ascending=False).head(n).index
         return [o for o in top_n_obs]
 
     def top_rel_abund(self, n):
@@ -29,7 +29,7 @@ class Observation(object):
         return [o for o in top_n_obs]
 
     def bottom_count(self, n):
-        top_n_obs = self.experiment.data_df.sum(axis=1).sort_values(ascending=False).tail(n).index
+        top_n_obs = self.experiment.counts_stats.observation_sums.sort_values(ascending=False).tail(n).index
         return [o for o in top_n_obs]
 
     def bottom_rel_abund(self, n):
@@ -1,10 +1,16 @@
+import os
 import numpy as np
 import pandas as pd
 import hashlib
+from collections import Counter
 from pathlib import Path
+from scipy import sparse
 from biom import parse_table
 from biom import Table as BiomTable
-from omicexperiment.util import parse_fasta, parse_fastq
+from omicexperiment.util import parse_fasta, parse_fastq, iter_fasta_batches, iter_fastq_batches, executor_for, map_tasks, sha1_digests
+from omicexperiment.sparse import CountsMatrix
+from omicexperiment.io.npz import load_counts_npz
+from omicexperiment.distance import CondensedDistances
 
 
 def load_biom(biom_filepath):
@@ -18,11 +24,11 @@ def is_biomtable_object(obj):
 
 
 def biomtable_to_dataframe(biom_table_object):
-  _bt = biom_table_object
-  data = _bt.matrix_data.todense()
-  out = pd.SparseDataFrame(data, index=_bt.ids('observation'),
-                           columns=_bt.ids('sample'))
-  return out.to_dense()
+  return biomtable_to_countsmatrix(biom_table_object).to_dataframe()
+
+
+def biomtable_to_countsmatrix(biom_table_object):
+  return CountsMatrix.from_biom(biom_table_object)
 
 
 def biomtable_to_sparsedataframe(biom_table_object):
@@ -39,44 +45,34 @@ def load_biom_as_dataframe(biom_filepath):
     return biomtable_to_dataframe(t)
 
 
-def load_fasta(fasta_filepath, calculate_sha1=False):
+def load_biom_as_countsmatrix(biom_filepath):
+    t = load_biom(biom_filepath)
+    return biomtable_to_countsmatrix(t)
 
-    descs = []
-    seqs = []
-    for desc, seq in parse_fasta(fasta_filepath):
-        descs.append(desc)
-        seqs.append(seq)
 
-    fasta_df = pd.DataFrame({'description': descs, 'sequence': seqs}, columns=['description', 'sequence'])
+def _concat_batches(batches, columns):
+    batches = list(batches)
+    if len(batches) == 0:
+        return pd.DataFrame({c: [] for c in columns}, columns=columns)
+    return pd.concat(batches, ignore_index=True)
 
-    del descs
-    del seqs
+
+def load_fasta(fasta_filepath, calculate_sha1=False):
+
+    fasta_df = _concat_batches(iter_fasta_batches(fasta_filepath), ['description', 'sequence'])
 
     if calculate_sha1:
-        fasta_df['sha1'] = fasta_df['sequence'].apply(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+        fasta_df['sha1'] = sha1_digests(fasta_df['sequence'].values)
 
     return fasta_df
 
 
 def load_fastq(fastq_filepath, calculate_sha1=False):
 
-    descs = []
-    seqs = []
-    quals = []
-    
-    for desc, seq, qual in parse_fastq(fastq_filepath):
-        descs.append(desc)
-        seqs.append(seq)
-        quals.append(qual)
-
-    fastq_df = pd.DataFrame({'description': descs, 'sequence': seqs, 'qual': quals}, columns=['description', 'sequence', 'qual'])
-
-    del descs
-    del seqs
-    del quals
+    fastq_df = _concat_batches(iter_fastq_batches(fastq_filepath), ['description', 'sequence', 'qual'])
     
     if calculate_sha1:
-        fastq_df['sha1'] = fastq_df['sequence'].apply(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+        fastq_df['sha1'] = sha1_digests(fastq_df['sequence'].values)
 
     return fastq_df
 
@@ -98,23 +94,79 @@ def load_fasta_counts(fasta_filepath, sample_name=None):
     return joined_df.drop_duplicates()
 
 
-def counts_table_from_fasta_files(fasta_filepaths, sample_names=None):
+def _count_sequence_file(sequence_filepath):
+    #counts the (bytes) sequences of a single file
+    if Path(sequence_filepath).suffix in ('.fastq', '.fq'):
+        batches = iter_fastq_batches(sequence_filepath, decode=False)
+    else:
+        batches = iter_fasta_batches(sequence_filepath, decode=False)
+
+    sequence_counts = Counter()
+    for batch in batches:
+        sequence_counts.update(batch['sequence'].values)
+
+    sequences = list(sequence_counts.keys())
+    counts = np.fromiter(sequence_counts.values(), dtype=np.int64, count=len(sequences))
+
+    return sequences, counts
+
+
+def counts_matrix_from_sequence_files(sequence_filepaths, sample_names=None, n_jobs=1, executor=None, sha1_cache=None,
+                                      n_threads=None):
+    """Count the sequences of every FASTA/FASTQ file (one file per sample).
+
+    Each file is read and counted on its own (in parallel with n_jobs
+    processes or on the executor given) and the per-file counts are
+    assembled into a sparse matrix at once. The distinct sequences of all
+    the files are then hashed in one batch, over n_threads threads (as
+    many as n_jobs by default; see sha1_digests; sha1_cache is an
+    optional Sha1Cache). Returns a CountsMatrix (sha1 x samples) and
+    a DataFrame of the sequence of every sha1.
+    """
+    sequence_filepaths = list(sequence_filepaths)
 
     if sample_names is None:
-        sample_names = [None for i in range(len(fasta_filepaths))]
+        sample_names = sequence_filepaths
+
+    if len(sample_names) != len(sequence_filepaths):
+        raise ValueError("sample_names must be of the same length as the sequence files.")
+
+    with executor_for(n_jobs, executor) as pool:
+        file_counts = map_tasks(_count_sequence_file, sequence_filepaths, pool)
+
+    sequences = np.empty(sum(len(seqs) for seqs, _ in file_counts), dtype=object)
+    sequences[:] = [seq for seqs, _ in file_counts for seq in seqs]
+    counts = np.concatenate([c for _, c in file_counts] + [np.empty(0, dtype=np.int64)])
+    sample_positions = np.repeat(np.arange(len(file_counts)), [len(c) for _, c in file_counts])
+
+    sequence_positions, unique_sequences = pd.factorize(sequences)
+    if n_threads is None:
+        n_threads = os.cpu_count() if n_jobs is not None and n_jobs < 0 else n_jobs
+    unique_sha1s = sha1_digests(unique_sequences, n_threads=n_threads, cache=sha1_cache)
+
+    #rows are ordered by sha1
+    order = np.argsort(unique_sha1s, kind='stable')
+    rows = np.empty(len(order), dtype=np.int64)
+    rows[order] = np.arange(len(order))
+
+    matrix = sparse.coo_matrix((counts, (rows[sequence_positions], sample_positions)),
+                               shape=(len(unique_sha1s), len(sample_names)))
+
+    sha1_index = pd.Index(unique_sha1s[order], name='sha1')
+    sequences_df = pd.DataFrame({'sequence': [seq.decode('utf-8') for seq in unique_sequences[order]]}, index=sha1_index)
+
+    counts_matrix = CountsMatrix(matrix, sha1_index, sample_names)
+
+    return counts_matrix, sequences_df
 
-    concated_df = None
-    seq_sha1_df = None
 
-    for fasta, sample_name in zip(fasta_filepaths, sample_names):
-        fasta_df = load_fasta_counts(fasta, fasta)
-        seq_sha1_df = pd.concat([seq_sha1_df, fasta_df['sequence']])
-        fasta_df.drop('sequence', axis=1, inplace=True)
-        concated_df = pd.concat([concated_df, fasta_df])
-        del fasta_df
+def counts_table_from_fasta_files(fasta_filepaths, sample_names=None, n_jobs=1, executor=None, sha1_cache=None,
+                                  n_threads=None):
+    counts_matrix, sequences_df = counts_matrix_from_sequence_files(fasta_filepaths, sample_names, n_jobs, executor, sha1_cache,
+                                                                    n_threads)
 
-    concated_df = concated_df.fillna(0).groupby(level=0).sum()
-    concated_df.set_index(seq_sha1_df.drop_duplicates(), append=True, inplace=True)
+    concated_df = counts_matrix.to_dataframe()
+    concated_df.set_index(sequences_df['sequence'], append=True, inplace=True)
 
     return concated_df
 
@@ -139,7 +191,7 @@ def fasta_df_to_counts_table(fasta_df, desc_to_sampleid_func, index='sha1'):
 
     if index == 'sha1' \
     and 'sha1' not in fasta_df.columns:
-        fasta_df['sha1'] = fasta_df['sequence'].apply(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+        fasta_df['sha1'] = sha1_digests(fasta_df['sequence'].values)
 
     pivoted = fasta_df.pivot_table(index=index, columns='sample', aggfunc='count', fill_value=0)
 
@@ -257,9 +309,45 @@ def load_dataframe(input_file_or_obj, first_col_in_file_as_index=True):
             index_col = 0 if first_col_in_file_as_index else None
             df = pd.read_csv(str(fp), sep='\t', index_col=index_col)
             return df
+        elif fp.suffix == '.npz':
+            df = load_counts_npz(str(fp)).to_dataframe()
+            return df
 
     elif isinstance(input_file_or_obj, pd.DataFrame):
         return input_file_or_obj
 
     elif isinstance(input_file_or_obj, BiomTable):
         return biomtable_to_dataframe(input_file_or_obj)
+
+
+def load_counts(input_file_or_obj, sparse=None):
+    """Load a counts table either as a DataFrame or as a sparse CountsMatrix.
+
+    With sparse=None, biom tables and .npz experiment files (which are
+    sparse to begin with, the latter memory-mapped) are kept sparse and
+    everything else is loaded as a dense DataFrame. sparse=True
+    or sparse=False force one or the other.
+    """
+    if isinstance(input_file_or_obj, (CountsMatrix, CondensedDistances)):
+        counts = input_file_or_obj
+    elif isinstance(input_file_or_obj, BiomTable):
+        counts = biomtable_to_countsmatrix(input_file_or_obj)
+    elif isinstance(input_file_or_obj, (str, Path)) \
+    and Path(input_file_or_obj).suffix == '.biom':
+        fp = Path(input_file_or_obj)
+        assert(fp.exists())
+        counts = load_biom_as_countsmatrix(str(fp))
+    elif isinstance(input_file_or_obj, (str, Path)) \
+    and Path(input_file_or_obj).suffix == '.npz':
+        fp = Path(input_file_or_obj)
+        assert(fp.exists())
+        counts = load_counts_npz(str(fp))
+    else:
+        counts = load_dataframe(input_file_or_obj)
+
+    if sparse is True and not isinstance(counts, CountsMatrix):
+        return CountsMatrix.from_dataframe(counts)
+    elif sparse is False and isinstance(counts, CountsMatrix):
+        return counts.to_dataframe()
+
+    return counts
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import pdist, cdist, squareform
+from numpy.lib.format import open_memmap
+
+from omicexperiment.sparse import is_sparse
+from omicexperiment.util import executor_for, imap_tasks
+
+
+#samples per side of the tiles the distances are computed in
+DISTANCE_BLOCK_SIZE = 1000
+
+#metrics unaffected by the observations absent from both samples: their
+#tiles are computed over the observations present in either block only
+ZERO_INVARIANT_METRICS = ('braycurtis', 'jaccard', 'euclidean', 'sqeuclidean', 'cityblock',
+                          'chebyshev', 'canberra', 'cosine', 'dice', 'minkowski')
+
+#presence/absence metrics as functions of the numbers of observations
+#present in both samples (tt), in one only (tf, ft) and in neither (ff),
+#as scipy computes them (which it does on the presence of counts too)
+def _yule(tt, tf, ft, ff):
+    half_r = tf * ft
+    return np.where(half_r == 0, 0.0, 2 * half_r / (tt * ff + half_r))
+
+PRESENCE_METRICS = {
+    'jaccard': lambda tt, tf, ft, ff: np.where(tt + tf + ft == 0, 0.0, (tf + ft) / (tt + tf + ft)),
+    'russellrao': lambda tt, tf, ft, ff: (tf + ft + ff) / (tt + tf + ft + ff),
+    'rogerstanimoto': lambda tt, tf, ft, ff: 2 * (tf + ft) / (tt + ff + 2 * (tf + ft)),
+    'sokalsneath': lambda tt, tf, ft, ff: 2 * (tf + ft) / (tt + 2 * (tf + ft)),
+    'yule': _yule,
+}
+
+#metrics with a sparse kernel, working on the non-zero values only
+SPARSE_METRICS = ('braycurtis',) + tuple(PRESENCE_METRICS)
+
+#upper bound of the (sample, sample, observation) triples expanded at once by _shared_minimum_sums
+SHARED_PAIRS_CHUNK_SIZE = 1 << 24
+
+
+class CondensedDistances(object):
+    """A distance matrix between samples in condensed form.
+
+    condensed holds the distances above the diagonal, row by row, as
+    returned by scipy's pdist; it may be a memory-mapped array. Labelled
+    like the square DataFrame it stands for (index and columns are the
+    sample ids); to_dataframe() builds that DataFrame.
+    """
+    def __init__(self, condensed, ids, metric=None):
+        self.condensed = condensed
+        self.ids = ids if isinstance(ids, pd.Index) else pd.Index(ids)
+        self.metric = metric
+
+        if len(condensed) != len(self.ids) * (len(self.ids) - 1) // 2:
+            raise ValueError("{} distances do not make a condensed matrix of {} samples".format(len(condensed), len(self.ids)))
+
+    @property
+    def index(self):
+        return self.ids
+
+    @property
+    def columns(self):
+        return self.ids
+
+    @property
+    def shape(self):
+        return (len(self.ids), len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to_dataframe(self):
+        return pd.DataFrame(squareform(np.asarray(self.condensed), checks=False), index=self.ids, columns=self.ids)
+
+    def __repr__(self):
+        return "<CondensedDistances: {} samples; metric:{}>".format(len(self.ids), self.metric)
+
+
+def samples_by_observations(data):
+    """The counts as a (samples x observations) CSR matrix, or dense array for dense data."""
+    if is_sparse(data):
+        return data.matrix.T.tocsr()
+    return np.asarray(data.fillna(0).values).T
+
+
+def _shared_minimum_sums(a, b):
+    """The (len(a) x len(b)) sums of min(a[i], b[j]) of the CSR (samples x observations) a and b.
+
+    Only the observations non-zero in both samples contribute: the pairs
+    of non-zero values of every observation are expanded (a chunk of
+    observations at a time) and their minima summed into the result.
+    """
+    a, b = a.tocsc(), b.tocsc()
+    a_counts, b_counts = np.diff(a.indptr), np.diff(b.indptr)
+    pair_counts = a_counts.astype(np.int64) * b_counts
+    pair_ends = np.cumsum(pair_counts)
+
+    num_b = b.shape[0]
+    sums = np.zeros(a.shape[0] * num_b)
+
+    start = 0
+    num_observations = len(pair_counts)
+    while start < num_observations:
+        #the observations whose pairs fit in the chunk (at least one)
+        first_pair = pair_ends[start] - pair_counts[start]
+        end = max(start + 1, int(np.searchsorted(pair_ends, first_pair + SHARED_PAIRS_CHUNK_SIZE, side='right')))
+
+        counts = pair_counts[start:end]
+        observations = np.repeat(np.arange(start, end), counts)
+        #the position of every pair among those of its observation
+        pair_positions = np.arange(counts.sum()) - np.repeat(pair_ends[start:end] - counts - first_pair, counts)
+
+        a_positions = a.indptr[observations] + pair_positions // b_counts[observations]
+        b_positions = b.indptr[observations] + pair_positions % b_counts[observations]
+        minima = np.minimum(a.data[a_positions], b.data[b_positions])
+        sums += np.bincount(a.indices[a_positions] * num_b + b.indices[b_positions], weights=minima, minlength=len(sums))
+        start = end
+
+    return sums.reshape(a.shape[0], num_b)
+
+
+def _sparse_tile_distances(metric, a, b):
+    b = a if b is None else b
+    if metric == 'braycurtis':
+        shared = _shared_minimum_sums(a, b)
+        totals = np.asarray(a.sum(axis=1)) + np.asarray(b.sum(axis=1)).T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            #sum|a - b| / sum(a + b), as sum|a - b| = sum(a + b) - 2 * sum(min(a, b))
+            return 1.0 - 2 * shared / totals
+
+    a_present, b_present = (a != 0).astype(np.float64), (b != 0).astype(np.float64)
+    tt = (a_present @ b_present.T).toarray()
+    tf = np.asarray(a_present.sum(axis=1)) - tt
+    ft = np.asarray(b_present.sum(axis=1)).T - tt
+    ff = a.shape[1] - tt - tf - ft
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return PRESENCE_METRICS[metric](tt, tf, ft, ff)
+
+
+def _tile_distances(a, b, metric, sparse_kernel):
+    a, b = a[0], None if b is None else b[0]
+    if sparse_kernel:
+        return _sparse_tile_distances(metric, a, b)
+
+    if sparse.issparse(a):
+        if metric in ZERO_INVARIANT_METRICS:
+            present = np.union1d(a.indices, b.indices) if b is not None else np.unique(a.indices)
+            a = a[:, present]
+            b = b[:, present] if b is not None else None
+        a = a.toarray()
+        b = b.toarray() if b is not None else None
+    #a tile on the diagonal, condensed itself
+    return pdist(a, metric) if b is None else cdist(a, b, metric)
+
+
+def _write_tile(condensed, num_samples, rows, columns, tile):
+    if tile.ndim == 1:
+        #diagonal tile: its own condensed distances, row by row
+        tile_size = rows[1] - rows[0]
+        tile_offset = 0
+        for k, r in enumerate(range(rows[0], rows[1] - 1)):
+            offset = num_samples * r - r * (r + 1) // 2 - r - 1
+            row_length = tile_size - k - 1
+            condensed[offset + r + 1:offset + rows[1]] = tile[tile_offset:tile_offset + row_length]
+            tile_offset += row_length
+        return
+
+    for r in range(rows[0], rows[1]):
+        column_start = max(columns[0], r + 1)
+        if column_start >= columns[1]:
+            continue
+        #condensed position of (r, c), for r < c: offset + c
+        offset = num_samples * r - r * (r + 1) // 2 - r - 1
+        condensed[offset + column_start:offset + columns[1]] = tile[r - rows[0], column_start - columns[0]:]
+
+
+def beta_distances(data, metric, block_size=DISTANCE_BLOCK_SIZE, filepath=None, n_jobs=1, executor=None, method='auto'):
+    """The distances between the samples (columns) of data, as CondensedDistances.
+
+    The distances are computed in tiles of block_size x block_size
+    samples, in n_jobs processes or on executor. With method='sparse',
+    the SPARSE_METRICS are computed from the non-zero counts only;
+    otherwise (method='dense') each tile goes through scipy's pdist or
+    cdist, densifying the tile's samples over the observations present
+    in them. 'auto' uses the sparse kernels for sparse data. With
+    filepath, the condensed distances are written to a memory-mapped
+    .npy file there instead of held in memory.
+    """
+    counts = samples_by_observations(data)
+
+    if method == 'auto':
+        #Bray-Curtis from the minima of the counts assumes they are not negative
+        sparse_kernel = metric in SPARSE_METRICS and sparse.issparse(counts) \
+                        and not (metric == 'braycurtis' and (counts.data < 0).any())
+    elif method == 'sparse':
+        if metric not in SPARSE_METRICS:
+            raise ValueError("no sparse kernel for {}; available for: {}".format(metric, ", ".join(SPARSE_METRICS)))
+        sparse_kernel = True
+        counts = sparse.csr_matrix(counts)
+    else:
+        sparse_kernel = False
+    return blocked_distances((counts,), data.columns, _tile_distances, (metric, sparse_kernel), metric, block_size, filepath, n_jobs, executor)
+
+
+def _run_tile(task):
+    tile_function, a, b, args = task
+    return tile_function(a, b, *args)
+
+
+def blocked_distances(samples, ids, tile_function, args=(), metric=None, block_size=DISTANCE_BLOCK_SIZE, filepath=None,
+                      n_jobs=1, executor=None):
+    """The CondensedDistances between the samples ids, computed in tiles of block_size x block_size samples.
+
+    samples is a sequence of arrays (or sparse matrices) with a row per
+    sample, sliced together into blocks of rows. tile_function(a, b, *args)
+    (a module-level function, to run in n_jobs processes or on executor)
+    returns the distances between the blocks a and b, or the condensed
+    distances within a when b is None.
+    """
+    num_samples = len(ids)
+    num_distances = num_samples * (num_samples - 1) // 2
+
+    if filepath is not None:
+        condensed = open_memmap(str(filepath), mode='w+', dtype=np.float64, shape=(num_distances,))
+    else:
+        condensed = np.empty(num_distances, dtype=np.float64)
+
+    bounds = [(start, min(start + block_size, num_samples)) for start in range(0, num_samples, block_size)]
+    tiles = [(i, j) for i in range(len(bounds)) for j in range(i, len(bounds))]
+
+    def tasks():
+        for i, j in tiles:
+            a = [x[bounds[i][0]:bounds[i][1]] for x in samples]
+            b = None if i == j else [x[bounds[j][0]:bounds[j][1]] for x in samples]
+            yield (tile_function, a, b, args)
+
+    with executor_for(n_jobs, executor) as pool:
+        for (i, j), tile in zip(tiles, imap_tasks(_run_tile, tasks(), pool)):
+            _write_tile(condensed, num_samples, bounds[i], bounds[j], tile)
+
+    if filepath is not None:
+        condensed.flush()
+
+    return CondensedDistances(condensed, ids, metric)
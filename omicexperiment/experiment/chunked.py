@@ -0,0 +1,232 @@
+import os
+import copy
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from omicexperiment.io.npz import NpzCountsWriter, load_experiment_npz, _read_npz, _decode_index, _decode_frames, _build_experiment, _append_labels
+from omicexperiment.sparse import CountsMatrix
+from omicexperiment.rarefaction import as_seed_sequence
+from omicexperiment.transforms import proxy
+from omicexperiment.transforms.transform import Filter, FusedFilter
+from omicexperiment.transforms.general import RelativeAbundance, MeanRelativeAbundance
+from omicexperiment.transforms.observation import ObservationSumCounts
+from omicexperiment.experiment.lazy import optimize_plan
+
+
+#samples loaded (and transformed) at a time
+CHUNKED_BLOCK_SIZE = 1000
+
+
+def _transform_class(transform):
+    return transform if isinstance(transform, type) else transform.__class__
+
+
+def _is_block_wise(transform):
+    if isinstance(transform, FusedFilter):
+        return all(_is_block_wise(f) for f in transform.filters)
+    elif isinstance(transform, Filter):
+        #sample filters selecting on metadata or on each sample's own counts
+        return transform._fusable() \
+               and transform.axis == 'columns' \
+               and (transform.per_label or not transform.data_dependent)
+    return transform.column_wise or transform.block_wise
+
+
+#reductions over the samples, summed over the blocks:
+#transform class -> (per-observation partial result of a block, final result from the total)
+_BLOCK_REDUCTIONS = {
+    ObservationSumCounts: (lambda exp: exp.data.sum(axis=1),
+                           lambda total: total.to_frame("sum_counts")),
+    MeanRelativeAbundance: (lambda exp: RelativeAbundance.__dapply__(exp).sum(axis=1),
+                            lambda total: total.sort_values(ascending=False).to_frame(name="mra")),
+}
+
+
+def _is_block_reduction(transform):
+    return _transform_class(transform) in _BLOCK_REDUCTIONS
+
+
+class ChunkedExperiment(object):
+    """An experiment whose counts stay on disk, in an .npz bundle, and are processed in blocks of samples.
+
+    Only one block of block_size samples is loaded at a time. Transforms
+    that work on samples separately (the column-wise ones, such as
+    RelativeAbundance, TSS and AlphaDiversity, Rarefaction and the sample
+    count/metadata filters) run block by block, consecutive ones in a
+    single pass, and their result is written to a new bundle.
+    ObservationSumCounts and MeanRelativeAbundance are accumulated over
+    the blocks instead, returning an in-memory experiment.
+
+    Transforms with a seed draw each block from its own stream spawned
+    from it, so their results depend on block_size.
+    """
+    Sample = proxy.Sample()
+
+    def __init__(self, filepath, block_size=CHUNKED_BLOCK_SIZE, sparse=None):
+        self.filepath = str(filepath)
+        self.block_size = block_size
+
+        self._arrays, self._meta = _read_npz(self.filepath, mmap=True)
+        self.sparse = self._meta['sparse'] if sparse is None else sparse
+
+        self.index = _decode_index(self._arrays, 'counts/index', self._meta['index'])
+        self.columns = _decode_index(self._arrays, 'counts/columns', self._meta['columns'])
+        self.indptr = np.asarray(self._arrays['counts/indptr'])
+        self.frames = _decode_frames(self._arrays, self._meta)
+        self._template_exp = None
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    @property
+    def samples(self):
+        return list(self.columns)
+
+    @property
+    def observations(self):
+        return list(self.index)
+
+    @property
+    def mapping_df(self):
+        return self.frames.get('mapping_df')
+
+    @property
+    def taxonomy_df(self):
+        return self.frames.get('taxonomy_df')
+
+    @property
+    def metadata(self):
+        return self._meta['metadata']
+
+    @property
+    def block_bounds(self):
+        num_samples = len(self.columns)
+        return [(start, min(start + self.block_size, num_samples)) for start in range(0, num_samples, self.block_size)]
+
+    def load_block(self, start, end):
+        """Read the counts of samples start to end into memory."""
+        value_start, value_end = self.indptr[start], self.indptr[end]
+        #a CSC block of samples is a contiguous range of the memory-mapped values
+        matrix = sparse.csc_matrix((np.array(self._arrays['counts/data'][value_start:value_end]),
+                                    np.array(self._arrays['counts/indices'][value_start:value_end]),
+                                    self.indptr[start:end + 1] - value_start),
+                                   shape=(len(self.index), end - start))
+        block = CountsMatrix(matrix, self.index, self.columns[start:end])
+        return block if self.sparse else block.to_dataframe()
+
+    def iter_blocks(self):
+        for start, end in self.block_bounds:
+            yield self.load_block(start, end)
+
+    @property
+    def _template(self):
+        #an experiment without samples, from which each block's experiment is derived
+        if self._template_exp is None:
+            empty_counts = CountsMatrix(sparse.csc_matrix((len(self.index), 0)), self.index, self.columns[:0])
+            self._template_exp = _build_experiment(self._meta, empty_counts, self.frames, self.sparse)
+        return self._template_exp
+
+    def iter_block_experiments(self):
+        for block in self.iter_blocks():
+            yield self._template._derive(block)
+
+    def _run_blocks(self, steps):
+        """Yield every block's experiment with steps applied to it."""
+        num_blocks = len(self.block_bounds)
+        block_steps = []
+        for step in steps:
+            if getattr(step, 'seed', None) is not None:
+                block_steps.append([copy.copy(step) for _ in range(num_blocks)])
+                for block_step, block_seed in zip(block_steps[-1], as_seed_sequence(step.seed).spawn(num_blocks)):
+                    block_step.seed = block_seed
+            else:
+                block_steps.append([step] * num_blocks)
+
+        for i, block_exp in enumerate(self.iter_block_experiments()):
+            yield block_exp.apply([s[i] for s in block_steps])
+
+    def _reduce(self, steps, reduction):
+        partial_result, final_result = _BLOCK_REDUCTIONS[_transform_class(reduction)]
+
+        index = self.index
+        total = None
+        for block_exp in self._run_blocks(steps):
+            partial = partial_result(block_exp)
+            index, positions = _append_labels(index, partial.index)
+            if total is None:
+                total = np.zeros(len(index), dtype=partial.dtype)
+                found = np.zeros(len(index), dtype=bool)
+            elif len(index) > len(total):
+                total = np.concatenate([total, np.zeros(len(index) - len(total), dtype=total.dtype)])
+                found = np.concatenate([found, np.zeros(len(index) - len(found), dtype=bool)])
+            total[positions] += partial.values
+            found[positions] = True
+
+        if total is None:
+            return final_result(pd.Series([], dtype=float))
+
+        return final_result(pd.Series(total[found], index=index[found]))
+
+    def _split_plan(self, transforms):
+        if not isinstance(transforms, list):
+            transforms = [transforms]
+
+        plan = optimize_plan(transforms)
+        num_block_wise = 0
+        while num_block_wise < len(plan) and _is_block_wise(plan[num_block_wise]):
+            num_block_wise += 1
+
+        block_wise_steps, rest = plan[:num_block_wise], plan[num_block_wise:]
+        if len(rest) > 0 and not _is_block_reduction(rest[0]):
+            raise NotImplementedError("{} cannot run on a chunked experiment".format(rest[0]))
+
+        return block_wise_steps, rest
+
+    def apply(self, transforms, filepath=None):
+        """Apply the transforms, writing the counts they produce to filepath (a temporary .npz file by default).
+
+        If the transforms include a reduction, the reduction and any
+        transform after it run in memory and an in-memory experiment is
+        returned; otherwise a ChunkedExperiment over the new bundle.
+        """
+        block_wise_steps, rest = self._split_plan(transforms)
+
+        if len(rest) > 0:
+            reduced_df = self._reduce(block_wise_steps, rest[0])
+            return self._template.with_data_df(reduced_df).apply(rest[1:])
+
+        if filepath is None:
+            fd, filepath = tempfile.mkstemp(suffix='.npz')
+            os.close(fd)
+
+        writer = NpzCountsWriter(filepath, self.index)
+        for block_exp in self._run_blocks(block_wise_steps):
+            writer.append(block_exp.data)
+        writer.close(self.mapping_df, self.taxonomy_df, self.metadata, self._meta['class'], self.sparse)
+
+        return self.__class__(filepath, self.block_size, self.sparse)
+
+    def dapply(self, transform):
+        block_wise_steps, rest = self._split_plan(transform)
+        if len(rest) > 0:
+            return self._reduce(block_wise_steps, rest[0])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunked_exp = self.apply(transform, os.path.join(tmpdir, 'dapply.npz'))
+            data = chunked_exp.to_experiment(mmap=False).data
+            del chunked_exp
+        return data
+
+    def __getitem__(self, value):
+        return self.apply(value)
+
+    def to_experiment(self, mmap=True):
+        """Load the whole experiment in memory (with its counts memory-mapped unless mmap=False)."""
+        return load_experiment_npz(self.filepath, mmap, self.sparse)
+
+    def __repr__(self):
+        base_repr = object.__repr__(self)[1:-1]
+        return "<{} - {} observations x {} samples; block_size:{}; filepath:{};>".format(base_repr, self.shape[0], self.shape[1], self.block_size, self.filepath)
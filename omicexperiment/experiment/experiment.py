@@ -7,22 +7,81 @@ from omicexperiment.transforms import proxy
 from omicexperiment.plotting.plot_pygal import plot_table, return_plot, return_plot_tree, plot_to_file
 from omicexperiment.plotting.groups import group_plot_tree
 from omicexperiment.rarefaction import rarefy_dataframe
-from omicexperiment.dataframe import load_dataframe
+from omicexperiment.dataframe import load_dataframe, load_counts
+from omicexperiment.sparse import CountsMatrix
+from omicexperiment.statistics import CountsStatistics
 from omicexperiment.transforms.transform import Transform, Filter
 
 
 class Experiment(object):
-    def __init__(self, data_df, metadata={}):
-        self.data_df = load_dataframe(data_df)
+    #attributes computed from the counts table, which a derived experiment does not share
+    _data_attributes = ('_data', '_dense_data_df', '_counts_stats')
+
+    def __init__(self, data_df, metadata={}, sparse=None):
+        self.data = load_counts(data_df, sparse=sparse)
         self.metadata = metadata
 
+    @property
+    def data(self):
+        """The counts table in its native form: a DataFrame, or a CountsMatrix for sparse experiments."""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._dense_data_df = None
+        self._counts_stats = None
+
+    @property
+    def data_df(self):
+        """The counts table as a dense DataFrame (densified, once, for sparse experiments and condensed distances)."""
+        if not hasattr(self._data, 'to_dataframe'):
+            return self._data
+
+        if self._dense_data_df is None:
+            self._dense_data_df = self._data.to_dataframe()
+        return self._dense_data_df
+
+    @data_df.setter
+    def data_df(self, value):
+        self.data = value
+
+    @property
+    def counts_stats(self):
+        """Per-sample and per-observation totals, non-zero and presence counts of the counts table (a CountsStatistics)."""
+        if self._counts_stats is None:
+            self._counts_stats = CountsStatistics(self._data)
+        return self._counts_stats
+
+    @property
+    def is_sparse(self):
+        return isinstance(self._data, CountsMatrix)
+
+    def _derive(self, data, invalidate=(), **attributes):
+        """A new experiment of the same class holding data, built without running __init__.
+
+        Every other attribute (mapping and taxonomy frames, cached indexes)
+        is shared with self rather than copied or validated again, except
+        those named in invalidate, and metadata, which is copied (shallowly)
+        for transforms to add to; attributes overrides or adds attributes.
+        """
+        excluded = set(self._data_attributes).union(invalidate)
+
+        new_exp = object.__new__(self.__class__)
+        new_exp.__dict__.update((k, v) for k, v in self.__dict__.items() if k not in excluded)
+        if 'metadata' in new_exp.__dict__:
+            new_exp.metadata = dict(new_exp.metadata)
+        new_exp.__dict__.update(attributes)
+        new_exp.data = data
+        return new_exp
+
 
 class OmicExperiment(Experiment):
     Sample = proxy.Sample()
     Observation = proxy.Observation()
     
-    def __init__(self, data_df, mapping_df = None, metadata={}):
-        Experiment.__init__(self, data_df, metadata)
+    def __init__(self, data_df, mapping_df = None, metadata={}, sparse=None):
+        Experiment.__init__(self, data_df, metadata, sparse)
         #self.data_df = load_dataframe(data_df)
 
         self.mapping_df = load_dataframe(mapping_df, first_col_in_file_as_index=True)
@@ -37,7 +96,7 @@ class OmicExperiment(Experiment):
 
         elif isinstance(transforms, (types.FunctionType, types.BuiltinFunctionType, functools.partial)):
             func = transforms #only a single object passed (not a list)
-            transformed_data_df = DataFrame(self.data_df.apply(func, axis=axis))
+            transformed_data_df = DataFrame(self.data.apply(func, axis=axis))
 
             #transpose to return the samples as column namess rather than row names
             if axis == 0 : transformed_data_df = transformed_data_df.transpose()
@@ -54,6 +113,11 @@ class OmicExperiment(Experiment):
             raise NotImplementedError
 
 
+    def lazy(self):
+        from omicexperiment.experiment.lazy import LazyExperiment
+        return LazyExperiment(self)
+
+
     def dapply(self, transforms, axis=0):
         if isinstance(transforms, Transform) \
         or \
@@ -66,11 +130,11 @@ class OmicExperiment(Experiment):
 
     @property
     def samples(self):
-        return list(self.data_df.columns)
+        return list(self.data.columns)
 
     @property
     def observations(self):
-        return list(self.data_df.index)
+        return list(self.data.index)
 
     @property
     def stats_df(self):
@@ -135,17 +199,28 @@ class OmicExperiment(Experiment):
     def __getitem__(self, value):
         return self.apply(value)
 
+    def to_sparse(self):
+        return self.with_data_df(self.data if self.is_sparse else CountsMatrix.from_dataframe(self.data_df))
+
+    def to_dense(self):
+        return self.with_data_df(self.data_df)
+
+    def to_npz(self, filepath):
+        from omicexperiment.io.npz import save_experiment_npz
+        save_experiment_npz(self, filepath)
+
     def with_data_df(self, new_data_df):
-        new_exp = self.__class__(new_data_df, self.mapping_df)
+        new_exp = self._derive(load_counts(new_data_df))
         return new_exp
 
     def with_mapping_df(self, new_mapping_df, reindex_data_df=True):
         if reindex_data_df:
-            new_data_df = self.data_df.reindex(columns=new_mapping_df.index)
+            new_data_df = self.data.reindex(columns=new_mapping_df.index)
         else:
-            new_data_df = self.data_df
+            new_data_df = self.data
 
-        new_exp = self.__class__(new_data_df, new_mapping_df)
+        new_mapping_df = load_dataframe(new_mapping_df, first_col_in_file_as_index=True)
+        new_exp = self._derive(new_data_df, mapping_df=new_mapping_df)
         return new_exp
 
 
@@ -170,15 +245,18 @@ class OmicExperiment(Experiment):
         "{sample_counts}"
         "")
 
+        data = self.data
+        stats = self.counts_stats
+
         d = {}
-        d['num_samples'] = len(self.data_df.columns)
-        d['num_observations'] = len(self.data_df.index)
-        d['total_count'] = self.data_df.sum().sum();
+        d['num_samples'] = len(data.columns)
+        d['num_observations'] = len(data.index)
+        d['total_count'] = stats.total
 
-        zero_df = (self.data_df==0).apply(lambda x: x.value_counts()).sum(axis=1)
-        d['table_density'] = float(zero_df[False]) / zero_df.sum()
+        nonzero_count = stats.sample_nnz.sum()
+        d['table_density'] = float(nonzero_count) / (len(data.index) * len(data.columns))
 
-        sample_sums_df = self.data_df.sum()
+        sample_sums_df = stats.sample_sums
         d['sample_counts'] = sample_sums_df.sort_values().to_string()
 
         sample_stats_df = sample_sums_df.describe()
@@ -0,0 +1,88 @@
+from omicexperiment.transforms.transform import Transform, Filter, FusedFilter
+
+
+def _is_fusable(transform):
+    return isinstance(transform, Filter) and transform._fusable()
+
+
+def _is_sample_metadata_filter(transform):
+    return _is_fusable(transform) \
+           and transform.axis == 'columns' \
+           and not transform.data_dependent
+
+
+def push_down_sample_filters(transforms):
+    """Move the filters on sample metadata ahead of the column-wise transforms before them."""
+    plan = []
+    for transform in transforms:
+        position = len(plan)
+        if _is_sample_metadata_filter(transform):
+            while position > 0 and getattr(plan[position - 1], 'column_wise', False):
+                position -= 1
+        plan.insert(position, transform)
+    return plan
+
+
+def fuse_filters(transforms):
+    """Replace every run of consecutive fusable filters by a single FusedFilter."""
+    plan = []
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            plan.append(run[0])
+        elif len(run) > 1:
+            plan.append(FusedFilter(run))
+        del run[:]
+
+    for transform in transforms:
+        if _is_fusable(transform) or isinstance(transform, FusedFilter):
+            run.append(transform)
+        else:
+            flush()
+            plan.append(transform)
+    flush()
+
+    return plan
+
+
+def optimize_plan(transforms):
+    return fuse_filters(push_down_sample_filters(transforms))
+
+
+class LazyExperiment(object):
+    """An experiment with a recorded plan of transforms, only run on collect().
+
+    The plan is optimized before it runs: filters on sample metadata are
+    moved ahead of column-wise transforms (e.g. RelativeAbundance,
+    TaxonomyGroupBy) and consecutive filters are fused, so that a chain of
+    filters selects from the counts table once.
+    """
+    def __init__(self, experiment, plan=None):
+        self.experiment = experiment
+        self.plan = list(plan) if plan is not None else []
+
+    def apply(self, transforms):
+        if isinstance(transforms, list):
+            new_steps = transforms
+        elif isinstance(transforms, Transform) \
+        or \
+        (isinstance(transforms, type) and issubclass(transforms, Transform)):
+            new_steps = [transforms]
+        else:
+            raise NotImplementedError
+
+        return self.__class__(self.experiment, self.plan + new_steps)
+
+    def __getitem__(self, value):
+        return self.apply(value)
+
+    def optimized_plan(self):
+        return optimize_plan(self.plan)
+
+    def collect(self):
+        return self.experiment.apply(self.optimized_plan())
+
+    def __repr__(self):
+        base_repr = object.__repr__(self)[1:-1]
+        return "<{} - plan:{};>".format(base_repr, self.plan)
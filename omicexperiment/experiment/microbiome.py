@@ -1,31 +1,37 @@
 from omicexperiment.experiment.experiment import OmicExperiment
-from omicexperiment.taxonomy import tax_as_index, tax_as_dataframe, process_taxonomy_dataframe
+from omicexperiment.taxonomy import tax_as_index, tax_as_dataframe, process_taxonomy_dataframe, TaxonomyRankIndex
 from omicexperiment.transforms import proxy
 from omicexperiment.rarefaction import rarefy_dataframe
+from omicexperiment.phylogeny import as_tree_index
 
 
 class MicrobiomeExperiment(OmicExperiment):
     
     Taxonomy = proxy.Taxonomy()
     
-    def __init__(self, data_df, mapping_df = None, taxonomy_assignment_file=None, metadata={}):
-        OmicExperiment.__init__(self, data_df, mapping_df, metadata)
+    def __init__(self, data_df, mapping_df = None, taxonomy_assignment_file=None, metadata={}, sparse=None, tree=None):
+        OmicExperiment.__init__(self, data_df, mapping_df, metadata, sparse)
         self.__init_taxonomy(taxonomy_assignment_file)
+        #a TreeIndex, shared by every derived experiment
+        self._tree_index = as_tree_index(tree)
 
     def __init_taxonomy(self, taxonomy_assignment_file):
         self.taxonomy_assignment_file = taxonomy_assignment_file
         self._tax_df = process_taxonomy_dataframe(taxonomy_assignment_file)
+        #created here (its codes are computed on first use) to be shared by every derived experiment
+        self._tax_rank_index = None if self._tax_df is None else TaxonomyRankIndex(self._tax_df)
 
 
     def load_tax_assignment(self, taxonomy_assignment_file):
         self.taxonomy_assignment_file = taxonomy_assignment_file
         self._tax_df = process_taxonomy_dataframe(taxonomy_assignment_file)
+        self._tax_rank_index = None if self._tax_df is None else TaxonomyRankIndex(self._tax_df)
 
         self.Taxonomy = Taxonomy
 
     @classmethod
     def from_experiment(self, exp):
-        return MicrobiomeExperiment(exp.data_df, exp.mapping_df, exp.taxonomy_df, exp.metadata)
+        return MicrobiomeExperiment(exp.data, exp.mapping_df, exp.taxonomy_df, exp.metadata)
 
     @property
     def tax_index(self):
@@ -36,8 +42,20 @@ class MicrobiomeExperiment(OmicExperiment):
             return self._tax_index
 
     @property
-    def data(self):
-        return self.data_df
+    def taxonomy_rank_index(self):
+        """The TaxonomyRankIndex of taxonomy_df, built once and shared by the experiments derived from this one."""
+        if getattr(self, "_tax_rank_index", None) is None:
+            self._tax_rank_index = TaxonomyRankIndex(self.taxonomy_df)
+        return self._tax_rank_index
+
+    @property
+    def tree_index(self):
+        """The TreeIndex of the experiment's phylogeny (see with_tree), used by the phylogenetic diversity metrics."""
+        return getattr(self, "_tree_index", None)
+
+    def with_tree(self, tree):
+        """A new experiment with the phylogeny tree: a TreeIndex, skbio TreeNode, newick string or file, or qiime2 NewickTree."""
+        return self._derive(self.data, _tree_index=as_tree_index(tree))
 
     @property
     def counts_df(self):
@@ -68,23 +86,13 @@ class MicrobiomeExperiment(OmicExperiment):
         return self.apply(Rarefaction(n, num_reps))
 
 
-    def with_data_df(self, new_data_df):
-        new_exp = self.__class__(new_data_df, self.mapping_df, self.taxonomy_df, self.metadata)
-
-        return new_exp
-
-    def with_mapping_df(self, new_mapping_df, reindex_data_df=True):
-        if reindex_data_df:
-            new_data_df = self.data_df.reindex(columns=new_mapping_df.index)
-        else:
-            new_data_df = self.data_df
-
-        new_exp = self.__class__(new_data_df, new_mapping_df, self.taxonomy_df, self.metadata)
-
-        return new_exp
-
     def with_taxonomy_df(self, new_taxonomy_df):
-        new_exp = self.__class__(self.data_df, self.mapping_df, new_taxonomy_df, self.metadata)
+        new_tax_df = process_taxonomy_dataframe(new_taxonomy_df)
+        new_exp = self._derive(self.data,
+                               invalidate=('_tax_index',),
+                               taxonomy_assignment_file=new_taxonomy_df,
+                               _tax_df=new_tax_df,
+                               _tax_rank_index=None if new_tax_df is None else TaxonomyRankIndex(new_tax_df))
 
         return new_exp
 
@@ -0,0 +1,367 @@
+import os
+import json
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+from scipy import sparse
+
+from omicexperiment.sparse import CountsMatrix, as_counts_matrix
+from omicexperiment.util import READ_BUFFER_SIZE
+
+
+NPZ_FORMAT_NAME = 'omicexperiment'
+NPZ_FORMAT_VERSION = 2
+
+
+def _encode_text(arrays, key, values):
+    """Store strings as one utf-8 buffer (key/text) and the offsets of each in it (key/offsets)."""
+    encoded = [v.encode('utf-8') for v in values]
+    arrays[key + '/text'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays[key + '/offsets'] = np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.int64)
+
+
+def _decode_text(arrays, key):
+    buffer = np.asarray(arrays[key + '/text']).tobytes()
+    offsets = np.asarray(arrays[key + '/offsets'])
+    return [buffer[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _check_text(values, name):
+    not_text = [v for v in values if not isinstance(v, str)]
+    if not_text:
+        raise ValueError("cannot store {!r}: its values are neither numbers nor all strings (e.g. {!r})".format(name, not_text[0]))
+
+
+def _encode_column(arrays, key, series):
+    """Store a column as plain numeric values, categorical codes or a utf-8 text buffer."""
+    if isinstance(series.dtype, CategoricalDtype):
+        categories = series.cat.categories
+        arrays[key + '/codes'] = np.asarray(series.cat.codes)
+        if categories.dtype.kind in 'biufcmM':
+            arrays[key + '/categories'] = np.asarray(categories)
+            categories_kind = 'numeric'
+        else:
+            _check_text(categories, series.name)
+            _encode_text(arrays, key + '/categories', categories)
+            categories_kind = 'text'
+        return {'kind': 'category', 'ordered': bool(series.cat.ordered), 'categories': categories_kind}
+
+    elif series.dtype.kind in 'biufcmM':
+        arrays[key + '/values'] = np.asarray(series)
+        return {'kind': 'numeric'}
+
+    else:
+        nulls = np.asarray(series.isnull())
+        values = series[~nulls]
+        _check_text(values, series.name)
+        _encode_text(arrays, key, values)
+        arrays[key + '/nulls'] = nulls
+        return {'kind': 'text'}
+
+
+def _decode_column(arrays, key, spec, length):
+    if spec['kind'] == 'category':
+        if spec['categories'] == 'numeric':
+            categories = np.asarray(arrays[key + '/categories'])
+        else:
+            categories = _decode_text(arrays, key + '/categories')
+        codes = np.asarray(arrays[key + '/codes'])
+        return pd.Categorical.from_codes(codes, categories=categories, ordered=spec['ordered'])
+
+    elif spec['kind'] == 'numeric':
+        return np.asarray(arrays[key + '/values'])
+
+    else:
+        nulls = np.asarray(arrays[key + '/nulls'])
+        values = np.full(length, np.nan, dtype=object)
+        values[~nulls] = _decode_text(arrays, key)
+        return values
+
+
+def _encode_frame(arrays, key, df):
+    columns = [_encode_column(arrays, '{}/columns/{}'.format(key, i), df.iloc[:, i]) for i in range(df.shape[1])]
+    return {'length': len(df), 'names': [str(c) for c in df.columns], 'columns': columns}
+
+
+def _decode_frame(arrays, key, spec):
+    data = [_decode_column(arrays, '{}/columns/{}'.format(key, i), column_spec, spec['length'])
+            for i, column_spec in enumerate(spec['columns'])]
+    return pd.DataFrame(dict(zip(range(len(data)), data)), index=pd.RangeIndex(spec['length'])).set_axis(spec['names'], axis=1)
+
+
+def _encode_index(arrays, key, index):
+    spec = _encode_frame(arrays, key, index.to_frame(index=False))
+    spec['index_names'] = [None if n is None else str(n) for n in index.names]
+    return spec
+
+
+def _decode_index(arrays, key, spec):
+    levels_df = _decode_frame(arrays, key, spec)
+    if len(spec['index_names']) > 1:
+        return pd.MultiIndex.from_arrays([levels_df.iloc[:, i].array for i in range(levels_df.shape[1])], names=spec['index_names'])
+    return pd.Index(levels_df.iloc[:, 0].array, name=spec['index_names'][0])
+
+
+def _encode_dataframe(arrays, key, df):
+    return {'index': _encode_index(arrays, key + '/index', df.index),
+            'frame': _encode_frame(arrays, key + '/frame', df)}
+
+
+def _decode_dataframe(arrays, key, spec):
+    df = _decode_frame(arrays, key + '/frame', spec['frame'])
+    df.index = _decode_index(arrays, key + '/index', spec['index'])
+    return df
+
+
+def _memmap_npz(filepath):
+    """Memory-map every (uncompressed) array of an .npz file, without reading it.
+
+    np.savez stores each array as an .npy member of an uncompressed zip
+    file, so its values sit at a fixed offset of the file.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filepath) as npz_zip, open(filepath, 'rb') as f:
+        for info in npz_zip.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                with npz_zip.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            #the local file header is 30 bytes, then the file name and extra field
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filepath, dtype=dtype, mode='r', offset=f.tell(),
+                                         shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+def _read_npz(filepath, mmap=True):
+    if mmap:
+        arrays = _memmap_npz(filepath)
+    else:
+        with np.load(filepath) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+
+    meta = json.loads(np.asarray(arrays['meta']).tobytes().decode('utf-8'))
+    if meta.get('format') != NPZ_FORMAT_NAME:
+        raise ValueError("{} is not an omicexperiment .npz file.".format(filepath))
+    if meta.get('version') != NPZ_FORMAT_VERSION:
+        raise ValueError("{} is an omicexperiment .npz file of version {}; this version reads version {}.".format(filepath, meta.get('version'), NPZ_FORMAT_VERSION))
+
+    return arrays, meta
+
+
+def _bundle_meta(arrays, experiment_class, sparse, shape, index, columns, metadata, frames):
+    meta = {'format': NPZ_FORMAT_NAME,
+            'version': NPZ_FORMAT_VERSION,
+            'class': experiment_class,
+            'sparse': sparse,
+            'shape': list(shape),
+            'index': _encode_index(arrays, 'counts/index', index),
+            'columns': _encode_index(arrays, 'counts/columns', columns),
+            'metadata': metadata,
+            'frames': {}}
+
+    for frame_name in ('mapping_df', 'taxonomy_df'):
+        df = frames.get(frame_name)
+        if isinstance(df, pd.DataFrame):
+            meta['frames'][frame_name] = _encode_dataframe(arrays, frame_name, df)
+
+    return meta
+
+
+def _encode_meta(meta):
+    return np.frombuffer(json.dumps(meta, default=str).encode('utf-8'), dtype=np.uint8)
+
+
+def save_experiment_npz(experiment, filepath):
+    """Save an experiment to an uncompressed .npz bundle.
+
+    The counts are stored in CSC form, with the mapping and taxonomy
+    frames stored column by column (numbers as arrays, text as utf-8
+    buffers with offsets, categoricals as codes); other object columns
+    raise a ValueError. The metadata is stored as JSON, with
+    values JSON cannot represent stored as their str().
+    """
+    arrays = {}
+    counts = as_counts_matrix(experiment.data)
+    matrix = counts.matrix
+
+    arrays['counts/data'] = matrix.data
+    arrays['counts/indices'] = matrix.indices
+    arrays['counts/indptr'] = matrix.indptr
+
+    frames = {name: getattr(experiment, name, None) for name in ('mapping_df', 'taxonomy_df')}
+    meta = _bundle_meta(arrays, experiment.__class__.__name__, experiment.is_sparse, matrix.shape,
+                        counts.index, counts.columns, getattr(experiment, 'metadata', {}), frames)
+    arrays['meta'] = _encode_meta(meta)
+
+    with open(filepath, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _append_labels(index, labels):
+    """The positions of labels in index, with the labels not in index appended to it."""
+    positions = index.get_indexer(labels)
+    new = positions == -1
+    if new.any():
+        positions[new] = len(index) + np.arange(new.sum())
+        index = index.append(labels[new])
+    return index, positions
+
+
+def _write_npy_member(npz_zip, name, chunks, dtype, length):
+    """Write a 1-D .npy member of length values, given as an iterable of array chunks."""
+    dtype = np.dtype(dtype)
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)}
+    with npz_zip.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array_header_1_0(member, header)
+        for chunk in chunks:
+            member.write(memoryview(np.ascontiguousarray(chunk, dtype=dtype)).cast('B'))
+
+
+def _read_spooled(f, dtype, buffer_size=READ_BUFFER_SIZE):
+    dtype = np.dtype(dtype)
+    f.seek(0)
+    while True:
+        block = f.read(buffer_size - buffer_size % dtype.itemsize)
+        if not block:
+            break
+        yield np.frombuffer(block, dtype=dtype)
+
+
+class NpzCountsWriter(object):
+    """Write the counts of an .npz bundle one block of samples at a time.
+
+    Only the block being appended is held in memory: its values and row
+    positions are spooled to temporary files, which close() copies into
+    the bundle. The observations are those of index, extended with any
+    new label a block brings; observations found in no block are left out.
+    """
+    def __init__(self, filepath, index=None, dtype=None):
+        self.filepath = str(filepath)
+        self.index = pd.Index([]) if index is None else pd.Index(index)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+
+        self._found = np.zeros(len(self.index), dtype=bool)
+        self._columns = []
+        self._column_nnz = []
+        self._nnz = 0
+
+        spool_dir = os.path.dirname(os.path.abspath(self.filepath))
+        self._data_file = tempfile.TemporaryFile(dir=spool_dir)
+        self._positions_file = tempfile.TemporaryFile(dir=spool_dir)
+
+    def append(self, block):
+        """Append the samples of block (a CountsMatrix or a DataFrame) as the next columns."""
+        counts = as_counts_matrix(block)
+        if self.dtype is None:
+            self.dtype = counts.dtype
+
+        self.index, positions = _append_labels(self.index, counts.index)
+        self._found = np.concatenate([self._found, np.zeros(len(self.index) - len(self._found), dtype=bool)])
+        self._found[positions] = True
+
+        #row positions in the writer's index, sorted within each column
+        matrix = sparse.csc_matrix((counts.matrix.data, positions[counts.matrix.indices], counts.matrix.indptr),
+                                   shape=(len(self.index), counts.shape[1]))
+        matrix.sort_indices()
+
+        self._data_file.write(memoryview(matrix.data.astype(self.dtype, casting='same_kind')).cast('B'))
+        self._positions_file.write(memoryview(matrix.indices.astype(np.int64)).cast('B'))
+        self._columns.append(counts.columns)
+        self._column_nnz.append(np.diff(matrix.indptr))
+        self._nnz += matrix.nnz
+
+    def close(self, mapping_df=None, taxonomy_df=None, metadata={}, experiment_class='OmicExperiment', sparse=True):
+        """Write the bundle, with the frames and metadata given, and remove the spooled files."""
+        dtype = np.int64 if self.dtype is None else self.dtype
+
+        #observations found in no block are dropped, the others renumbered
+        kept = np.flatnonzero(self._found)
+        new_positions = np.full(len(self._found), -1, dtype=np.int64)
+        new_positions[kept] = np.arange(len(kept))
+        index = self.index.take(kept)
+
+        columns = self._columns[0].append(self._columns[1:]) if self._columns else pd.Index([])
+        column_nnz = np.concatenate(self._column_nnz) if self._column_nnz else np.zeros(0, dtype=np.int64)
+        index_dtype = np.int32 if max(len(index), self._nnz) < np.iinfo(np.int32).max else np.int64
+
+        arrays = {'counts/indptr': np.concatenate([[0], np.cumsum(column_nnz)]).astype(index_dtype)}
+        meta = _bundle_meta(arrays, experiment_class, sparse, (len(index), len(columns)), index, columns, metadata,
+                            {'mapping_df': mapping_df, 'taxonomy_df': taxonomy_df})
+        arrays['meta'] = _encode_meta(meta)
+
+        try:
+            with zipfile.ZipFile(self.filepath, 'w', zipfile.ZIP_STORED, allowZip64=True) as npz_zip:
+                _write_npy_member(npz_zip, 'counts/data', _read_spooled(self._data_file, dtype), dtype, self._nnz)
+                _write_npy_member(npz_zip, 'counts/indices',
+                                  (new_positions[p] for p in _read_spooled(self._positions_file, np.int64)),
+                                  index_dtype, self._nnz)
+                for name, array in arrays.items():
+                    _write_npy_member(npz_zip, name, [array], array.dtype, len(array))
+        finally:
+            self._data_file.close()
+            self._positions_file.close()
+
+
+def _build_experiment(meta, counts, frames, sparse=None):
+    from omicexperiment.experiment.experiment import OmicExperiment
+    from omicexperiment.experiment.microbiome import MicrobiomeExperiment, QiimeMicrobiomeExperiment
+
+    if sparse is None:
+        sparse = meta['sparse']
+
+    experiment_classes = {cls.__name__: cls for cls in (OmicExperiment, MicrobiomeExperiment, QiimeMicrobiomeExperiment)}
+    experiment_class = experiment_classes.get(meta['class'], OmicExperiment)
+
+    if issubclass(experiment_class, MicrobiomeExperiment):
+        return experiment_class(counts, frames.get('mapping_df'), frames.get('taxonomy_df'), meta['metadata'], sparse=sparse)
+    else:
+        return experiment_class(counts, frames.get('mapping_df'), meta['metadata'], sparse=sparse)
+
+
+def _decode_frames(arrays, meta):
+    return {name: _decode_dataframe(arrays, name, spec) for name, spec in meta['frames'].items()}
+
+
+def load_counts_npz(filepath, mmap=True):
+    """Load the counts of an .npz bundle as a CountsMatrix, memory-mapped unless mmap=False."""
+    arrays, meta = _read_npz(filepath, mmap)
+    return _counts_from_arrays(arrays, meta)
+
+
+def _counts_from_arrays(arrays, meta):
+    matrix = sparse.csc_matrix((arrays['counts/data'], arrays['counts/indices'], arrays['counts/indptr']),
+                               shape=tuple(meta['shape']))
+    index = _decode_index(arrays, 'counts/index', meta['index'])
+    columns = _decode_index(arrays, 'counts/columns', meta['columns'])
+    return CountsMatrix(matrix, index, columns)
+
+
+def load_experiment_npz(filepath, mmap=True, sparse=None):
+    """Load an experiment saved by save_experiment_npz, as an instance of the class it was saved from.
+
+    With sparse=None the counts are loaded in the form they were saved in
+    (sparse counts stay memory-mapped).
+    """
+    arrays, meta = _read_npz(filepath, mmap)
+    return _build_experiment(meta, _counts_from_arrays(arrays, meta), _decode_frames(arrays, meta), sparse)
@@ -1,42 +1,94 @@
- 
-import tempfile
-import requests
-import re
-import ipykernel
-import json
+import threading
 import yaml
 from zipfile import ZipFile
 from pathlib import Path
-from io import StringIO
+from io import BytesIO, TextIOWrapper
 from collections import OrderedDict
 
 from pandas import read_csv, DataFrame, Series
-from biom.parse import load_table
+from biom.parse import parse_biom_table
 
 
 class Qiime2ArtifactFile(object):    
+    """A qiime2 artifact (.qza), read straight from its zip archive.
+
+    The archive is opened once, on first use, and its member names and
+    metadata are cached; the payloads are read from the zip members
+    without extracting them. close() (or using the artifact as a context
+    manager) closes the archive. Pickled artifacts reopen it on first use.
+    """
     
     def __init__(self, pth):
         self.path = Path(pth).absolute()
         assert(self.path.exists())
         self._zipfile = None
+        self._members = None
+        self._metadata_file = None
+        self._metadata = None
+        self._lock = threading.Lock()
         
 
     @property
     def __zipfile__(self):
-        return ZipFile(str(self.path))
+        if self._zipfile is None:
+            with self._lock:
+                if self._zipfile is None:
+                    self._zipfile = ZipFile(str(self.path))
+        return self._zipfile
+
+    @property
+    def members(self):
+        if self._members is None:
+            self._members = self.__zipfile__.namelist()
+        return self._members
+
+    def open_member(self, member):
+        """The binary stream of the archive's member."""
+        return self.__zipfile__.open(member)
+
+    def read_member(self, member):
+        return self.__zipfile__.read(member)
+
+    def close(self):
+        with self._lock:
+            if self._zipfile is not None:
+                self._zipfile.close()
+                self._zipfile = None
+
+    def __getstate__(self):
+        #the open archive and its lock stay with this process
+        state = self.__dict__.copy()
+        for attr in ('_lock', '_zipfile', '_members'):
+            state.pop(attr)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._zipfile = None
+        self._members = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
     
     @property
     def metadata_file(self):
-        with ZipFile(str(self.path)) as myzip:
-            for f in myzip.namelist():
+        if self._metadata_file is None:
+            for f in self.members:
                 if f.endswith("metadata.yaml"):
-                    return f
+                    self._metadata_file = f
+                    break
+        return self._metadata_file
+
     @property
     def metadata(self):
-        with self.__zipfile__ as myzip:
-            with myzip.open(self.metadata_file) as metadata_yaml:
-                return yaml.load(metadata_yaml)
+        if self._metadata is None:
+            with self.open_member(self.metadata_file) as metadata_yaml:
+                self._metadata = yaml.safe_load(metadata_yaml)
+        return self._metadata
             
     @property
     def __id__(self):
@@ -55,17 +107,17 @@ class BiomTable(Qiime2ArtifactFile):
         return str(Path(self.__id__) / 'data' / self.__singlefiledir_filename__)
     
     def load_data(self):
-        with self.__zipfile__ as myzip:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                extracted_file_pth_str = myzip.extract(self.__data_path__, tmpdir)
-                return load_table(extracted_file_pth_str)
+        import h5py
+        #the HDF5 table is read from memory (h5py needs to seek in it)
+        with h5py.File(BytesIO(self.read_member(self.__data_path__)), 'r') as biom_file:
+            return parse_biom_table(biom_file)
     
     def to_dataframe(self, astype='int64'):
         biom_table = self.load_data()
         if astype is None:
-            return biom_table.to_dataframe().to_dense()
+            return biom_table.to_dataframe(dense=True)
         else:
-            return biom_table.to_dataframe().to_dense().astype(astype)
+            return biom_table.to_dataframe(dense=True).astype(astype)
     
 
 
@@ -80,10 +132,8 @@ class TaxonomyAssignment(Qiime2ArtifactFile):
         return str(Path(self.__id__) / 'data' / self.__singlefiledir_filename__)
     
     def load_data(self):
-        with self.__zipfile__ as myzip:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                extracted_file_pth_str = myzip.extract(self.__data_path__, tmpdir)
-                return read_csv(extracted_file_pth_str, sep="\t")
+        with self.open_member(self.__data_path__) as tsv:
+            return read_csv(tsv, sep="\t")
     
     def to_dataframe(self):
         tax_df = self.load_data()
@@ -103,34 +153,32 @@ class NewickTree(Qiime2ArtifactFile):
         return str(Path(self.__id__) / 'data' / self.__singlefiledir_filename__)
     
     def load_data(self):
-        with self.__zipfile__ as myzip:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                extracted_file_pth_str = myzip.extract(self.__data_path__, tmpdir)
-                with open(extracted_file_pth_str) as f:
-                    return f.read()
+        with TextIOWrapper(self.open_member(self.__data_path__), encoding='utf-8') as f:
+            return f.read()
     
     def to_treenode(self):
         from skbio.tree import TreeNode
-        data_str = self.load_data()
-        treenode = TreeNode.read(StringIO(data_str))
+        with TextIOWrapper(self.open_member(self.__data_path__), encoding='utf-8') as f:
+            treenode = TreeNode.read(f)
         return treenode
     
+    def to_tree_index(self):
+        from omicexperiment.phylogeny import TreeIndex
+        return TreeIndex(self.to_treenode())
+    
     def to_dataframe(self):
         tree = self.to_treenode()
-        all_nodes = [l for l in tree.root().preorder()]
 
-        all_nodes = {node: len(node.ancestors()) for node in all_nodes}
-        nodes_ancestors = [[node] + node.ancestors() for node in all_nodes]
-
-        lst_of_dcts = [OrderedDict({i:n.name for (i,n) in enumerate(reversed(lstn))}) for lstn in nodes_ancestors]
-        
-        dct_of_dcts = OrderedDict()
-        for i, dct in enumerate(lst_of_dcts):
-            last_node_ie_tip = next(reversed(dct.values()))
-            dct_of_dcts[i] = last_node_ie_tip
-                          
+        #the names from the root down to every node, in preorder, each
+        #extending its parent's rather than walking up the tree again
+        paths = {}
+        for node in tree.preorder(include_self=True):
+            parent_path = paths[id(node.parent)] if node is not tree else ()
+            paths[id(node)] = parent_path + (node.name,)
+        nodes_paths = list(paths.values())
 
-        df_nodes = DataFrame(lst_of_dcts, index=dct_of_dcts.values())
+        lst_of_dcts = [OrderedDict(enumerate(path)) for path in nodes_paths]
+        df_nodes = DataFrame(lst_of_dcts, index=[path[-1] for path in nodes_paths])
         df_nodes.index.name = 'node'
 
         col_levels = [c for c in df_nodes.columns]
@@ -150,10 +198,8 @@ class DistanceMatrix(Qiime2ArtifactFile):
         return str(Path(self.__id__) / 'data' / self.__singlefiledir_filename__)
     
     def load_data(self):
-        with self.__zipfile__ as myzip:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                extracted_file_pth_str = myzip.extract(self.__data_path__, tmpdir)
-                return read_csv(extracted_file_pth_str, sep="\t", index_col=0)
+        with self.open_member(self.__data_path__) as tsv:
+            return read_csv(tsv, sep="\t", index_col=0)
     
     def to_dataframe(self):
         dm_df = self.load_data()
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse.linalg import LinearOperator, eigsh
+from skbio.stats.ordination import OrdinationResults
+
+from omicexperiment.distance import CondensedDistances
+
+
+#upper bound of the distances expanded at once, per block of rows, by the centred operator
+ORDINATION_BLOCK_ELEMENTS = 1 << 24
+
+
+class CentredDistanceOperator(object):
+    """The Gower-centred matrix B = -1/2 J D**2 J of a distance matrix D, without forming it.
+
+    distances is a CondensedDistances (possibly memory-mapped) or a
+    square array. dot(X) computes B @ X in one pass over the distances,
+    a block of rows at a time: for condensed distances, the part of each
+    row above the diagonal (which is contiguous) is expanded and
+    contributes to both its rows and, transposed, its columns.
+    """
+    def __init__(self, distances, block_elements=ORDINATION_BLOCK_ELEMENTS):
+        if isinstance(distances, CondensedDistances):
+            self.condensed = distances.condensed
+            self.square = None
+            self.size = len(distances)
+        else:
+            self.condensed = None
+            self.square = np.asarray(distances)
+            self.size = self.square.shape[0]
+        self.block_size = max(1, block_elements // max(1, self.size))
+
+    def _row_blocks(self):
+        for start in range(0, self.size, self.block_size):
+            yield start, min(start + self.block_size, self.size)
+
+    def _squared_dot(self, X):
+        """-1/2 D**2 @ X"""
+        n = self.size
+        result = np.zeros((n, X.shape[1]))
+        for start, end in self._row_blocks():
+            if self.square is not None:
+                rows = np.square(np.asarray(self.square[start:end], dtype=np.float64))
+                result[start:end] = rows @ X
+                continue
+
+            rows = np.zeros((end - start, n))
+            for r in range(start, end):
+                #condensed position of (r, c), for r < c: offset + c
+                offset = n * r - r * (r + 1) // 2 - r - 1
+                rows[r - start, r + 1:] = self.condensed[offset + r + 1:offset + n]
+            np.square(rows, out=rows)
+            result[start:end] += rows @ X
+            result += rows.T @ X[start:end]
+        result *= -0.5
+        return result
+
+    def dot(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        vector = X.ndim == 1
+        X = X.reshape(self.size, -1)
+        #B @ X = J (A (J X)), where J subtracts the column means
+        Z = self._squared_dot(X - X.mean(axis=0))
+        Z -= Z.mean(axis=0)
+        return Z.ravel() if vector else Z
+
+    def trace(self):
+        """The sum of all the eigenvalues of B: minus the sum of -1/2 D**2 over the number of samples."""
+        return -self._squared_dot(np.ones((self.size, 1))).sum() / self.size
+
+    def as_linear_operator(self):
+        return LinearOperator((self.size, self.size), matvec=self.dot, matmat=self.dot, dtype=np.float64)
+
+
+def _randomized_eigen(operator, dimensions, oversamples, iterations, seed):
+    """The largest eigenvalues and eigenvectors of the symmetric operator, by a randomized range finder."""
+    rng = np.random.default_rng(seed)
+    num_vectors = min(operator.size, dimensions + oversamples)
+    Q, _ = np.linalg.qr(operator.dot(rng.standard_normal((operator.size, num_vectors))))
+    for _ in range(iterations):
+        Q, _ = np.linalg.qr(operator.dot(Q))
+    eigvals, eigvecs = np.linalg.eigh(Q.T @ operator.dot(Q))
+    return eigvals, Q @ eigvecs
+
+
+def approximate_pcoa(distances, dimensions=10, method='randomized', oversamples=10, iterations=4, seed=None,
+                     block_elements=ORDINATION_BLOCK_ELEMENTS):
+    """The first dimensions principal coordinates of the distances, as skbio OrdinationResults.
+
+    The centred matrix is never formed (see CentredDistanceOperator): its
+    largest eigenvalues are found with a randomized eigensolver, making
+    iterations + 2 passes over the distances (method='randomized'), or
+    with scipy's eigsh (method='eigsh'), one pass per iteration. The
+    proportions explained are relative to the trace of the centred
+    matrix, the sum of all its eigenvalues.
+    """
+    ids = distances.index
+    operator = CentredDistanceOperator(distances, block_elements)
+    dimensions = min(dimensions, operator.size - 1)
+
+    if method == 'randomized':
+        eigvals, eigvecs = _randomized_eigen(operator, dimensions, oversamples, iterations, seed)
+    elif method == 'eigsh':
+        v0 = np.random.default_rng(seed).standard_normal(operator.size)
+        eigvals, eigvecs = eigsh(operator.as_linear_operator(), k=dimensions, which='LA', v0=v0)
+    else:
+        raise ValueError("unknown PCoA method: {}".format(method))
+
+    descending = np.argsort(eigvals)[::-1][:dimensions]
+    eigvals, eigvecs = eigvals[descending], eigvecs[:, descending]
+    coordinates = eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+
+    axis_labels = ["PC{}".format(i + 1) for i in range(dimensions)]
+    return OrdinationResults(short_method_name='PCoA',
+                             long_method_name='Principal Coordinate Analysis',
+                             eigvals=pd.Series(eigvals, index=axis_labels),
+                             samples=pd.DataFrame(coordinates, index=ids, columns=axis_labels),
+                             proportion_explained=pd.Series(eigvals / operator.trace(), index=axis_labels))
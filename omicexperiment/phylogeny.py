@@ -0,0 +1,175 @@
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from omicexperiment.sparse import is_sparse
+from omicexperiment.distance import DISTANCE_BLOCK_SIZE, blocked_distances, _tile_distances
+
+
+PHYLOGENETIC_ALPHA_METRICS = ('faith_pd',)
+PHYLOGENETIC_BETA_METRICS = ('unweighted_unifrac', 'weighted_unifrac', 'weighted_normalized_unifrac')
+
+
+class TreeIndex(object):
+    """A rooted phylogeny as arrays over its nodes, in postorder.
+
+    parent holds the position of every node's parent (-1 for the root)
+    and lengths its branch length (0 for the root, or where missing);
+    tips maps the tip names to their positions. ancestry(observations)
+    is the sparse (nodes x observations) matrix of the tips below every
+    node: products with it give the counts under every node, for all the
+    samples at once.
+    """
+    def __init__(self, tree):
+        nodes = list(tree.postorder(include_self=True))
+        positions = {id(node): i for i, node in enumerate(nodes)}
+
+        self.parent = np.array([-1 if node is tree else positions[id(node.parent)] for node in nodes], dtype=np.int64)
+        self.lengths = np.array([0.0 if node is tree or node.length is None else node.length for node in nodes], dtype=np.float64)
+        self.names = pd.Index([node.name for node in nodes], dtype=object)
+
+        tip_positions = [i for i, node in enumerate(nodes) if node.is_tip()]
+        self.tips = pd.Series(tip_positions, index=self.names[tip_positions])
+        if not self.tips.index.is_unique:
+            raise ValueError("the tip names of the tree are not unique")
+
+        self._last_ancestry = (None, None)
+
+    @classmethod
+    def from_newick(cls, newick):
+        """The TreeIndex of a newick string or file."""
+        from skbio.tree import TreeNode
+        return cls(TreeNode.read(StringIO(newick) if isinstance(newick, str) and newick.rstrip().endswith(';') else newick))
+
+    def __len__(self):
+        return len(self.parent)
+
+    def tip_positions(self, observations):
+        positions = self.tips.reindex(observations)
+        if positions.isnull().any():
+            missing = list(observations[positions.isnull().values][:5])
+            raise ValueError("observations not found among the tips of the tree: {}".format(missing))
+        return positions.to_numpy(dtype=np.int64)
+
+    def ancestry(self, observations):
+        """The (nodes x observations) CSR matrix of ones at every tip of observations and each of its ancestors."""
+        last_observations, matrix = self._last_ancestry
+        if observations is not last_observations:
+            nodes = self.tip_positions(observations)
+            columns = np.arange(len(observations))
+            rows, cols = [], []
+            #one step up the tree from all the tips at a time
+            while len(nodes) > 0:
+                rows.append(nodes)
+                cols.append(columns)
+                nodes = self.parent[nodes]
+                above_root = nodes >= 0
+                nodes, columns = nodes[above_root], columns[above_root]
+            rows, cols = np.concatenate(rows), np.concatenate(cols)
+            matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(self), len(observations)))
+            self._last_ancestry = (observations, matrix)
+        return matrix
+
+    def tip_depths(self, observations):
+        """The distance from the root of the tip of every observation."""
+        return self.ancestry(observations).T @ self.lengths
+
+
+def as_tree_index(tree):
+    """A TreeIndex from a TreeIndex, an skbio TreeNode, a newick string or file, or a qiime2 NewickTree artifact."""
+    if tree is None or isinstance(tree, TreeIndex):
+        return tree
+    if hasattr(tree, 'to_tree_index'):
+        return tree.to_tree_index()
+    if hasattr(tree, 'postorder'):
+        return TreeIndex(tree)
+    return TreeIndex.from_newick(tree)
+
+
+def _counts_matrix(data):
+    """The counts as an (observations x samples) CSC matrix."""
+    if is_sparse(data):
+        return data.matrix.tocsc()
+    return sparse.csc_matrix(np.asarray(data.fillna(0).values, dtype=np.float64))
+
+
+def node_counts(tree_index, data):
+    """The (nodes x samples) CSC matrix of the counts under every node of the tree."""
+    return (tree_index.ancestry(data.index) @ _counts_matrix(data)).tocsc()
+
+
+def _presence(matrix):
+    matrix = matrix.copy()
+    matrix.data = (matrix.data > 0).astype(np.float64)
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def faith_pd(tree_index, data):
+    """Faith's phylogenetic diversity of every sample (column) of data, as a Series."""
+    present = _presence(node_counts(tree_index, data))
+    return pd.Series(present.T @ tree_index.lengths, index=data.columns)
+
+
+def _row_sums(matrix):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def _unifrac_tile(a, b, metric):
+    b = a if b is None else b
+    if metric == 'unweighted_unifrac':
+        #rows of present nodes valued by the square roots of their branch lengths:
+        #their products are the branch lengths shared by two samples
+        shared = (a[0] @ b[0].T).toarray()
+        a_totals, b_totals = _row_sums(a[0].multiply(a[0])), _row_sums(b[0].multiply(b[0]))
+        unique = a_totals[:, None] + b_totals[None, :] - 2 * shared
+        union = unique + shared
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(union == 0, 0.0, unique / union)
+
+    #rows of branch lengths times the proportions of the counts under them:
+    #their cityblock distances, over the nodes present in either block
+    distances = _tile_distances([a[0]], [b[0]], 'cityblock', False)
+    if metric == 'weighted_normalized_unifrac':
+        normalizations = a[1][:, None] + b[1][None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            #0 between two empty samples, as in skbio
+            distances = np.where(normalizations == 0, 0.0, distances / normalizations)
+    return distances
+
+
+def unifrac_distances(tree_index, data, metric='unweighted_unifrac', block_size=DISTANCE_BLOCK_SIZE, filepath=None,
+                      n_jobs=1, executor=None):
+    """The UniFrac distances between the samples (columns) of data, as CondensedDistances.
+
+    The counts under every node are computed once, for all the samples,
+    from the tree's ancestry matrix; the distances between them are then
+    computed in tiles of samples, in parallel, as by
+    distance.beta_distances. metric is one of PHYLOGENETIC_BETA_METRICS
+    (weighted_unifrac being skbio's weighted UniFrac, not normalized).
+    """
+    if metric not in PHYLOGENETIC_BETA_METRICS:
+        raise ValueError("unknown UniFrac metric: {}; available: {}".format(metric, ", ".join(PHYLOGENETIC_BETA_METRICS)))
+
+    counts = _counts_matrix(data)
+    ancestry = tree_index.ancestry(data.index)
+    under_nodes = (ancestry @ counts).tocsc()
+
+    if metric == 'unweighted_unifrac':
+        present = _presence(under_nodes).T.tocsr()
+        present.data = np.sqrt(tree_index.lengths[present.indices])
+        samples = (present,)
+    else:
+        totals = np.asarray(counts.sum(axis=0)).ravel()
+        #empty samples have no proportions (and a normalization of 0)
+        inverse_totals = np.zeros(len(totals))
+        np.divide(1.0, totals, out=inverse_totals, where=totals != 0)
+        proportions = (under_nodes @ sparse.diags(inverse_totals)).T.tocsr()
+        proportions.data *= tree_index.lengths[proportions.indices]
+        #the normalization of every sample: the mean distance from the root of its counts
+        normalizations = (counts.T @ tree_index.tip_depths(data.index)) * inverse_totals
+        samples = (proportions, normalizations)
+
+    return blocked_distances(samples, data.columns, _unifrac_tile, (metric,), metric, block_size, filepath, n_jobs, executor)
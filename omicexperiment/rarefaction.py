@@ -1,21 +1,233 @@
+from contextlib import closing
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from omicexperiment.util import executor_for, imap_tasks
 
-def rarefy(series, n):
-    series_sum = series.sum()
-    rel_abundance = series.apply(lambda c: c / series_sum)
-    sampled = np.random.choice(rel_abundance.index, n, p=rel_abundance)
-    sampled_series = pd.Series(sampled, name=series.name)
-    return sampled_series.value_counts()
-
-
-def rarefy_dataframe(dataframe, n):
-    
-    rarefied_all = []
-    
-    for col in dataframe:
-        rarefied_series = rarefy(dataframe[col], n)
-        rarefied_all.append(rarefied_series)
-    
-    return pd.concat(rarefied_all,axis=1).fillna(0)
-    
+
+#samples per independently seeded chunk; results depend on it, not on the number of workers
+RAREFACTION_CHUNK_SIZE = 1000
+
+
+def _draw_counts(indptr, counts, n, replace, rng):
+    """Draw n reads (or n[j] reads) from every column of a CSC (indptr, counts) structure at once.
+
+    The multinomial (replace=True) or multivariate hypergeometric
+    (replace=False) draw is decomposed into its conditional marginals:
+    the k-th non-zero value of every column is drawn in one vectorized
+    binomial/hypergeometric call, given what is left in that column.
+    Only max(nnz per column) numpy calls are made, whatever the number
+    of samples.
+    """
+    nnz = np.diff(indptr)
+    drawn = np.zeros(len(counts), dtype=np.int64)
+
+    if len(nnz) == 0 or nnz.max() == 0:
+        return drawn
+
+    #columns ordered by decreasing nnz, so that the columns still
+    #having a k-th value are always a prefix of that order
+    order = np.argsort(-nnz, kind='stable')
+    sorted_nnz = nnz[order]
+    starts = indptr[:-1][order]
+
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+    column_totals = cumulative_counts[indptr[1:]] - cumulative_counts[indptr[:-1]]
+    remaining_total = column_totals[order].astype(np.float64 if replace else np.int64)
+    remaining_n = np.broadcast_to(np.asarray(n, dtype=np.int64), nnz.shape)[order].copy()
+
+    if not replace and (remaining_total < remaining_n).any():
+        raise ValueError("Cannot draw {} reads without replacement from a sample with fewer reads.".format(n))
+
+    ascending_nnz = sorted_nnz[::-1]
+
+    for k in range(sorted_nnz[0]):
+        num_active = len(order) - np.searchsorted(ascending_nnz, k, side='right')
+        pos = starts[:num_active] + k
+        good = counts[pos]
+        total = remaining_total[:num_active]
+        to_draw = remaining_n[:num_active]
+
+        if replace:
+            p = np.divide(good, total, out=np.zeros(num_active), where=total > 0)
+            draws = rng.binomial(to_draw, np.minimum(p, 1.0))
+        else:
+            draws = rng.hypergeometric(good, total - good, to_draw)
+
+        #the last value of a column takes whatever is left (guards against float error)
+        is_last = sorted_nnz[:num_active] == k + 1
+        draws[is_last] = to_draw[is_last]
+
+        drawn[pos] = draws
+        remaining_total[:num_active] -= good
+        remaining_n[:num_active] -= draws
+
+    return drawn
+
+
+def rarefy_matrix(matrix, n, num_reps=1, replace=True, rng=None):
+    """Rarefy every column (sample) of an (observations x samples) matrix to n reads.
+
+    matrix may be a scipy sparse matrix or a 2D array; a CSC int64 matrix
+    is returned. With replace=True reads are drawn with replacement
+    (multinomial), with replace=False without replacement (multivariate
+    hypergeometric), which needs integer counts. With num_reps > 1, num_reps
+    draws are pooled and n reads are drawn again from the pool.
+
+    rng is a numpy Generator, or anything np.random.default_rng accepts.
+    """
+    rng = np.random.default_rng(rng)
+    matrix = sparse.csc_matrix(matrix)
+    matrix.sum_duplicates()
+
+    counts = matrix.data
+    if not replace:
+        if not np.array_equal(counts, np.floor(counts)):
+            raise ValueError("Rarefaction without replacement requires integer counts.")
+        counts = counts.astype(np.int64)
+
+    indptr = matrix.indptr
+
+    if n == 0:
+        drawn = np.zeros(len(counts), dtype=np.int64)
+    else:
+        drawn = _draw_counts(indptr, counts, n, replace, rng)
+
+        if num_reps > 1:
+            for r in range(num_reps - 1):
+                drawn = drawn + _draw_counts(indptr, counts, n, replace, rng)
+            drawn = _draw_counts(indptr, drawn, n, replace, rng)
+
+    return sparse.csc_matrix((drawn, matrix.indices.copy(), indptr.copy()), shape=matrix.shape)
+
+
+def as_seed_sequence(seed):
+    """The SeedSequence of seed (an int, a SeedSequence or None).
+
+    A SeedSequence is copied, so that spawning from the result (which
+    advances it) leaves the caller's own unchanged: the same seed always
+    spawns the same streams.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key, pool_size=seed.pool_size)
+    return np.random.SeedSequence(seed)
+
+
+def _rarefy_chunk(task):
+    matrix_chunk, n, replace, seed_sequence = task
+    return rarefy_matrix(matrix_chunk, n, 1, replace, np.random.default_rng(seed_sequence))
+
+
+def rarefy_matrices(matrix, draws, replace=True, n_jobs=1, executor=None, chunk_size=RAREFACTION_CHUNK_SIZE):
+    """Yield the rarefaction of matrix, as by rarefy_matrix, for every (n, num_reps, seed[, columns]) of draws.
+
+    columns, if given, are the positions of the samples to rarefy (all of
+    them by default). The draws are split into tasks of one repetition of
+    one chunk of chunk_size samples, all of them run on the same n_jobs
+    processes or executor, so that repetitions and draws (e.g. the depths
+    of a curve) run in parallel too. Every chunk draws from its own
+    stream spawned from the draw's seed (and every repetition from one
+    spawned from the chunk's, the pooled draw of num_reps > 1 from one
+    more), so for a given seed and chunk_size the result is bit-identical
+    whether the tasks run serially (n_jobs=1) or not.
+    """
+    matrix = sparse.csc_matrix(matrix)
+
+    plan = []
+    for draw in draws:
+        n, num_reps, seed = draw[:3]
+        columns = np.arange(matrix.shape[1]) if len(draw) < 4 or draw[3] is None else np.asarray(draw[3])
+        chunks = [columns[start:start + chunk_size] for start in range(0, len(columns), chunk_size)]
+        chunk_seeds = as_seed_sequence(seed).spawn(len(chunks))
+        rep_seeds = [[chunk_seed] if num_reps == 1 else chunk_seed.spawn(num_reps + 1) for chunk_seed in chunk_seeds]
+        plan.append((n, num_reps, len(columns), chunks, rep_seeds))
+
+    def tasks():
+        for n, num_reps, _, chunks, rep_seeds in plan:
+            for chunk, chunk_rep_seeds in zip(chunks, rep_seeds):
+                chunk_matrix = matrix[:, chunk]
+                for rep_seed in chunk_rep_seeds[:num_reps]:
+                    yield (chunk_matrix, n, replace, rep_seed)
+
+    with executor_for(n_jobs, executor) as pool:
+        results = imap_tasks(_rarefy_chunk, tasks(), pool)
+        for n, num_reps, num_columns, chunks, rep_seeds in plan:
+            rarefied_chunks = []
+            for chunk_rep_seeds in rep_seeds:
+                reps = [next(results) for _ in range(num_reps)]
+                if num_reps == 1:
+                    rarefied_chunks.append(reps[0])
+                else:
+                    #the repetitions are pooled and n reads drawn again from the pool
+                    rarefied_chunks.append(rarefy_matrix(sum(reps[1:], reps[0]), n, 1, replace,
+                                                         np.random.default_rng(chunk_rep_seeds[-1])))
+
+            if len(rarefied_chunks) == 0:
+                yield sparse.csc_matrix((matrix.shape[0], num_columns), dtype=np.int64)
+            else:
+                yield sparse.hstack(rarefied_chunks, format='csc')
+
+
+def rarefy_matrix_chunked(matrix, n, num_reps=1, replace=True, seed=None, n_jobs=1, executor=None, chunk_size=RAREFACTION_CHUNK_SIZE):
+    """Rarefy like rarefy_matrix, in chunks of chunk_size samples (and repetitions) that may run in parallel.
+
+    See rarefy_matrices: for a given seed and chunk_size the result is
+    bit-identical whether the chunks run serially (n_jobs=1), on n_jobs
+    processes or on the executor given.
+    """
+    with closing(rarefy_matrices(matrix, [(n, num_reps, seed)], replace, n_jobs, executor, chunk_size)) as rarefied:
+        return next(rarefied)
+
+
+def rarefaction_curve_matrices(matrix, depths, seed=None):
+    """Yield (depth, sample_positions, rarefied_matrix) for every depth of a rarefaction curve.
+
+    The subsamples are nested: each depth keeps every read of the previous
+    one and adds reads drawn without replacement from those not yet taken.
+    This is the same as permuting each sample's reads once and reading
+    every depth off as a prefix of that permutation, without ever
+    materializing the reads, and the whole curve is drawn in one pass.
+    As with Rarefaction, samples with fewer reads than a depth are left
+    out of it; sample_positions are the columns of matrix that were kept.
+    """
+    matrix = sparse.csc_matrix(matrix, copy=True)
+    matrix.sum_duplicates()
+
+    if not np.array_equal(matrix.data, np.floor(matrix.data)):
+        raise ValueError("Rarefaction without replacement requires integer counts.")
+
+    rng = np.random.default_rng(as_seed_sequence(seed))
+
+    indptr = matrix.indptr
+    counts = matrix.data.astype(np.int64)
+
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+    totals = cumulative_counts[indptr[1:]] - cumulative_counts[indptr[:-1]]
+
+    drawn = np.zeros(len(counts), dtype=np.int64)
+    drawn_per_sample = np.zeros(len(totals), dtype=np.int64)
+
+    for depth in np.sort(np.asarray(depths, dtype=np.int64)):
+        target = np.minimum(totals, depth)
+        drawn += _draw_counts(indptr, counts - drawn, target - drawn_per_sample, False, rng)
+        drawn_per_sample = target
+
+        sample_positions = np.flatnonzero(totals >= depth)
+
+        #column selection copies, so the shared structure is never modified
+        depth_matrix = sparse.csc_matrix((drawn, matrix.indices, indptr), shape=matrix.shape)[:, sample_positions]
+        depth_matrix.eliminate_zeros()
+
+        yield depth, sample_positions, depth_matrix
+
+
+def rarefy(series, n, rng=None):
+    rarefied = rarefy_matrix(series.values.reshape(-1, 1), n, rng=rng).toarray().ravel()
+    rarefied_series = pd.Series(rarefied, index=series.index, name=series.name)
+    return rarefied_series[rarefied_series > 0]
+
+
+def rarefy_dataframe(dataframe, n, rng=None):
+    rarefied = rarefy_matrix(dataframe.fillna(0).values, n, rng=rng).toarray()
+    rarefied_df = pd.DataFrame(rarefied, index=dataframe.index, columns=dataframe.columns)
+    return rarefied_df[(rarefied_df > 0).any(axis=1)]
@@ -0,0 +1,320 @@
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def _ensure_index(labels):
+    if isinstance(labels, pd.Index):
+        return labels
+    return pd.Index(labels)
+
+
+def _is_full_slice(key):
+    return isinstance(key, slice) and key == slice(None)
+
+
+def _is_boolean_key(key):
+    if isinstance(key, (pd.Series, pd.Index, np.ndarray)):
+        return key.dtype == bool
+    elif isinstance(key, list):
+        return len(key) > 0 and all(isinstance(k, (bool, np.bool_)) for k in key)
+    return False
+
+
+class _LocIndexer(object):
+    def __init__(self, counts_matrix):
+        self.counts_matrix = counts_matrix
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, columns = key
+        else:
+            rows, columns = key, slice(None)
+
+        cm = self.counts_matrix
+        row_positions = cm._label_positions(rows, cm.index)
+        column_positions = cm._label_positions(columns, cm.columns)
+        return cm.take(row_positions, column_positions)
+
+
+class CountsMatrix(object):
+    """A sparse (observations x samples) matrix labelled like a DataFrame.
+
+    The matrix is held in CSC form so that per-sample operations work on
+    contiguous column slices. Only the subset of the DataFrame API used by
+    the transforms is provided; call to_dataframe() for everything else.
+    """
+
+    def __init__(self, matrix, index, columns):
+        self.matrix = sparse.csc_matrix(matrix)
+        #only when needed, as the buffers may be read-only (e.g. memory-mapped)
+        if (self.matrix.data == 0).any():
+            self.matrix.eliminate_zeros()
+        self.index = _ensure_index(index)
+        self.columns = _ensure_index(columns)
+
+        if self.matrix.shape != (len(self.index), len(self.columns)):
+            raise ValueError("matrix shape {} does not match index/columns lengths ({}, {})".format(self.matrix.shape, len(self.index), len(self.columns)))
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        return cls(sparse.csc_matrix(dataframe.fillna(0).values), dataframe.index, dataframe.columns)
+
+    @classmethod
+    def from_biom(cls, biom_table_object):
+        _bt = biom_table_object
+        return cls(_bt.matrix_data, _bt.ids('observation'), _bt.ids('sample'))
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.matrix.toarray(), index=self.index, columns=self.columns)
+
+    def _with_matrix(self, matrix, index=None, columns=None):
+        index = self.index if index is None else index
+        columns = self.columns if columns is None else columns
+        return self.__class__(matrix, index, columns)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    @property
+    def density(self):
+        size = self.shape[0] * self.shape[1]
+        return float(self.nnz) / size if size else 0.0
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    @property
+    def loc(self):
+        return _LocIndexer(self)
+
+    def transpose(self):
+        return self.__class__(self.matrix.transpose(), self.columns, self.index)
+
+    def copy(self):
+        return self._with_matrix(self.matrix.copy())
+
+    def astype(self, dtype):
+        return self._with_matrix(self.matrix.astype(dtype))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return "<CountsMatrix: {} observations x {} samples; {} non-zero values; dtype:{}>".format(self.shape[0], self.shape[1], self.nnz, self.dtype)
+
+    def sum(self, axis=0):
+        if axis in (0, 'index'):
+            return pd.Series(np.asarray(self.matrix.sum(axis=0)).ravel(), index=self.columns)
+        else:
+            return pd.Series(np.asarray(self.matrix.sum(axis=1)).ravel(), index=self.index)
+
+    def count_nonzero(self, axis=0):
+        if axis in (0, 'index'):
+            return pd.Series(self.matrix.getnnz(axis=0), index=self.columns)
+        else:
+            return pd.Series(self.matrix.getnnz(axis=1), index=self.index)
+
+    #comparisons are delegated to scipy, which only stays sparse
+    #when the comparison is False for zero (e.g. "> 0", ">= 1", "!= 0")
+    def _compare(self, operator, other):
+        return self._with_matrix(getattr(self.matrix, operator)(other))
+
+    def __gt__(self, other):
+        return self._compare('__gt__', other)
+
+    def __ge__(self, other):
+        return self._compare('__ge__', other)
+
+    def __lt__(self, other):
+        return self._compare('__lt__', other)
+
+    def __le__(self, other):
+        return self._compare('__le__', other)
+
+    def __ne__(self, other):
+        return self._compare('__ne__', other)
+
+    def _aligned_values(self, other, axis):
+        if isinstance(other, pd.Series):
+            labels = self.columns if axis in (1, 'columns') else self.index
+            return other.reindex(labels).values.astype(float)
+        return np.asarray(other, dtype=float)
+
+    def mul(self, other, axis='columns'):
+        if np.isscalar(other):
+            return self._with_matrix(self.matrix * other)
+
+        values = self._aligned_values(other, axis)
+        if axis in (1, 'columns'):
+            return self._with_matrix(self.matrix @ sparse.diags(values))
+        else:
+            return self._with_matrix(sparse.diags(values) @ self.matrix)
+
+    def div(self, other, axis='columns'):
+        if np.isscalar(other):
+            return self._with_matrix(self.matrix / other)
+
+        values = self._aligned_values(other, axis)
+        #a zero divisor can only belong to an empty row/column,
+        #so its (infinite) reciprocal never touches a stored value
+        with np.errstate(divide='ignore'):
+            reciprocals = 1.0 / values
+        return self.mul(reciprocals, axis)
+
+    @staticmethod
+    def _label_positions(key, labels):
+        if key is None or _is_full_slice(key):
+            return None
+        elif _is_boolean_key(key):
+            if isinstance(key, pd.Series):
+                key = key.reindex(labels).fillna(False)
+            return np.flatnonzero(np.asarray(key, dtype=bool))
+        else:
+            if np.isscalar(key):
+                key = [key]
+            positions = labels.get_indexer(key)
+            if (positions == -1).any():
+                raise KeyError("{} labels not found".format(int((positions == -1).sum())))
+            return positions
+
+    def take(self, rows=None, columns=None):
+        matrix = self.matrix
+        index = self.index
+        cols = self.columns
+
+        if columns is not None:
+            matrix = matrix[:, columns]
+            cols = cols.take(columns)
+        if rows is not None:
+            matrix = matrix[rows, :]
+            index = index.take(rows)
+
+        return self.__class__(matrix, index, cols)
+
+    @staticmethod
+    def _selection_coordinates(positions):
+        #coordinates of an (old x new) selection matrix, with a single 1
+        #linking each found label to its new position (missing labels stay empty)
+        found = positions >= 0
+        new_positions = np.arange(len(positions))[found]
+        data = np.ones(found.sum())
+        return positions[found], new_positions, data
+
+    def reindex(self, index=None, columns=None):
+        result = self
+
+        if columns is not None:
+            columns = _ensure_index(columns)
+            positions = result.columns.get_indexer(columns)
+            if (positions >= 0).all():
+                result = result.take(columns=positions)
+            else:
+                old, new, data = self._selection_coordinates(positions)
+                selector = sparse.csc_matrix((data, (old, new)), shape=(result.shape[1], len(columns)))
+                result = result.__class__(result.matrix @ selector, result.index, columns)
+
+        if index is not None:
+            index = _ensure_index(index)
+            positions = result.index.get_indexer(index)
+            if (positions >= 0).all():
+                result = result.take(rows=positions)
+            else:
+                old, new, data = self._selection_coordinates(positions)
+                selector = sparse.csr_matrix((data, (new, old)), shape=(len(index), result.shape[0]))
+                result = result.__class__(selector @ result.matrix, index, result.columns)
+
+        return result
+
+    def drop(self, labels, axis=0, errors='raise'):
+        axis_labels = self.columns if axis in (1, 'columns') else self.index
+        to_drop = pd.Index(labels)
+        if errors == 'raise':
+            missing = to_drop.difference(axis_labels)
+            if len(missing) > 0:
+                raise KeyError("{} not found in axis".format(list(missing)))
+
+        keep = ~axis_labels.isin(to_drop)
+        if axis in (1, 'columns'):
+            return self.loc[:, keep]
+        else:
+            return self.loc[keep]
+
+    def groupby_sum(self, keys, axis=0):
+        """Sum the rows (axis=0) or columns (axis=1) sharing the same key.
+
+        Behaves like DataFrame.groupby(keys).sum(): keys are sorted and
+        missing (NaN) keys are dropped.
+        """
+        codes, uniques = pd.factorize(keys, sort=True)
+        if isinstance(keys, pd.MultiIndex):
+            uniques = pd.MultiIndex.from_tuples(list(uniques), names=keys.names)
+        else:
+            uniques = pd.Index(uniques, name=getattr(keys, 'name', None))
+
+        indicator = group_indicator(codes, len(uniques), self.dtype)
+
+        if axis in (0, 'index'):
+            return self.__class__(indicator @ self.matrix, uniques, self.columns)
+        else:
+            return self.__class__(self.matrix @ indicator.transpose(), self.index, uniques)
+
+    def apply(self, func, axis=0):
+        """Apply func to each column (axis=0) or row (axis=1) as a dense Series.
+
+        Only one column/row is densified at a time.
+        """
+        if axis in (0, 'index'):
+            matrix = self.matrix
+            labels, other_labels = self.columns, self.index
+            get_vector = lambda i: matrix[:, i].toarray().ravel()
+        else:
+            matrix = self.matrix.tocsr()
+            labels, other_labels = self.index, self.columns
+            get_vector = lambda i: matrix[i, :].toarray().ravel()
+
+        results = OrderedDict()
+        for i, label in enumerate(labels):
+            results[label] = func(pd.Series(get_vector(i), index=other_labels, name=label))
+
+        if all(isinstance(r, pd.Series) for r in results.values()) and len(results) > 0:
+            applied_df = pd.DataFrame(results)
+            return applied_df if axis in (0, 'index') else applied_df.transpose()
+        else:
+            return pd.Series(list(results.values()), index=labels)
+
+
+def group_indicator(codes, num_groups, dtype=np.float64):
+    """A (groups x labels) sparse matrix linking every label to the group of its code (-1 for none)."""
+    codes = np.asarray(codes)
+    found = codes >= 0
+    positions = np.arange(len(codes))[found]
+    return sparse.csr_matrix((np.ones(found.sum(), dtype=dtype), (codes[found], positions)),
+                             shape=(num_groups, len(codes)))
+
+
+def is_sparse(data):
+    return isinstance(data, CountsMatrix)
+
+
+def as_counts_matrix(data):
+    if isinstance(data, CountsMatrix):
+        return data
+    return CountsMatrix.from_dataframe(data)
+
+
+def as_dataframe(data):
+    if isinstance(data, CountsMatrix):
+        return data.to_dataframe()
+    return data
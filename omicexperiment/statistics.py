@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+from omicexperiment.sparse import is_sparse
+
+
+#per-axis statistics, each kept as (per-observation array, per-sample array),
+#i.e. indexed by axis (0: along the rows/observations, 1: along the columns/samples)
+#sums: total counts; nnz: non-zero values; presence: values > 0
+STATISTICS = ('sums', 'nnz', 'presence')
+
+
+def _values(data):
+    return data.matrix if is_sparse(data) else np.asarray(data.values)
+
+
+def _compute(values, sums=True):
+    """The statistics of a dense array or a CSC matrix, computed in one pass over its values."""
+    if isinstance(values, np.ndarray):
+        nonzero = values != 0
+        present = values > 0
+        return {'sums': (np.nansum(values, axis=1), np.nansum(values, axis=0)) if sums else None,
+                'nnz': (nonzero.sum(axis=1), nonzero.sum(axis=0)),
+                'presence': (present.sum(axis=1), present.sum(axis=0))}
+
+    num_rows, num_columns = values.shape
+    column_ids = np.repeat(np.arange(num_columns), np.diff(values.indptr))
+    nonzero = values.data != 0
+    present = values.data > 0
+
+    def count(mask):
+        return (np.bincount(values.indices[mask], minlength=num_rows),
+                np.bincount(column_ids[mask], minlength=num_columns))
+
+    return {'sums': (np.asarray(values.sum(axis=1)).ravel(), np.asarray(values.sum(axis=0)).ravel()),
+            'nnz': count(nonzero),
+            'presence': count(present)}
+
+
+def _sums(data, axis):
+    #through data.sum, so that the sums are exactly those the transforms computed from the data
+    return np.asarray(data.sum(axis=1 - axis))
+
+
+def _is_exact(array):
+    #integer sums can be updated by subtraction without rounding errors
+    return array.dtype.kind in 'biu'
+
+
+class CountsStatistics(object):
+    """Sample and observation totals, non-zero counts and presence counts of a counts table.
+
+    Everything is computed together, on first use. The statistics of a
+    subset of rows (or of columns) of a table whose statistics are known
+    are derived from them (see take) rather than computed again: the
+    kept axis is sliced and the other axis updated with the removed part.
+    """
+    def __init__(self, data):
+        self.data = data
+        self._arrays = None
+        self._series = {}
+        self._parent = None
+
+    def take(self, data, index_mask, columns_mask):
+        """The statistics of data, the rows index_mask and columns columns_mask of self.data.
+
+        They are linked to self (and so to self.data) only if self's are
+        computed already; otherwise they are computed from data alone.
+        """
+        new_stats = self.__class__(data)
+        if self._arrays is not None:
+            new_stats._parent = (self, np.asarray(index_mask, dtype=bool), np.asarray(columns_mask, dtype=bool))
+        return new_stats
+
+    def _from_parent(self):
+        parent, index_mask, columns_mask = self._parent
+        if parent._arrays is None:
+            return None
+
+        rows_kept, columns_kept = index_mask.all(), columns_mask.all()
+        if not (rows_kept or columns_kept):
+            return None
+
+        #the axis subset (0: rows, 1: columns), and the other one
+        axis = 1 if rows_kept else 0
+        mask = columns_mask if rows_kept else index_mask
+        if (~mask).sum() > mask.sum():
+            #removing most of the table: computing its statistics is cheaper
+            return None
+
+        parent_values = _values(parent.data)
+        if axis == 0:
+            removed = _compute(parent_values[np.flatnonzero(~mask)])
+        else:
+            removed = _compute(parent_values[:, np.flatnonzero(~mask)])
+
+        arrays = {}
+        for name in STATISTICS:
+            by_axis = [None, None]
+            by_axis[axis] = parent._arrays[name][axis][mask]
+            other = parent._arrays[name][1 - axis]
+            if _is_exact(other):
+                by_axis[1 - axis] = other - removed[name][1 - axis]
+            else:
+                by_axis[1 - axis] = _sums(self.data, 1 - axis)
+            arrays[name] = tuple(by_axis)
+        return arrays
+
+    def _compute(self):
+        if self._parent is not None:
+            self._arrays = self._from_parent()
+            self._parent = None
+        if self._arrays is None:
+            sparse_data = is_sparse(self.data)
+            self._arrays = _compute(_values(self.data), sums=sparse_data)
+            if not sparse_data:
+                self._arrays['sums'] = (_sums(self.data, 0), _sums(self.data, 1))
+
+    def _get(self, name, axis):
+        if (name, axis) not in self._series:
+            if self._arrays is None:
+                self._compute()
+            labels = self.data.index if axis == 0 else self.data.columns
+            self._series[name, axis] = pd.Series(self._arrays[name][axis], index=labels)
+        return self._series[name, axis]
+
+    @property
+    def sample_sums(self):
+        return self._get('sums', 1)
+
+    @property
+    def observation_sums(self):
+        return self._get('sums', 0)
+
+    @property
+    def sample_nnz(self):
+        return self._get('nnz', 1)
+
+    @property
+    def observation_nnz(self):
+        return self._get('nnz', 0)
+
+    @property
+    def sample_presence(self):
+        """The number of observations present (> 0) in every sample."""
+        return self._get('presence', 1)
+
+    @property
+    def observation_presence(self):
+        """The number of samples every observation is present (> 0) in."""
+        return self._get('presence', 0)
+
+    @property
+    def total(self):
+        return self.sample_sums.sum()
+
+
+def counts_stats(experiment, data):
+    """The statistics of data: those cached on experiment when data is its counts table."""
+    if data is experiment.data:
+        return experiment.counts_stats
+    return CountsStatistics(data)
+
+
+#alpha diversity metrics computed by alpha_diversities (as skbio defines them),
+#with the keyword arguments each accepts
+ALPHA_METRICS = {
+    'observed_features': (),
+    'observed_otus': (),
+    'sobs': (),
+    'singles': (),
+    'doubles': (),
+    'shannon': ('base',),
+    'pielou_e': ('base',),
+    'simpson': (),
+    'dominance': (),
+    'chao1': ('bias_corrected',),
+}
+
+
+def _sample_values(data):
+    """The non-zero counts of data and the position of the sample (column) of each."""
+    if is_sparse(data):
+        matrix = data.matrix
+        return matrix.data, np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+    values = np.asarray(data.fillna(0).values)
+    nonzero = values != 0
+    return values[nonzero], np.nonzero(nonzero)[1]
+
+
+def alpha_diversities(data, metrics, base=None, bias_corrected=True):
+    """The ALPHA_METRICS of every sample (column) of data, as a (metrics x samples) DataFrame.
+
+    All the metrics are computed from the same per-sample intermediates
+    (totals, observed counts, singletons and doubletons, sums of p*log(p)
+    and of p**2), accumulated over the non-zero counts only.
+    """
+    values, sample_ids = _sample_values(data)
+    num_samples = data.shape[1]
+
+    def per_sample(weights=None):
+        return np.bincount(sample_ids, weights=weights, minlength=num_samples)
+
+    totals = per_sample(values)
+    observed = per_sample()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportions = values / totals[sample_ids]
+        dominance = per_sample(proportions * proportions)
+        dominance[observed == 0] = np.nan
+        entropy = per_sample(-proportions * np.log(proportions))
+        entropy[observed == 0] = np.nan
+        singles = per_sample(values == 1)
+        doubles = per_sample(values == 2)
+
+        def chao1():
+            if bias_corrected:
+                return observed + singles * (singles - 1) / (2 * (doubles + 1))
+            return np.where((singles > 0) & (doubles > 0),
+                            observed + singles ** 2 / (2 * doubles),
+                            observed + singles * (singles - 1) / (2 * (doubles + 1)))
+
+        def pielou_e():
+            return np.where(observed == 1, 1.0, entropy / np.log(observed))
+
+        results = {
+            'observed_features': lambda: observed,
+            'observed_otus': lambda: observed,
+            'sobs': lambda: observed,
+            'singles': lambda: singles,
+            'doubles': lambda: doubles,
+            'shannon': lambda: entropy if base is None else entropy / np.log(base),
+            'pielou_e': pielou_e,
+            'simpson': lambda: 1 - dominance,
+            'dominance': lambda: dominance,
+            'chao1': chao1,
+        }
+        rows = [results[metric]() for metric in metrics]
+
+    return pd.DataFrame(np.vstack(rows) if rows else np.empty((0, num_samples)), index=list(metrics), columns=data.columns)
@@ -1,6 +1,7 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from pandas.api.types import CategoricalDtype
 
@@ -150,39 +151,211 @@ class GreenGenesProcessedTaxonomy(object):
         return taxon_no_prefix in ('', 'unidentified', 'no blast hit', 'unassigned')
 
 
-def tax_as_tuples(tax_file_or_tax_df):
+UNIDENTIFIED_TAXA = ('', 'unidentified', 'no blast hit', 'unassigned')
+
+#distinct tax strings whose processed lineage is kept by the lineage cache
+LINEAGE_CACHE_SIZE = 100000
+
+Lineage = namedtuple('Lineage', ('tax_tuple', 'rank_resolution', 'tax', 'taxhash'))
+
+
+class LineageCache(object):
+    """A bounded cache of processed lineages (Lineage tuples), keyed on the raw tax string.
+
+    The least recently used lineages are evicted first.
+    """
+    def __init__(self, maxsize=LINEAGE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lineages = OrderedDict()
+
+    def __len__(self):
+        return len(self._lineages)
+
+    def get(self, tax_string):
+        lineage = self._lineages.get(tax_string)
+        if lineage is not None:
+            self._lineages.move_to_end(tax_string)
+        return lineage
+
+    def update(self, items):
+        """Add (tax string, lineage) pairs, as the most recently used."""
+        for tax_string, lineage in items:
+            self._lineages[tax_string] = lineage
+            self._lineages.move_to_end(tax_string)
+        while len(self._lineages) > self.maxsize:
+            self._lineages.popitem(last=False)
+
+    def clear(self):
+        self._lineages.clear()
+
+
+lineage_cache = LineageCache()
+
+
+def _remove_prefixes(taxa):
+    #as GreenGenesProcessedTaxonomy.remove_prefix, for an array of taxa
+    return np.where(taxa.str[1:3] == '__', taxa.str[3:], taxa)
+
+
+def _are_unidentified(taxa):
+    #as GreenGenesProcessedTaxonomy.is_unidentified, for an array of taxa
+    return pd.Series(_remove_prefixes(taxa), dtype=object).str.lower().isin(UNIDENTIFIED_TAXA).values
+
+
+def _processed_lineages(tax_strings, cache=None):
+    """The processed lineage of every distinct tax string, and the code of each string's lineage.
+
+    Lineages found in cache are not processed again; the others are added to it.
+    """
+    codes, unique_tax_strings = pd.factorize(np.asarray(tax_strings, dtype=object), use_na_sentinel=False)
+    if cache is None:
+        return codes, _process_unique_tax_strings(unique_tax_strings)
+
+    cached = [cache.get(t) if isinstance(t, str) else None for t in unique_tax_strings]
+    missing = np.array([i for i, lineage in enumerate(cached) if lineage is None], dtype=np.intp)
+    processed = _process_unique_tax_strings(unique_tax_strings[missing])
+
+    if len(missing) == len(unique_tax_strings):
+        lineages = processed
+    else:
+        found = np.array([i for i, lineage in enumerate(cached) if lineage is not None], dtype=np.intp)
+        found_lineages = [cached[i] for i in found]
+
+        lineages = OrderedDict()
+        for k, values in processed.items():
+            lineages[k] = np.empty(len(unique_tax_strings), dtype=values.dtype)
+            lineages[k][missing] = values
+        for i, rank in enumerate(TAXONOMY_RANKS):
+            lineages[rank][found] = [l.tax_tuple[i] for l in found_lineages]
+        for field in ('rank_resolution', 'tax', 'taxhash'):
+            lineages[field][found] = [getattr(l, field) for l in found_lineages]
+
+    #lineages that would be evicted by the later ones are not cached
+    to_cache = slice(max(0, len(missing) - cache.maxsize), len(missing))
+    tax_tuples = map(TaxonomyTuple._make, zip(*(processed[rank][to_cache] for rank in TAXONOMY_RANKS)))
+    new_lineages = map(Lineage._make, zip(tax_tuples, *(processed[field][to_cache] for field in ('rank_resolution', 'tax', 'taxhash'))))
+    cache.update((t, lineage) for t, lineage in zip(unique_tax_strings[missing][to_cache], new_lineages) if isinstance(t, str))
+
+    return codes, lineages
+
+
+def process_tax_strings(tax_strings, cache=lineage_cache):
+    """Process a column of tax strings at once, as GreenGenesProcessedTaxonomy does one string.
+
+    Returns an OrderedDict of arrays, keyed by the rank (kingdom to species),
+    'rank_resolution', 'tax' and 'taxhash'. Every distinct string is only
+    processed once, and not at all if its lineage is in cache (a
+    LineageCache, or None).
+    """
+    codes, lineages = _processed_lineages(tax_strings, cache)
+    return OrderedDict((k, v[codes]) for k, v in lineages.items())
+
+
+def _rank_taxa(split_column):
+    """The stripped taxa of one rank, and whether each counts as unidentified.
+
+    Returns (taxa, present, unidentified, unidentified_no_prefix), the last
+    one as tested on the taxon with its prefix removed (as in
+    GreenGenesProcessedTaxonomy.highest_res_rank_index). A rank has far
+    fewer distinct taxa than rows, so the string operations only run on
+    those.
+    """
+    codes, unique_taxa = pd.factorize(np.asarray(split_column, dtype=object))
+    unique_taxa = pd.Series(unique_taxa, dtype=object).str.strip()
+    unique_no_prefix = pd.Series(_remove_prefixes(unique_taxa), dtype=object).str.strip()
+
+    present = codes >= 0
+    #missing taxa (code -1) are taken from the appended None/True values
+    taxa = np.append(unique_taxa.values, None)[codes]
+    unidentified = np.append(_are_unidentified(unique_taxa), True)[codes]
+    unidentified_no_prefix = np.append(_are_unidentified(unique_no_prefix), True)[codes]
+    return taxa, present, unidentified, unidentified_no_prefix
+
+
+def _process_unique_tax_strings(tax_strings):
+    tax_strings = pd.Series(np.asarray(tax_strings, dtype=object), dtype=object)
+    num_rows = len(tax_strings)
+
+    split_df = tax_strings.str.split(';', expand=True) if num_rows else pd.DataFrame(index=tax_strings.index, columns=[0])
+    if split_df.shape[1] > len(TAX_RANKS):
+        raise ValueError("tax strings may hold at most {} ranks".format(len(TAX_RANKS)))
+
+    taxa, present, unidentified, unidentified_no_prefix = zip(*[_rank_taxa(split_df[i]) for i in split_df.columns])
+
+    #the resolved rank is the last of the leading identified ranks
+    identified_so_far = np.ones(num_rows, dtype=bool)
+    rank_index = np.full(num_rows, -1)
+    for is_unidentified in unidentified_no_prefix:
+        identified_so_far &= ~is_unidentified
+        rank_index += identified_so_far
+
+    taxa_array = np.column_stack(taxa) if num_rows else np.empty((0, 1), dtype=object)
+    resolved = rank_index >= 0
+    assignment = np.full(num_rows, 'Unassigned', dtype=object)
+    assignment[resolved] = taxa_array[resolved, rank_index[resolved]]
+    assignment_suffix = " (" + assignment + ")"
+
+    processed = OrderedDict()
+    for i, rank in enumerate(TAXONOMY_RANKS):
+        unidentified_label = "{0}unidentified".format(TAX_PREFIXES[i])
+        if i < len(taxa):
+            relabeled = np.where(unidentified[i], unidentified_label, taxa[i])
+            processed[rank] = np.where(i <= rank_index, taxa[i], relabeled + assignment_suffix)
+        else:
+            processed[rank] = unidentified_label + assignment_suffix
+
+    rank_names = np.array(TAX_RANKS + ('unassigned',), dtype=object)
+    processed['rank_resolution'] = rank_names[rank_index]
+
+    tax = taxa[0].copy()
+    for t, is_present in zip(taxa[1:], present[1:]):
+        tax[is_present] = tax[is_present] + ";" + t[is_present]
+    processed['tax'] = tax
+    processed['taxhash'] = np.array([hash(tuple(t.split(";"))) for t in tax], dtype=np.int64)
+
+    return processed
+
+
+def _tax_file_df(tax_file_or_tax_df):
     if isinstance(tax_file_or_tax_df, pd.DataFrame):
-        tax_file_df = tax_file_or_tax_df
+        return tax_file_or_tax_df
     elif isinstance(tax_file_or_tax_df, (str, Path)):
         tax_fp = Path(str(tax_file_or_tax_df))
         assert( tax_fp.exists() )
-        tax_file_df = load_qiime_taxonomy_assignment_file(tax_fp)
-
-    otu_to_taxonomy_tuples = []
+        return load_qiime_taxonomy_assignment_file(tax_fp)
 
-    for row in zip(tax_file_df['otu'], tax_file_df['tax']):
-        otu = row[0]
 
-        taxonomy_obj = GreenGenesProcessedTaxonomy(row[1])
-        tax = taxonomy_obj.tax_string
-        taxhash = hash(taxonomy_obj)
-        rank_resolution = taxonomy_obj.rank_resolution
-        tax_tuple = taxonomy_obj.tax_tuple
+def _tax_columns(tax_file_or_tax_df):
+    tax_file_df = _tax_file_df(tax_file_or_tax_df)
+    columns = process_tax_strings(tax_file_df['tax'])
+    columns['otu'] = np.asarray(tax_file_df['otu'], dtype=object)
+    return columns
 
-        otu_to_taxonomy_tuples.append((tax_tuple.kingdom, tax_tuple.phylum, tax_tuple.class_, tax_tuple.order, tax_tuple.family, tax_tuple.genus, tax_tuple.species, rank_resolution, tax, taxhash, otu))
 
-    return otu_to_taxonomy_tuples
+def tax_as_tuples(tax_file_or_tax_df):
+    return list(zip(*_tax_columns(tax_file_or_tax_df).values()))
 
 
 def tax_as_index(tax_file_or_tax_df):
-    otu_to_taxonomy_tuples = tax_as_tuples(tax_file_or_tax_df)
-    mi = pd.MultiIndex.from_tuples(otu_to_taxonomy_tuples, names=TAXONOMY_OBJECT_INDEX_COLUMNS)
+    columns = _tax_columns(tax_file_or_tax_df)
+    mi = pd.MultiIndex.from_arrays(list(columns.values()), names=TAXONOMY_OBJECT_INDEX_COLUMNS)
     return mi
 
 
 def tax_as_dataframe(tax_file_or_tax_df):
-    otu_to_taxonomy_tuples = tax_as_tuples(tax_file_or_tax_df)
-    df = pd.DataFrame.from_records(otu_to_taxonomy_tuples, columns=TAXONOMY_OBJECT_INDEX_COLUMNS)
+    tax_file_df = _tax_file_df(tax_file_or_tax_df)
+    codes, lineages = _processed_lineages(tax_file_df['tax'], lineage_cache)
+
+    columns = OrderedDict((k, v[codes]) for k, v in lineages.items() if k not in TAXONOMY_RANKS)
+    columns['otu'] = np.asarray(tax_file_df['otu'], dtype=object)
+    df = pd.DataFrame(columns).infer_objects()
+
+    #the ranks are categoricals, coded from the distinct lineages
+    for rank in TAXONOMY_RANKS:
+        rank_codes, rank_categories = pd.factorize(lineages[rank], sort=True)
+        df[rank] = pd.Categorical.from_codes(rank_codes[codes], categories=pd.Index(rank_categories).infer_objects())
+
+    df = df[list(TAXONOMY_OBJECT_INDEX_COLUMNS)]
     df.set_index('otu', drop=False, inplace=True)
     
     tax_category_type = CategoricalDtype(categories=['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species'],
@@ -193,6 +366,109 @@ def tax_as_dataframe(tax_file_or_tax_df):
     return df
 
 
+def _sorted_codes(values):
+    """Code values by the position of their label among the sorted distinct labels (-1 for missing values)."""
+    if isinstance(values.dtype, CategoricalDtype):
+        codes, labels = np.asarray(values.cat.codes, dtype=np.intp), values.cat.categories
+    else:
+        codes, labels = pd.factorize(np.asarray(values))
+        labels = pd.Index(labels)
+
+    #only the labels found are kept, in sorted order
+    observed = np.zeros(len(labels), dtype=bool)
+    observed[codes[codes >= 0]] = True
+    observed_positions = np.flatnonzero(observed)
+    order = observed_positions[labels.take(observed_positions).argsort()]
+
+    recoded = np.full(len(labels) + 1, -1, dtype=np.intp)
+    recoded[order] = np.arange(len(order))
+    return recoded[codes], labels.take(order)
+
+
+class TaxonomyRankIndex(object):
+    """Integer codes mapping every observation of a taxonomy_df to its taxon at each rank.
+
+    The codes of a rank (or any other taxonomy_df column) and of the
+    lineages down to a rank are computed on first use and kept, so
+    grouping or filtering on the taxonomy needs no join with the counts.
+    """
+    def __init__(self, taxonomy_df):
+        self.taxonomy_df = taxonomy_df
+        self.observations = taxonomy_df.index
+        self._taxon_codes = {}
+        self._taxon_values = {}
+        self._lineage_codes = {}
+        #the last observations looked up, and their positions
+        self._last_positions = (None, None)
+
+    def taxon_codes(self, rank):
+        """(codes, taxa): the position in taxa (the sorted taxa of rank) of every observation's taxon, -1 for none."""
+        if rank not in self._taxon_codes:
+            codes, taxa = _sorted_codes(self.taxonomy_df[rank])
+            self._taxon_codes[rank] = codes, pd.Index(taxa, name=rank)
+        return self._taxon_codes[rank]
+
+    def taxon_values(self, rank):
+        """The taxa of rank as a Series of taxonomy_df's dtype for rank, followed by a missing value (code -1)."""
+        if rank not in self._taxon_values:
+            codes, taxa = self.taxon_codes(rank)
+            found = np.flatnonzero(codes >= 0)
+            _, first = np.unique(codes[found], return_index=True)
+            values = self.taxonomy_df[rank].take(found[first]).reset_index(drop=True)
+            self._taxon_values[rank] = values.reindex(range(len(taxa) + 1))
+        return self._taxon_values[rank]
+
+    def lineage_codes(self, rank):
+        """(codes, taxa): the code of every observation's lineage down to rank, and the taxon at rank of each lineage.
+
+        Lineages are numbered in the order of their taxa, rank by rank;
+        observations missing a taxon at any of those ranks get -1.
+        """
+        if rank not in self._lineage_codes:
+            ranks = TAXONOMY_RANKS[:TAXONOMY_RANKS.index(rank) + 1]
+            lineage_codes = np.zeros(len(self.observations), dtype=np.int64)
+            for r in ranks:
+                codes, taxa = self.taxon_codes(r)
+                has_lineage = (lineage_codes >= 0) & (codes >= 0)
+                combined = lineage_codes[has_lineage] * len(taxa) + codes[has_lineage]
+                unique_combined, combined_codes = np.unique(combined, return_inverse=True)
+
+                lineage_codes = np.full(len(self.observations), -1, dtype=np.int64)
+                lineage_codes[has_lineage] = combined_codes
+
+            self._lineage_codes[rank] = lineage_codes, taxa.take(unique_combined % len(taxa))
+        return self._lineage_codes[rank]
+
+    def group_codes(self, rank, observations, lineage=False):
+        """(codes, taxa): the group of each of observations (in taxa) when grouping by rank, or by lineage down to rank.
+
+        Only the taxa of the observations given are kept.
+        """
+        all_codes, all_taxa = self.lineage_codes(rank) if lineage else self.taxon_codes(rank)
+        codes = self.observation_codes(all_codes, observations)
+
+        used = np.zeros(len(all_taxa) + 1, dtype=bool)
+        used[codes] = True
+        used = used[:-1]
+        recoded = np.append(np.cumsum(used) - 1, -1)
+        return recoded[codes], all_taxa[used]
+
+    def observation_codes(self, codes, observations):
+        """codes (one per observation of taxonomy_df) for observations instead, -1 for those without taxonomy."""
+        last_observations, positions = self._last_positions
+        if observations is not last_observations:
+            if observations.equals(self.observations):
+                positions = np.arange(len(observations))
+            elif not self.observations.is_unique:
+                duplicated = self.observations[self.observations.duplicated()].unique()
+                raise ValueError("the observations of taxonomy_df are not unique: {}".format(list(duplicated[:5])))
+            else:
+                positions = self.observations.get_indexer(observations)
+            self._last_positions = (observations, positions)
+
+        return np.where(positions >= 0, codes[positions], -1)
+
+
 def process_taxonomy_dataframe(tax_file_or_tax_df):
     if isinstance(tax_file_or_tax_df, pd.DataFrame):
         return tax_file_or_tax_df
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.experiment.chunked import ChunkedExperiment
+from omicexperiment.transforms.general import RelativeAbundance, MeanRelativeAbundance, Rarefaction
+from omicexperiment.transforms.observation import ObservationSumCounts
+
+
+class ChunkedExperimentTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 30, size=(40, 11)) * (rng.random((40, 11)) < 0.3)
+        df = pd.DataFrame(counts,
+                          index=['o{}'.format(i) for i in range(40)],
+                          columns=['s{}'.format(i) for i in range(11)])
+        mapping_df = pd.DataFrame({'group': list('abc' * 4)[:11]}, index=df.columns)
+        self.exp = OmicExperiment(df, mapping_df, sparse=True)
+
+        filepath = os.path.join(self.tmpdir, 'exp.npz')
+        self.exp.to_npz(filepath)
+        self.chunked_exp = ChunkedExperiment(filepath, block_size=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_block_wise_transforms_match_in_memory(self):
+        exp = self.exp
+        steps = [exp.Sample.count >= 40, exp.Sample.att.group != 'a', RelativeAbundance]
+
+        result_exp = self.chunked_exp.apply(steps, os.path.join(self.tmpdir, 'result.npz'))
+        self.assertIsInstance(result_exp, ChunkedExperiment)
+        pd.testing.assert_frame_equal(result_exp.to_experiment().data_df, exp.apply(steps).data_df)
+
+    def test_reductions_accumulate_over_blocks(self):
+        exp = self.exp
+        for reduction in (ObservationSumCounts(), MeanRelativeAbundance):
+            steps = [exp.Sample.count >= 40, reduction]
+            pd.testing.assert_frame_equal(self.chunked_exp.apply(steps).data_df, exp.apply(steps).data_df)
+
+    def test_rarefaction(self):
+        rarefied = self.chunked_exp.dapply(Rarefaction(30, seed=0)).to_dataframe()
+
+        self.assertTrue((rarefied.sum() == 30).all())
+        self.assertTrue((rarefied.sum(axis=1) > 0).all())
+        self.assertEqual(list(rarefied.columns), list(self.exp.data.columns[self.exp.data.sum() >= 30]))
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+import pandas as pd
+
+from omicexperiment.experiment.microbiome import MicrobiomeExperiment
+from omicexperiment.transforms.general import RelativeAbundance
+
+
+class DerivedExperimentTestCase(TestCase):
+    def setUp(self):
+        df = pd.DataFrame({'s1': [10, 0, 5], 's2': [0, 4, 4]}, index=['o1', 'o2', 'o3'])
+        mapping_df = pd.DataFrame({'group': ['a', 'b']}, index=['s1', 's2'])
+        taxonomy_df = pd.DataFrame({'genus': ['g__A', 'g__B', 'g__A']}, index=df.index)
+        self.exp = MicrobiomeExperiment(df, mapping_df, taxonomy_df)
+        self.exp._tax_index = object()
+
+    def test_derived_experiments_share_metadata(self):
+        derived_exp = self.exp.apply([self.exp.Sample.count >= 10, RelativeAbundance])
+
+        self.assertIsInstance(derived_exp, MicrobiomeExperiment)
+        self.assertEqual(derived_exp.samples, ['s1'])
+        self.assertIs(derived_exp.mapping_df, self.exp.mapping_df)
+        self.assertIs(derived_exp.taxonomy_df, self.exp.taxonomy_df)
+        self.assertIs(derived_exp._tax_index, self.exp._tax_index)
+
+    def test_with_taxonomy_df_drops_taxonomy_index(self):
+        new_taxonomy_df = self.exp.taxonomy_df.iloc[:2]
+        derived_exp = self.exp.with_taxonomy_df(new_taxonomy_df)
+
+        self.assertIs(derived_exp.taxonomy_df, new_taxonomy_df)
+        self.assertFalse('_tax_index' in derived_exp.__dict__)
+        self.assertIs(derived_exp.data, self.exp.data)
+
+    def test_with_taxonomy_df_none(self):
+        derived_exp = self.exp.with_taxonomy_df(None)
+
+        self.assertIsNone(derived_exp.taxonomy_df)
+        self.assertIsNone(derived_exp._tax_rank_index)
+
+    def test_derived_metadata_is_copied(self):
+        self.exp.metadata = {'source': 'a'}
+        derived_exp = self.exp.apply(RelativeAbundance)
+        derived_exp.metadata['distance_metric'] = 'braycurtis'
+
+        self.assertEqual(derived_exp.metadata, {'source': 'a', 'distance_metric': 'braycurtis'})
+        self.assertEqual(self.exp.metadata, {'source': 'a'})
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from skbio.diversity import beta_diversity
+
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.distance import CondensedDistances, beta_distances, SPARSE_METRICS
+from omicexperiment.transforms.diversity import BetaDiversity, GroupwiseDistances
+
+
+class BlockedBetaDiversityTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 30, size=(60, 23)) * (rng.random((60, 23)) < 0.3)
+        self.df = pd.DataFrame(counts,
+                               index=['o{}'.format(i) for i in range(60)],
+                               columns=['s{}'.format(i) for i in range(23)])
+        self.mapping_df = pd.DataFrame({'group': list('abc' * 8)[:23]}, index=self.df.columns)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_matches_skbio(self):
+        for metric in BetaDiversity.BLOCKED_METRICS:
+            expected = beta_diversity(metric, self.df.T.to_numpy(), ids=list(self.df.columns)).condensed_form()
+            for sparse in (False, True):
+                exp = OmicExperiment(self.df, sparse=sparse)
+                for method in ('dense', 'sparse') if metric in SPARSE_METRICS else ('dense',):
+                    distances = beta_distances(exp.data, metric, block_size=5, method=method)
+                    np.testing.assert_allclose(distances.condensed, expected, atol=1e-12)
+
+    def test_memory_mapped_result(self):
+        exp = OmicExperiment(self.df, self.mapping_df, sparse=True)
+        filepath = os.path.join(self.tmpdir, 'braycurtis.npy')
+        distances_exp = exp.apply(BetaDiversity('braycurtis', filepath=filepath, block_size=7))
+
+        self.assertIsInstance(distances_exp.data, CondensedDistances)
+        self.assertIsInstance(distances_exp.data.condensed, np.memmap)
+
+        in_memory_exp = exp.apply(BetaDiversity('braycurtis'))
+        pd.testing.assert_frame_equal(distances_exp.data_df, in_memory_exp.data_df)
+        pd.testing.assert_frame_equal(distances_exp.dapply(GroupwiseDistances('group')),
+                                      in_memory_exp.dapply(GroupwiseDistances('group')))
+
+
+class GroupwiseDistancesTestCase(TestCase):
+    def test_labels(self):
+        ids = ['s1', 's2', 's3', 's4']
+        #pairs: (s1,s2) (s1,s3) (s1,s4) (s2,s3) (s2,s4) (s3,s4)
+        distances = CondensedDistances(np.array([1., 2., 3., 4., 5., 6.]), ids, 'braycurtis')
+        mapping_df = pd.DataFrame({'group': ['b', 'a', 'b', 'a']}, index=ids)
+        exp = OmicExperiment(pd.DataFrame({'s1': [1]}), mapping_df).with_data_df(distances)
+        exp.metadata = {'distance_metric': 'braycurtis'}
+
+        groupwise_df = exp.dapply(GroupwiseDistances('group', include_within_dists=True))
+        self.assertEqual(list(groupwise_df.loc[['all_within'], 'braycurtis']), [2., 5.])
+        self.assertEqual(list(groupwise_df.loc[['all_between'], 'braycurtis']), [1., 3., 4., 6.])
+        #both orders of the samples
+        self.assertEqual(list(groupwise_df.loc[['b_vs_a'], 'braycurtis']), [1., 3., 4., 6.])
+        self.assertEqual(list(groupwise_df.loc[['within_a'], 'braycurtis']), [5.])
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.transforms.general import RelativeAbundance
+from omicexperiment.transforms.transform import FusedFilter, FilterExpression
+
+
+class LazyExperimentTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 30, size=(50, 12)) * (rng.random((50, 12)) < 0.4)
+        self.df = pd.DataFrame(counts,
+                               index=['o{}'.format(i) for i in range(50)],
+                               columns=['s{}'.format(i) for i in range(12)])
+        self.mapping_df = pd.DataFrame({'group': ['a', 'b', 'c'] * 4}, index=self.df.columns)
+
+    def steps(self, exp):
+        return [exp.Observation.min_count == 40,
+                exp.Sample.count >= 60,
+                RelativeAbundance,
+                exp.Sample.att.group != 'a',
+                exp.Observation.min_samples == 2]
+
+    def test_plan_is_optimized(self):
+        exp = OmicExperiment(self.df, self.mapping_df)
+        plan = exp.lazy().apply(self.steps(exp)).optimized_plan()
+
+        self.assertEqual(len(plan), 3)
+        self.assertIsInstance(plan[0], FusedFilter)
+        self.assertEqual(len(plan[0].filters), 3)
+        self.assertIs(plan[1], RelativeAbundance)
+
+    def test_collect_matches_eager_apply(self):
+        for sparse in (False, True):
+            exp = OmicExperiment(self.df, self.mapping_df, sparse=sparse)
+            eager_df = exp.apply(self.steps(exp)).data_df
+            lazy_exp = exp.lazy().apply(self.steps(exp)).collect()
+
+            self.assertEqual(lazy_exp.is_sparse, sparse)
+            pd.testing.assert_frame_equal(lazy_exp.data_df, eager_df)
+
+
+class FilterExpressionTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 30, size=(50, 12)) * (rng.random((50, 12)) < 0.4)
+        self.df = pd.DataFrame(counts,
+                               index=['o{}'.format(i) for i in range(50)],
+                               columns=['s{}'.format(i) for i in range(12)])
+        self.mapping_df = pd.DataFrame({'group': ['a', 'b', 'c'] * 4}, index=self.df.columns)
+
+    def test_boolean_algebra(self):
+        for sparse in (False, True):
+            exp = OmicExperiment(self.df, self.mapping_df, sparse=sparse)
+            sample_sums = self.df.sum()
+
+            either_df = exp.apply((exp.Sample.count >= 150) | (exp.Sample.att.group == 'a')).data_df
+            self.assertEqual(list(either_df.columns), list(self.df.columns[(sample_sums >= 150) | (self.mapping_df.group == 'a')]))
+
+            not_df = exp.apply(~(exp.Sample.count >= 150)).data_df
+            self.assertEqual(list(not_df.columns), list(self.df.columns[sample_sums < 150]))
+
+    def test_and_across_axes_fuses(self):
+        exp = OmicExperiment(self.df, self.mapping_df)
+        expression = (exp.Observation.min_count == 40) & (exp.Sample.count >= 60) & ~(exp.Observation.min_samples == 6)
+
+        self.assertIsInstance(expression, FusedFilter)
+        self.assertIsInstance(expression.filters[2], FilterExpression)
+        pd.testing.assert_frame_equal(exp.apply(expression).data_df,
+                                      exp.apply(list(expression.filters)).data_df)
+
+        with self.assertRaises(ValueError):
+            (exp.Observation.min_count == 40) | (exp.Sample.count >= 60)
+
+    def test_fused_filter_cannot_be_or_or_inverted(self):
+        exp = OmicExperiment(self.df, self.mapping_df)
+        fused = (exp.Sample.count >= 10) & (exp.Observation.min_count == 5)
+
+        with self.assertRaises(ValueError):
+            fused | (exp.Sample.att.group == 'a')
+        with self.assertRaises(ValueError):
+            (exp.Sample.att.group == 'a') | fused
+        with self.assertRaises(ValueError):
+            ~fused
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
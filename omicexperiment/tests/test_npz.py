@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from omicexperiment.experiment.microbiome import MicrobiomeExperiment
+from omicexperiment.io.npz import load_experiment_npz
+from omicexperiment.dataframe import load_counts, load_dataframe
+
+
+class ExperimentNpzTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'exp.npz')
+
+        df = pd.DataFrame({'s1': [10, 0, 5], 's2': [0, 4, 4]}, index=['o1', 'o2', 'o3'])
+        mapping_df = pd.DataFrame({'group': ['a', np.nan], 'depth': [1.5, 2.0]}, index=pd.Index(['s1', 's2'], name='#SampleID'))
+        taxonomy_df = pd.DataFrame({'genus': ['g__A', 'g__B', 'g__A'],
+                                    'rank_resolution': pd.Categorical(['genus', 'genus', 'family'],
+                                                                      categories=['family', 'genus'], ordered=True)},
+                                   index=pd.Index(df.index, name='otu'))
+        self.exp = MicrobiomeExperiment(df, mapping_df, taxonomy_df, metadata={'run': 3}, sparse=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        self.exp.to_npz(self.filepath)
+        loaded_exp = load_experiment_npz(self.filepath)
+
+        self.assertIsInstance(loaded_exp, MicrobiomeExperiment)
+        self.assertTrue(loaded_exp.is_sparse)
+        #the counts are memory-mapped, read-only
+        self.assertFalse(loaded_exp.data.matrix.data.flags.writeable)
+        self.assertEqual(loaded_exp.metadata, {'run': 3})
+
+        pd.testing.assert_frame_equal(loaded_exp.data_df, self.exp.data_df)
+        pd.testing.assert_frame_equal(loaded_exp.mapping_df, self.exp.mapping_df, check_dtype=False)
+        pd.testing.assert_frame_equal(loaded_exp.taxonomy_df, self.exp.taxonomy_df, check_dtype=False)
+        self.assertTrue(loaded_exp.taxonomy_df['rank_resolution'].cat.ordered)
+
+    def test_load_counts_recognizes_npz(self):
+        self.exp.to_npz(self.filepath)
+        pd.testing.assert_frame_equal(load_counts(self.filepath).to_dataframe(), self.exp.data_df)
+        pd.testing.assert_frame_equal(load_dataframe(self.filepath), self.exp.data_df)
+
+    def test_text_and_categories(self):
+        mapping_df = pd.DataFrame({'note': ['a\x00b', None], 'dose': pd.Categorical([10, 20])},
+                                  index=pd.Index(['s1', 's2'], name='#SampleID'))
+        exp = MicrobiomeExperiment(self.exp.data_df, mapping_df)
+        exp.to_npz(self.filepath)
+        pd.testing.assert_frame_equal(load_experiment_npz(self.filepath).mapping_df, mapping_df)
+
+    def test_mixed_object_column_raises(self):
+        mapping_df = pd.DataFrame({'mixed': ['a', 1]}, index=pd.Index(['s1', 's2'], name='#SampleID'))
+        exp = MicrobiomeExperiment(self.exp.data_df, mapping_df)
+        self.assertRaises(ValueError, exp.to_npz, self.filepath)
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
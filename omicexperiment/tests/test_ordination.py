@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import numpy as np
+from scipy.spatial.distance import pdist
+from skbio.stats.ordination import pcoa
+
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.distance import CondensedDistances
+from omicexperiment.transforms.ordination import PCoA
+
+
+class ApproximatePCoATestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        points = np.hstack([rng.standard_normal((150, 4)) * [10, 6, 3, 1], 0.1 * rng.standard_normal((150, 20))])
+        self.distances = CondensedDistances(pdist(points), ['s{}'.format(i) for i in range(150)])
+        self.full_results = pcoa(self.distances.to_dataframe(), dimensions=3)
+
+    def test_matches_full_pcoa(self):
+        for data in (self.distances, self.distances.to_dataframe()):
+            exp = OmicExperiment(data)
+            for method in ('randomized', 'eigsh'):
+                pcoa_exp = exp.apply(PCoA(method, dimensions=3, seed=0, block_elements=1000))
+                results = pcoa_exp.metadata['pcoa']
+
+                self.assertEqual(list(pcoa_exp.data_df.columns), list(self.distances.ids))
+                np.testing.assert_allclose(results.eigvals.values, self.full_results.eigvals.values, rtol=1e-8)
+                np.testing.assert_allclose(results.proportion_explained.values, self.full_results.proportion_explained.values, rtol=1e-8)
+                #axes are defined up to their sign
+                np.testing.assert_allclose(np.abs(pcoa_exp.data_df.values.T), np.abs(self.full_results.samples.values), atol=1e-6)
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
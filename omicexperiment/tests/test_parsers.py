@@ -0,0 +1,100 @@
+import os
+import hashlib
+import shutil
+import tempfile
+from unittest import TestCase
+
+from omicexperiment.util import parse_fasta, parse_fastq, iter_fasta_records, iter_fastq_batches, sha1_digests, Sha1Cache
+from omicexperiment.dataframe import counts_matrix_from_sequence_files
+
+
+class SequenceParsersTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.fasta_filepath = os.path.join(self.tmpdir, 'seqs.fasta')
+        with open(self.fasta_filepath, 'w') as f:
+            f.write(">seq1 sample=a\nACGT\nTTGA\n>seq2\nGG\n\n>seq3\nC")
+
+        self.fastq_filepath = os.path.join(self.tmpdir, 'seqs.fastq')
+        with open(self.fastq_filepath, 'w') as f:
+            for i in range(5):
+                f.write("@read{}\nACGT{}\n+\nIIII{}\n".format(i, 'A' * i, 'I' * i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_fasta_joins_multiline_records(self):
+        expected = [('seq1 sample=a', 'ACGTTTGA'), ('seq2', 'GG'), ('seq3', 'C')]
+        self.assertEqual(list(parse_fasta(self.fasta_filepath)), expected)
+
+        #records spanning several read blocks are reassembled
+        small_blocks = list(iter_fasta_records(self.fasta_filepath, buffer_size=3))
+        self.assertEqual([(d.decode(), s.decode()) for d, s in small_blocks], expected)
+
+    def test_fastq_batches(self):
+        batches = list(iter_fastq_batches(self.fastq_filepath, batch_size=2, buffer_size=16))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(list(batches[2].iloc[0]), ['read4', 'ACGTAAAA', 'IIIIIIII'])
+        self.assertEqual(len(list(parse_fastq(self.fastq_filepath))), 5)
+
+
+class SequenceFilesCountsTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepaths = []
+        for i, seqs in enumerate([['AAA', 'CCC', 'AAA'], ['CCC', 'GGG']]):
+            filepath = os.path.join(self.tmpdir, 's{}.fasta'.format(i))
+            with open(filepath, 'w') as f:
+                for j, seq in enumerate(seqs):
+                    f.write(">r{}\n{}\n".format(j, seq))
+            self.filepaths.append(filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_counts_matrix_from_sequence_files(self):
+        counts, sequences_df = counts_matrix_from_sequence_files(self.filepaths, ['a', 'b'])
+        sha1 = lambda seq: hashlib.sha1(seq.encode('utf-8')).hexdigest()
+
+        counts_df = counts.to_dataframe()
+        self.assertEqual(list(counts_df.columns), ['a', 'b'])
+        self.assertEqual(list(counts_df.loc[sha1('AAA')]), [2, 0])
+        self.assertEqual(list(counts_df.loc[sha1('CCC')]), [1, 1])
+        self.assertEqual(sequences_df.loc[sha1('GGG'), 'sequence'], 'GGG')
+        self.assertEqual(list(sequences_df.index), list(counts.index))
+
+        threaded_counts, threaded_sequences_df = counts_matrix_from_sequence_files(self.filepaths, ['a', 'b'], n_threads=2)
+        self.assertTrue(threaded_counts.to_dataframe().equals(counts_df))
+        self.assertTrue(threaded_sequences_df.equals(sequences_df))
+
+
+class Sha1DigestsTestCase(TestCase):
+    def test_digests_match_hashlib(self):
+        sequences = ['ACGT', 'GG', 'ACGT', b'TTA']
+        expected = [hashlib.sha1(s if isinstance(s, bytes) else s.encode('utf-8')).hexdigest() for s in sequences]
+
+        self.assertEqual(list(sha1_digests(sequences)), expected)
+        self.assertEqual(list(sha1_digests(sequences, n_threads=2)), expected)
+        self.assertEqual([d.hex() for d in sha1_digests(sequences, binary=True)], expected)
+
+    def test_cache_roundtrip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache_filepath = os.path.join(tmpdir, 'sha1_cache.npz')
+            cache = Sha1Cache(cache_filepath)
+            digests = sha1_digests(['ACGT', 'GG', 'ACGT'], cache=cache)
+            self.assertEqual(len(cache), 2)
+            cache.save()
+
+            reloaded_cache = Sha1Cache(cache_filepath)
+            cached_digests, found = reloaded_cache.lookup([b'GG', b'CCC'])
+            self.assertEqual(list(found), [True, False])
+            self.assertEqual(cached_digests[0].hex(), digests[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
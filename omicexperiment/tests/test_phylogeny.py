@@ -0,0 +1,53 @@
+from io import StringIO
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from skbio import TreeNode
+from skbio.diversity import alpha_diversity, beta_diversity
+
+from omicexperiment.experiment.microbiome import MicrobiomeExperiment
+from omicexperiment.phylogeny import TreeIndex
+from omicexperiment.transforms.diversity import AlphaDiversity, BetaDiversity
+
+
+class PhylogeneticDiversityTestCase(TestCase):
+    def setUp(self):
+        self.newick = '(((a:1,b:2)x:0.5,(c:3,d:1)y:2)z:1,(e:1,(f:1,g:2)w:1.5)v:0.5)root;'
+        self.tree = TreeNode.read(StringIO(self.newick))
+        self.df = pd.DataFrame({'s1': [1, 0, 3, 0, 2, 0, 1],
+                                's2': [0, 2, 1, 1, 0, 0, 4],
+                                's3': [5, 5, 0, 0, 0, 1, 0],
+                                's4': [0, 0, 0, 7, 0, 2, 2]}, index=list('abcdefg'))
+
+    def test_tree_index(self):
+        tree_index = TreeIndex(self.tree)
+        self.assertEqual(len(tree_index), 13)
+        self.assertEqual(tree_index.parent[-1], -1)
+        np.testing.assert_allclose(tree_index.tip_depths(pd.Index(['a', 'g'])), [2.5, 4.0])
+
+    def test_matches_skbio(self):
+        counts = self.df.T.to_numpy()
+        for sparse in (False, True):
+            exp = MicrobiomeExperiment(self.df, sparse=sparse).with_tree(self.newick)
+
+            expected = alpha_diversity('faith_pd', counts, ids=self.df.columns, taxa=self.df.index, tree=self.tree)
+            np.testing.assert_allclose(exp.dapply(AlphaDiversity('faith_pd')).loc['faith_pd'].values, expected.values)
+
+            for metric, kwargs in (('unweighted_unifrac', {}), ('weighted_unifrac', {}), ('weighted_unifrac', {'normalized': True})):
+                expected = beta_diversity(metric, counts, ids=self.df.columns, taxa=self.df.index, tree=self.tree, **kwargs)
+                np.testing.assert_allclose(exp.dapply(BetaDiversity(metric, block_size=3, **kwargs)).values, expected.data, atol=1e-12)
+
+    def test_empty_samples(self):
+        tree = TreeNode.read(StringIO('((a:1,b:2)x:1,c:3)r;'))
+        df = pd.DataFrame({'s1': [1, 0, 2], 's2': [0, 0, 0], 's3': [0, 3, 0], 's4': [0, 0, 0]}, index=list('abc'))
+        counts = df.T.to_numpy()
+        exp = MicrobiomeExperiment(df).with_tree(tree)
+        for metric, kwargs in (('unweighted_unifrac', {}), ('weighted_unifrac', {}), ('weighted_unifrac', {'normalized': True})):
+            expected = beta_diversity(metric, counts, ids=df.columns, taxa=df.index, tree=tree, **kwargs)
+            np.testing.assert_allclose(exp.dapply(BetaDiversity(metric, **kwargs)).values, expected.data, atol=1e-12)
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,56 @@
+import os
+import pickle
+import shutil
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from omicexperiment.io.qiime2 import TaxonomyAssignment, NewickTree
+
+
+class Qiime2ArtifactFileTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_artifact(self, member, payload):
+        filepath = os.path.join(self.tmpdir, 'artifact.qza')
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('1234-abcd/metadata.yaml', 'uuid: 1234-abcd\ntype: X\nformat: Y\n')
+            z.writestr('1234-abcd/provenance/metadata.yaml', 'uuid: 5678-efgh\n')
+            z.writestr('1234-abcd/data/' + member, payload)
+        return filepath
+
+    def test_reads_from_the_archive(self):
+        filepath = self._write_artifact('taxonomy.tsv', 'Feature ID\tTaxon\tConfidence\no1\tk__Bacteria; p__X\t0.9\no2\tk__Bacteria\t0.8\n')
+        with TaxonomyAssignment(filepath) as artifact:
+            self.assertEqual(artifact.__id__, '1234-abcd')
+            self.assertEqual(artifact.metadata['uuid'], '1234-abcd')
+            self.assertIs(artifact.metadata, artifact.metadata)
+            tax_df = artifact.to_dataframe()
+        self.assertEqual(list(tax_df.index), ['o1', 'o2'])
+        self.assertEqual(tax_df.loc['o1', 'tax'], 'k__Bacteria; p__X')
+        self.assertIsNone(artifact._zipfile)
+
+    def test_newick_tree(self):
+        tree_artifact = NewickTree(self._write_artifact('tree.nwk', '((o1:1,o2:2)x:1,o3:1)root;\n'))
+        tree_index = tree_artifact.to_tree_index()
+        self.assertEqual(len(tree_index), 5)
+        self.assertEqual(sorted(tree_index.tips.index), ['o1', 'o2', 'o3'])
+        tree_artifact.close()
+
+    def test_pickle(self):
+        filepath = self._write_artifact('tree.nwk', '((o1:1,o2:2)x:1,o3:1)root;\n')
+        with NewickTree(filepath) as tree_artifact:
+            newick = tree_artifact.load_data()
+            unpickled = pickle.loads(pickle.dumps(tree_artifact))
+        self.assertIsNone(unpickled._zipfile)
+        self.assertEqual(unpickled.load_data(), newick)
+        unpickled.close()
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,123 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from omicexperiment.rarefaction import rarefy_matrix, rarefy_matrix_chunked, rarefy_matrices, rarefaction_curve_matrices
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.transforms.general import Rarefaction, RarefactionCurve
+from omicexperiment.transforms.observation import NumberUniqueObservations
+from omicexperiment.transforms.observation import AbundanceFilteringWangEtAl
+
+
+class RarefyMatrixTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        counts = rng.integers(0, 50, size=(200, 30))
+        counts[rng.random(counts.shape) < 0.7] = 0
+        self.matrix = sparse.csc_matrix(counts)
+        self.depth = int(np.asarray(self.matrix.sum(axis=0)).min())
+
+    def test_every_sample_rarefied_to_depth(self):
+        for replace in (True, False):
+            rarefied = rarefy_matrix(self.matrix, self.depth, replace=replace, rng=0)
+            np.testing.assert_array_equal(np.asarray(rarefied.sum(axis=0)).ravel(), self.depth)
+            self.assertEqual(rarefied.dtype, np.int64)
+
+    def test_without_replacement_never_exceeds_counts(self):
+        rarefied = rarefy_matrix(self.matrix, self.depth, replace=False, rng=0)
+        self.assertEqual((rarefied > self.matrix).nnz, 0)
+
+    def test_without_replacement_full_depth_returns_counts(self):
+        column = sparse.csc_matrix(np.array([[5], [0], [3], [2]]))
+        rarefied = rarefy_matrix(column, 10, replace=False, rng=0)
+        np.testing.assert_array_equal(rarefied.toarray(), column.toarray())
+
+    def test_seeded_draws_are_reproducible(self):
+        first = rarefy_matrix(self.matrix, self.depth, num_reps=3, rng=7)
+        second = rarefy_matrix(self.matrix, self.depth, num_reps=3, rng=7)
+        self.assertEqual((first != second).nnz, 0)
+
+    def test_chunked_result_independent_of_workers(self):
+        serial = rarefy_matrix_chunked(self.matrix, self.depth, seed=11, chunk_size=7)
+        parallel = rarefy_matrix_chunked(self.matrix, self.depth, seed=11, chunk_size=7, n_jobs=2)
+        self.assertEqual((serial != parallel).nnz, 0)
+        np.testing.assert_array_equal(np.asarray(parallel.sum(axis=0)).ravel(), self.depth)
+
+    def test_draws_and_repetitions_independent_of_workers(self):
+        seed = np.random.SeedSequence(13)
+        draws = [(self.depth, 3, seed), (10, 1, seed, [0, 2, 4])]
+        serial = list(rarefy_matrices(self.matrix, draws, chunk_size=7))
+        parallel = list(rarefy_matrices(self.matrix, draws, chunk_size=7, n_jobs=2))
+        for serial_matrix, parallel_matrix in zip(serial, parallel):
+            self.assertEqual((serial_matrix != parallel_matrix).nnz, 0)
+        np.testing.assert_array_equal(np.asarray(serial[0].sum(axis=0)).ravel(), self.depth)
+        self.assertEqual(serial[1].shape, (self.matrix.shape[0], 3))
+
+        #the caller's SeedSequence is not advanced by the draws
+        again = rarefy_matrix_chunked(self.matrix, self.depth, 3, seed=seed, chunk_size=7)
+        self.assertEqual((again != serial[0]).nnz, 0)
+
+    def test_without_replacement_requires_enough_reads(self):
+        with self.assertRaises(ValueError):
+            rarefy_matrix(self.matrix, int(self.matrix.sum()), replace=False, rng=0)
+
+    def test_curve_subsamples_are_nested(self):
+        totals = np.asarray(self.matrix.sum(axis=0)).ravel()
+        depths = [0, 10, self.depth, totals.max()]
+        previous = None
+
+        for depth, sample_positions, depth_matrix in rarefaction_curve_matrices(self.matrix, depths, seed=5):
+            np.testing.assert_array_equal(sample_positions, np.flatnonzero(totals >= depth))
+            np.testing.assert_array_equal(np.asarray(depth_matrix.sum(axis=0)).ravel(), depth)
+            self.assertEqual((depth_matrix > self.matrix[:, sample_positions]).nnz, 0)
+
+            if previous is not None:
+                previous_positions, previous_matrix = previous
+                kept = np.isin(previous_positions, sample_positions)
+                self.assertEqual((previous_matrix[:, kept] > depth_matrix).nnz, 0)
+
+            previous = (sample_positions, depth_matrix)
+
+
+class RarefactionTransformTestCase(TestCase):
+    def test_dense_and_sparse_experiments_agree(self):
+        df = pd.DataFrame({'s1': [10, 0, 5, 1], 's2': [0, 4, 4, 0], 's3': [1, 1, 0, 0]},
+                          index=['o1', 'o2', 'o3', 'o4'])
+        dense_exp = OmicExperiment(df)
+        sparse_exp = OmicExperiment(df, sparse=True)
+
+        dense_df = dense_exp.apply(Rarefaction(5, seed=3, replace=False)).data_df
+        sparse_df = sparse_exp.apply(Rarefaction(5, seed=3, replace=False)).data_df
+
+        pd.testing.assert_frame_equal(dense_df, sparse_df)
+        self.assertEqual(list(dense_df.columns), ['s1', 's2'])
+        self.assertTrue((dense_df.sum() == 5).all())
+
+    def test_incremental_curve_defaults(self):
+        exp = OmicExperiment(pd.DataFrame({'s1': [10, 0, 5, 1], 's2': [0, 4, 4, 0]}, index=['o1', 'o2', 'o3', 'o4']))
+        curve_df = exp.dapply(RarefactionCurve(8, 1, 4, NumberUniqueObservations, seed=1, incremental=True))
+        self.assertEqual(list(curve_df.index), [0, 4])
+        self.assertRaises(ValueError, RarefactionCurve, 8, 1, 4, NumberUniqueObservations, replace=True, incremental=True)
+
+
+class AbundanceFilteringTestCase(TestCase):
+    def test_thresholds_reproducible_and_independent_of_workers(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(100, 2000, size=(60, 6))
+        counts[:20] = rng.integers(0, 3, size=(20, 6))
+        exp = OmicExperiment(pd.DataFrame(counts), sparse=True)
+
+        serial = exp.apply(AbundanceFilteringWangEtAl(num_reps=200, seed=4)).data_df
+        parallel = exp.apply(AbundanceFilteringWangEtAl(num_reps=200, seed=4, n_jobs=2)).data_df
+
+        pd.testing.assert_frame_equal(serial, parallel)
+        #the rare observations are filtered out, the abundant ones are all kept
+        self.assertTrue(len(serial) < 60)
+        self.assertTrue(set(range(20, 60)).issubset(serial.index))
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from omicexperiment.sparse import CountsMatrix
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.transforms.general import RelativeAbundance
+
+
+class CountsMatrixTestCase(TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'s1': [10, 0, 5, 0],
+                                's2': [0, 0, 3, 7],
+                                's3': [1, 2, 0, 0]},
+                               index=['o1', 'o2', 'o3', 'o4'],
+                               columns=['s1', 's2', 's3'])
+        self.cm = CountsMatrix.from_dataframe(self.df)
+
+    def test_roundtrip_dataframe(self):
+        pd.testing.assert_frame_equal(self.cm.to_dataframe(), self.df, check_dtype=False)
+        self.assertEqual(self.cm.nnz, 6)
+
+    def test_sums(self):
+        pd.testing.assert_series_equal(self.cm.sum(), self.df.sum(), check_dtype=False)
+        pd.testing.assert_series_equal(self.cm.sum(axis=1), self.df.sum(axis=1), check_dtype=False)
+        pd.testing.assert_series_equal((self.cm > 0).sum(axis=1), (self.df > 0).sum(axis=1), check_dtype=False)
+
+    def test_loc_boolean_rows_and_columns(self):
+        rows = self.df.sum(axis=1) >= 5
+        selected = self.cm.loc[rows, ['s3', 's1']]
+        pd.testing.assert_frame_equal(selected.to_dataframe(), self.df.loc[rows, ['s3', 's1']], check_dtype=False)
+
+    def test_reindex_fills_missing_with_zeros(self):
+        reindexed = self.cm.reindex(columns=['s2', 'missing'])
+        self.assertEqual(list(reindexed.columns), ['s2', 'missing'])
+        self.assertEqual(reindexed.sum()['missing'], 0)
+        self.assertEqual(reindexed.sum()['s2'], 10)
+
+    def test_groupby_sum(self):
+        keys = pd.Series(['b', 'a', 'b', np.nan], name='cluster')
+        grouped = self.cm.groupby_sum(keys)
+        expected = self.df.iloc[:3].groupby(keys.iloc[:3].values).sum()
+        self.assertEqual(grouped.index.name, 'cluster')
+        np.testing.assert_array_equal(grouped.to_dataframe().values, expected.values)
+
+    def test_apply_per_column(self):
+        applied = self.cm.apply(lambda c: (c > 0).sum())
+        pd.testing.assert_series_equal(applied, self.df.apply(lambda c: (c > 0).sum()), check_dtype=False)
+
+
+class SparseExperimentTestCase(TestCase):
+    def setUp(self):
+        df = pd.DataFrame({'s1': [10, 0, 5], 's2': [0, 4, 4]}, index=['o1', 'o2', 'o3'])
+        self.exp = OmicExperiment(df, sparse=True)
+
+    def test_transforms_stay_sparse(self):
+        rel_exp = self.exp.apply(RelativeAbundance)
+        self.assertTrue(rel_exp.is_sparse)
+        self.assertAlmostEqual(rel_exp.data_df.loc['o1', 's1'], 10 / 15 * 100)
+
+        filtered_exp = self.exp.apply(self.exp.Observation.min_count == 6)
+        self.assertTrue(filtered_exp.is_sparse)
+        self.assertEqual(filtered_exp.observations, ['o1', 'o3'])
+
+    def test_to_dense(self):
+        dense_exp = self.exp.to_dense()
+        self.assertFalse(dense_exp.is_sparse)
+        self.assertIsInstance(dense_exp.data, pd.DataFrame)
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from skbio.diversity import alpha_diversity
+
+from omicexperiment.experiment.experiment import OmicExperiment
+from omicexperiment.statistics import CountsStatistics
+from omicexperiment.transforms.diversity import AlphaDiversity
+
+
+class CountsStatisticsTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 30, size=(40, 10)) * (rng.random((40, 10)) < 0.4)
+        self.df = pd.DataFrame(counts,
+                               index=['o{}'.format(i) for i in range(40)],
+                               columns=['s{}'.format(i) for i in range(10)])
+
+    def test_statistics(self):
+        for sparse in (False, True):
+            stats = OmicExperiment(self.df, sparse=sparse).counts_stats
+            pd.testing.assert_series_equal(stats.sample_sums, self.df.sum(), check_dtype=False)
+            pd.testing.assert_series_equal(stats.observation_sums, self.df.sum(axis=1), check_dtype=False)
+            pd.testing.assert_series_equal(stats.sample_nnz, (self.df != 0).sum(), check_dtype=False)
+            pd.testing.assert_series_equal(stats.observation_presence, (self.df > 0).sum(axis=1), check_dtype=False)
+
+    def test_carried_through_filters(self):
+        for sparse in (False, True):
+            exp = OmicExperiment(self.df, sparse=sparse)
+            exp.counts_stats.sample_sums
+
+            filtered_exp = exp.apply(exp.Observation.min_count == 60)
+            filtered_exp = filtered_exp.apply(filtered_exp.Sample.count >= 100)
+
+            stats = filtered_exp.counts_stats
+            fresh_stats = CountsStatistics(filtered_exp.data)
+            for name in ('sample_sums', 'observation_sums', 'sample_nnz', 'observation_nnz', 'sample_presence', 'observation_presence'):
+                pd.testing.assert_series_equal(getattr(stats, name), getattr(fresh_stats, name), check_dtype=False)
+
+    def test_uncomputed_statistics_do_not_link_filtered_experiments(self):
+        mapping_df = pd.DataFrame({'group': list('ab' * 5)}, index=self.df.columns)
+        exp = OmicExperiment(self.df, mapping_df, sparse=True)
+        filtered_exp = exp.apply(exp.Sample.att.group == 'a')
+        filtered_exp = filtered_exp.apply(filtered_exp.Sample.att.group != 'b')
+        self.assertIsNone(exp._counts_stats)
+        self.assertIsNone(filtered_exp._counts_stats)
+        pd.testing.assert_series_equal(filtered_exp.counts_stats.sample_sums, filtered_exp.data_df.sum(), check_dtype=False)
+
+
+class AlphaDiversityTestCase(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 4, size=(40, 10)) * (rng.random((40, 10)) < 0.4)
+        counts[:, 0] = 0
+        self.df = pd.DataFrame(counts,
+                               index=['o{}'.format(i) for i in range(40)],
+                               columns=['s{}'.format(i) for i in range(10)])
+
+    def test_batched_metrics_match_skbio(self):
+        metrics = ['sobs', 'shannon', 'simpson', 'chao1', 'pielou_e', 'margalef']
+        for sparse in (False, True):
+            alpha_df = OmicExperiment(self.df, sparse=sparse).dapply(AlphaDiversity(metrics))
+            self.assertEqual(list(alpha_df.index), metrics)
+            for metric in metrics:
+                expected = alpha_diversity(metric, self.df.T.to_numpy(), ids=self.df.columns)
+                np.testing.assert_allclose(alpha_df.loc[metric].values.astype(float), expected.values.astype(float), equal_nan=True)
+
+    def test_skbio_metric_kwargs_with_batched_metric(self):
+        df = self.df.drop(columns='s0')
+        alpha_df = OmicExperiment(df).dapply(AlphaDiversity(['tsallis', 'shannon'], order=3, base=2))
+        expected = alpha_diversity('tsallis', df.T.to_numpy(), ids=df.columns, order=3)
+        np.testing.assert_allclose(alpha_df.loc['tsallis'].values.astype(float), expected.values.astype(float))
+        expected = alpha_diversity('shannon', df.T.to_numpy(), ids=df.columns, base=2)
+        np.testing.assert_allclose(alpha_df.loc['shannon'].values.astype(float), expected.values.astype(float))
+
+        alpha_df = OmicExperiment(df).dapply(AlphaDiversity('michaelis_menten_fit', num_repeats=2))
+        self.assertEqual(list(alpha_df.index), ['michaelis_menten_fit'])
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main()
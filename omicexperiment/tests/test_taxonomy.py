@@ -1,6 +1,10 @@
 from unittest import TestCase
 
-from omicexperiment.taxonomy import GreenGenesProcessedTaxonomy
+import pandas as pd
+
+from omicexperiment.taxonomy import GreenGenesProcessedTaxonomy, process_tax_strings, tax_as_dataframe, LineageCache, TAXONOMY_RANKS
+from omicexperiment.experiment.microbiome import MicrobiomeExperiment
+from omicexperiment.transforms.taxonomy import TaxonomyGroupBy
 
 class GreenGenesProcessedTaxonomyTestCase(TestCase):
     def setUp(self):
@@ -53,6 +57,92 @@ class GreenGenesProcessedTaxonomyTestCase(TestCase):
             self.assertEqual(tax.highest_res_rank, 'unassigned')
 
 
+class ProcessTaxStringsTestCase(TestCase):
+    def test_matches_greengenes_processed_taxonomy(self):
+        test_strings = ["k__Fungi;p__Ascomycota;c__Eurotiomycetes;o__Eurotiales;f__Trichocomaceae;g__Aspergillus;s__Aspergillus bombycis",
+                        "k__Fungi;p__Ascomycota;c__Dothideomycetes;o__unidentified;f__Pleosporaceae",
+                        "k__Fungi; p__Ascomycota ;c__;o__",
+                        "k__Fungi;p__Ascomycota;c__Dothideomycetes;o__unidentified;f__Pleosporaceae",
+                        "No blast hit",
+                        "k__unidentified;",
+                        ""]
+
+        processed = process_tax_strings(test_strings)
+
+        for i, test_str in enumerate(test_strings):
+            tax = GreenGenesProcessedTaxonomy(test_str)
+            self.assertEqual(tuple(processed[rank][i] for rank in TAXONOMY_RANKS), tax.tax_tuple)
+            self.assertEqual(processed['rank_resolution'][i], tax.rank_resolution)
+            self.assertEqual(processed['tax'][i], tax.tax_string)
+            self.assertEqual(processed['taxhash'][i], hash(tax))
+
+    def test_lineage_cache(self):
+        cache = LineageCache(maxsize=2)
+        test_strings = ["k__Fungi;p__Ascomycota", "k__Fungi", "k__Fungi;p__Basidiomycota", "k__Fungi"]
+        processed = process_tax_strings(test_strings, cache=cache)
+
+        #the least recently used lineage is evicted
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("k__Fungi;p__Ascomycota"))
+        self.assertEqual(cache.get("k__Fungi").tax, "k__Fungi")
+
+        cached_processed = process_tax_strings(test_strings, cache=cache)
+        for k in processed:
+            self.assertEqual(list(cached_processed[k]), list(processed[k]))
+
+    def test_ranks_are_categorical(self):
+        tax_df = tax_as_dataframe(pd.DataFrame({'otu': ['a', 'b', 'c'], 'tax': ["k__Fungi;p__Ascomycota", "k__Fungi", "k__Fungi;p__Ascomycota"]}))
+        self.assertIsInstance(tax_df['phylum'].dtype, pd.CategoricalDtype)
+        self.assertEqual(list(tax_df['phylum']), ["p__Ascomycota", "p__unidentified (k__Fungi)", "p__Ascomycota"])
+
+
+class TaxonomyGroupByTestCase(TestCase):
+    def setUp(self):
+        tax_df = tax_as_dataframe(pd.DataFrame({'otu': ['o1', 'o2', 'o3', 'o4'],
+                                                'tax': ["k__A;p__X", "k__B;p__X", "k__A;p__Y", "k__A;p__X"]}))
+        counts_df = pd.DataFrame({'s1': [1, 2, 3, 4], 's2': [0, 5, 0, 6]}, index=['o1', 'o2', 'o3', 'o4'])
+        self.exps = [MicrobiomeExperiment(counts_df, taxonomy_assignment_file=tax_df, sparse=sparse) for sparse in (False, True)]
+
+    def test_collapse(self):
+        for exp in self.exps:
+            grouped = exp.dapply(TaxonomyGroupBy('phylum'))
+            grouped_df = grouped.to_dataframe() if exp.is_sparse else grouped
+            self.assertEqual(list(grouped_df.index), ['p__X', 'p__Y'])
+            self.assertEqual(grouped_df.loc['p__X'].tolist(), [7, 11])
+
+    def test_lineages(self):
+        #p__X of k__A and of k__B stay apart
+        for exp in self.exps:
+            grouped = exp.dapply(TaxonomyGroupBy('phylum', collapse=False))
+            grouped_df = grouped.to_dataframe() if exp.is_sparse else grouped
+            self.assertEqual(list(grouped_df.index), ['p__X', 'p__Y', 'p__X'])
+            self.assertEqual(grouped_df['s2'].tolist(), [6, 0, 5])
+
+
+class TaxonomyAttributeFilterTestCase(TestCase):
+    def test_filter_on_taxonomy_index(self):
+        tax_df = tax_as_dataframe(pd.DataFrame({'otu': ['o1', 'o2', 'o3'],
+                                                'tax': ["k__A;p__X;c__C;o__O;f__F;g__G", "k__B;p__X", "k__A;p__Y"]}))
+        #o4 has no taxonomy
+        counts_df = pd.DataFrame({'s1': [1, 2, 3, 4]}, index=['o1', 'o2', 'o3', 'o4'])
+        exp = MicrobiomeExperiment(counts_df, taxonomy_assignment_file=tax_df)
+
+        self.assertEqual(list(exp.apply(exp.Taxonomy.phylum == 'p__X').data.index), ['o1', 'o2'])
+        self.assertEqual(list(exp.apply(exp.Taxonomy.phylum != 'p__X').data.index), ['o3', 'o4'])
+        #rank_resolution compares in rank order
+        self.assertEqual(list(exp.apply(exp.Taxonomy.rank_resolution >= 'phylum').data.index), ['o1', 'o2', 'o3'])
+        self.assertEqual(list(exp.apply(exp.Taxonomy.rank_resolution > 'phylum').data.index), ['o1'])
+
+    def test_duplicate_taxonomy_observations(self):
+        tax_df = tax_as_dataframe(pd.DataFrame({'otu': ['o1', 'o2', 'o2'],
+                                                'tax': ["k__A;p__X", "k__B;p__X", "k__A;p__Y"]}))
+        counts_df = pd.DataFrame({'s1': [1, 2, 3]}, index=['o1', 'o2', 'o3'])
+        exp = MicrobiomeExperiment(counts_df, taxonomy_assignment_file=tax_df)
+
+        with self.assertRaisesRegex(ValueError, 'not unique'):
+            exp.apply(exp.Taxonomy.phylum == 'p__X')
+
+
 if __name__ == "__main__":
     from unittest import main
     main()
@@ -6,29 +6,74 @@ from skbio.diversity import beta_diversity
 
 from omicexperiment.transforms.transform import Transform
 from omicexperiment.transforms.general import RarefactionFunction
+from omicexperiment.statistics import alpha_diversities, ALPHA_METRICS
+from omicexperiment.distance import CondensedDistances, beta_distances, DISTANCE_BLOCK_SIZE, SPARSE_METRICS
+from omicexperiment.phylogeny import as_tree_index, faith_pd, unifrac_distances, PHYLOGENETIC_ALPHA_METRICS, PHYLOGENETIC_BETA_METRICS
+
+
+#skbio's keyword arguments for the tree of the phylogenetic metrics and its tips
+PHYLOGENETIC_KWARGS = ('tree', 'taxa', 'otu_ids')
+
+
+def _tree_index(transform, experiment):
+    """The TreeIndex of the transform's tree keyword argument (built once), or else of the experiment."""
+    if 'tree' in transform.kwargs:
+        if getattr(transform, '_tree_index', None) is None:
+            transform._tree_index = as_tree_index(transform.kwargs['tree'])
+        return transform._tree_index
+    return getattr(experiment, 'tree_index', None)
 
 
 class AlphaDiversity(Transform):
+    """Alpha diversity of every sample, one row per metric.
+
+    distance_metric is a metric name or a list of them. The metrics in
+    statistics.ALPHA_METRICS (observed_features, shannon, simpson, chao1,
+    pielou_e...) are computed together in one pass over the non-zero
+    counts, sparse or dense; faith_pd over the tree index of the tree
+    keyword argument or of the experiment (see
+    MicrobiomeExperiment.with_tree); the others by skbio's alpha_diversity.
+    """
+    column_wise = True
+
     def __init__(self, distance_metric, **kwargs):
         self.distance_metric = distance_metric
         self.kwargs = kwargs
 
+    @property
+    def metrics(self):
+        if isinstance(self.distance_metric, str):
+            return [self.distance_metric]
+        return list(self.distance_metric)
+
+    def _skbio_alpha(self, experiment, metric, kwargs):
+        kwargs = dict(kwargs)
+        if 'tree' in kwargs and not ('taxa' in kwargs or 'otu_ids' in kwargs):
+            kwargs['taxa'] = experiment.data_df.index
+        matrix = experiment.data_df.T.to_numpy()
+        return alpha_diversity(metric, counts=matrix, ids=experiment.data_df.columns, **kwargs)
+
     def __dapply__(self, experiment):
-        otu_ids = experiment.data_df.index
-        sample_ids = experiment.data_df.columns
-        matrix = experiment.data_df.T.as_matrix()
-        try:
-            alpha = alpha_diversity(self.distance_metric, counts=matrix, ids=sample_ids, **self.kwargs)
-        except ValueError as e:
-            otu_ids_err_msg = "``otu_ids`` is required for phylogenetic diversity metrics."
-            if str(e) == otu_ids_err_msg:
-                alpha = alpha_diversity(self.distance_metric, counts=matrix,
-                                        ids=sample_ids, otu_ids=otu_ids,
-                                        **self.kwargs)
+        metrics = self.metrics
+        batched = [m for m in metrics if m in ALPHA_METRICS]
+        #the batched metrics take only the keyword arguments they accept, skbio's the others
+        batched_kwargs = {k: v for k, v in self.kwargs.items() if any(k in ALPHA_METRICS[m] for m in batched)}
+        skbio_kwargs = {k: v for k, v in self.kwargs.items() if k not in batched_kwargs}
+        if batched:
+            alpha_df = alpha_diversities(experiment.data, batched, **batched_kwargs)
+        else:
+            alpha_df = pd.DataFrame(columns=experiment.data.columns, dtype=np.float64)
+
+        for metric in metrics:
+            if metric in batched:
+                continue
+            tree_index = _tree_index(self, experiment) if metric in PHYLOGENETIC_ALPHA_METRICS else None
+            if tree_index is not None:
+                alpha_df.loc[metric] = faith_pd(tree_index, experiment.data).values
             else:
-                raise(e)
-                
-        return alpha.to_frame(name=self.distance_metric).transpose()
+                alpha_df.loc[metric] = self._skbio_alpha(experiment, metric, skbio_kwargs).values
+
+        return alpha_df.loc[metrics]
 
     def __eapply__(self, experiment):
         distance_matrix_df = self.__dapply__(experiment)
@@ -36,18 +81,59 @@ class AlphaDiversity(Transform):
 
 
 class BetaDiversity(Transform):
-    def __init__(self, distance_metric, **kwargs):
+    """Distances between the samples, by skbio's beta_diversity.
+
+    The BLOCKED_METRICS (without extra keyword arguments) are computed by
+    the blocked engine of omicexperiment.distance instead, in n_jobs
+    processes or on executor; method selects its sparse kernels (Bray-Curtis
+    and the presence/absence metrics, the default for sparse data) or
+    its dense ones. The UniFrac metrics are computed the same way over the
+    tree index of the tree keyword argument or of the experiment (see
+    phylogeny.unifrac_distances). With condensed=True or a filepath (where
+    the distances are memory-mapped), the result is a CondensedDistances
+    rather than a square DataFrame.
+    """
+    BLOCKED_METRICS = ('euclidean',) + SPARSE_METRICS
+
+    def __init__(self, distance_metric, condensed=False, filepath=None, block_size=DISTANCE_BLOCK_SIZE, n_jobs=1, executor=None, method='auto', **kwargs):
         self.distance_metric = distance_metric
+        self.method = method
+        self.condensed = condensed
+        self.filepath = filepath
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.executor = executor
         self.kwargs = kwargs
 
+    def _unifrac_distances(self, experiment):
+        if self.distance_metric not in PHYLOGENETIC_BETA_METRICS \
+           or not set(self.kwargs) <= set(PHYLOGENETIC_KWARGS + ('normalized',)):
+            return None
+        tree_index = _tree_index(self, experiment)
+        if tree_index is None:
+            return None
+
+        metric = self.distance_metric
+        if metric == 'weighted_unifrac' and self.kwargs.get('normalized'):
+            metric = 'weighted_normalized_unifrac'
+        return unifrac_distances(tree_index, experiment.data, metric, self.block_size, self.filepath, self.n_jobs, self.executor)
+
     def __dapply__(self, experiment):
+        distances = self._unifrac_distances(experiment)
+        if distances is None and self.distance_metric in self.BLOCKED_METRICS and not self.kwargs:
+            distances = beta_distances(experiment.data, self.distance_metric, self.block_size, self.filepath, self.n_jobs, self.executor, self.method)
+        if distances is not None:
+            if self.condensed or self.filepath is not None:
+                return distances
+            return distances.to_dataframe()
+
         otu_ids = experiment.data_df.index
         df = experiment.data_df.transpose()
         try:
-            dm = beta_diversity(self.distance_metric, counts=df.as_matrix(), otu_ids=otu_ids, **self.kwargs)
+            dm = beta_diversity(self.distance_metric, counts=df.to_numpy(), otu_ids=otu_ids, **self.kwargs)
         except TypeError as e:
             if 'takes no keyword arguments' in str(e):
-                dm = beta_diversity(self.distance_metric, counts=df.as_matrix(), **self.kwargs)
+                dm = beta_diversity(self.distance_metric, counts=df.to_numpy(), **self.kwargs)
             else:
                 raise(e)
             
@@ -58,66 +144,90 @@ class BetaDiversity(Transform):
         distance_matrix_df = self.__dapply__(experiment)
         new_exp = experiment.with_data_df(distance_matrix_df)
         new_exp.metadata['distance_metric'] = self.distance_metric
-        return experiment.with_data_df(distance_matrix_df)
+        return new_exp
 
 
 class GroupwiseDistances(Transform):
+    """The distances between samples, labelled by the groups (grouping_col of mapping_df) of the two samples.
+
+    Returns every distance within a group (labelled all_within) and
+    between groups (all_between), followed by the distances between each
+    pair of groups (grp1_vs_grp2) and, with include_within_dists, within
+    each group (within_grp), indexed by a categorical 'label' index.
+    Groups are in their order in mapping_df; samples without a group only
+    count as between groups.
+    """
     def __init__(self, grouping_col, include_between_dists=True, include_within_dists=False, **kwargs):
         self.grouping_col = grouping_col
         self.include_between_dists = include_between_dists
         self.include_within_dists = include_within_dists
         self.kwargs = kwargs
 
+    @staticmethod
+    def _pair_codes(codes):
+        """The codes of the first and second sample of every pair, in the order of the condensed distances."""
+        num_samples = len(codes)
+        first = np.repeat(codes[:-1], np.arange(num_samples - 1, 0, -1))
+        second = np.concatenate([codes[r + 1:] for r in range(num_samples - 1)]) if num_samples > 1 else codes[:0]
+        return first, second
+
     def __dapply__(self, experiment):
-        from collections import OrderedDict
-        from itertools import combinations
-        
-        grouping_col = self.grouping_col
         distance_metric = experiment.metadata['distance_metric']
-        
-        
-        distances_df = pd.DataFrame({distance_metric: squareform(experiment.data_df)},
-                        index=pd.MultiIndex.from_tuples(tuple(combinations(experiment.data_df.index, 2)), names=['sample_1', 'sample_2'])).reset_index()
-
-        group_1 = experiment.mapping_df[[grouping_col]].reindex(distances_df['sample_1'])
-        group_2 = experiment.mapping_df[[grouping_col]].reindex(distances_df['sample_2'])
-
-        distances_df['group_1'] = group_1.reset_index()[grouping_col]
-        distances_df['group_2'] = group_2.reset_index()[grouping_col]
-        
-        all_within = distances_df[distances_df['group_1'] == distances_df['group_2']]
-        all_within_with_label = all_within.copy()
-        all_within_with_label['label'] = 'all_within'
-        all_within_with_label = all_within_with_label.set_index('label')[[distance_metric]]
-
-        all_between = distances_df[distances_df['group_1'] != distances_df['group_2']]
-        all_between_with_label = all_between.copy()
-        all_between_with_label['label'] = 'all_between'
-        all_between_with_label = all_between_with_label.set_index('label')[[distance_metric]]
-
-        dist_dataframes = OrderedDict()
-        dist_dataframes['all_within'] = all_within_with_label
-        dist_dataframes['all_between'] = all_between_with_label
-        
+
+        data = experiment.data
+        condensed = np.asarray(data.condensed if isinstance(data, CondensedDistances) else squareform(data))
+
+        group_codes, groups = pd.factorize(experiment.mapping_df[self.grouping_col])
+        num_groups = len(groups)
+        codes = pd.Series(group_codes, index=experiment.mapping_df.index).reindex(data.index, fill_value=-1).to_numpy()
+        codes = codes.astype(np.int32)
+
+        first, second = self._pair_codes(codes)
+        within = (first == second) & (first >= 0)
+
+        #every pair of groups (or group, for pairs within one) as a single key,
+        #the distances sorted by it once (stably, keeping their order)
+        key_dtype = np.int32 if num_groups * num_groups < np.iinfo(np.int32).max else np.int64
+        keys = np.minimum(first, second).astype(key_dtype)
+        has_groups = keys >= 0
+        keys *= num_groups
+        keys += np.maximum(first, second)
+        keys[~has_groups] = -1
+        del first, second, has_groups
+
+        order = np.argsort(keys, kind='stable')
+        #where the distances of every key start in that order
+        key_starts = np.searchsorted(keys[order], np.arange(num_groups * num_groups + 1, dtype=key_dtype))
+        del keys
+
+        def key_positions(key):
+            return order[key_starts[key]:key_starts[key + 1]]
+
+        labels = ['all_within', 'all_between']
+        selections = [within, ~within]
+
         if self.include_between_dists:
-            for grp1, grp2 in combinations(experiment.mapping_df[grouping_col].unique(), 2):
-                lbl = "{}_vs_{}".format(grp1, grp2)
-                dist_df = distances_df[(distances_df['group_1'] == grp1) & (distances_df['group_2'] == grp2)]
-                dist_df_w_label = dist_df.copy()
-                dist_df_w_label['label'] = lbl
-                dist_df_w_label = dist_df_w_label.set_index('label')[[distance_metric]]
-                dist_dataframes[lbl] = dist_df_w_label
-        
+            for i in range(num_groups):
+                for j in range(i + 1, num_groups):
+                    labels.append("{}_vs_{}".format(groups[i], groups[j]))
+                    selections.append(key_positions(i * num_groups + j))
+
         if self.include_within_dists:
-            for grp in experiment.mapping_df[grouping_col].unique():
-                lbl = "within_{}".format(grp)
-                dist_df = distances_df[(distances_df['group_1'] == grp) & (distances_df['group_2'] == grp)]
-                dist_df_w_label = dist_df.copy()
-                dist_df_w_label['label'] = lbl
-                dist_df_w_label = dist_df_w_label.set_index('label')[[distance_metric]]
-                dist_dataframes[lbl] = dist_df_w_label
-        
-        return pd.concat([v for k,v in dist_dataframes.items()])
+            for i in range(num_groups):
+                labels.append("within_{}".format(groups[i]))
+                selections.append(key_positions(i * num_groups + i))
+
+        #filled label by label, the labels kept as the codes of a categorical index
+        sizes = [int(sel.sum()) if sel.dtype == bool else len(sel) for sel in selections]
+        values = np.empty(sum(sizes), dtype=condensed.dtype)
+        start = 0
+        for sel, size in zip(selections, sizes):
+            values[start:start + size] = condensed[sel]
+            start += size
+
+        label_codes = np.repeat(np.arange(len(labels), dtype=np.min_scalar_type(len(labels))), sizes)
+        label_index = pd.CategoricalIndex(pd.Categorical.from_codes(label_codes, labels), name='label')
+        return pd.DataFrame({distance_metric: values}, index=label_index)
 
     def __eapply__(self, experiment):
         groupwise_distances_df = self.__dapply__(experiment)
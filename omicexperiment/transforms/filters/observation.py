@@ -1,37 +1,61 @@
 import pandas as pd
 from omicexperiment.transforms.transform import TransformObjectsProxy, Transform, Filter
 from omicexperiment.transforms.observation import ObservationSumCounts
+from omicexperiment.statistics import counts_stats
 
 class ObservationMinCount(Filter):
-    def __dapply__(self, experiment):
+    axis = 'index'
+    per_label = True
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, int)
-            df = experiment.data_df
-            return df[df.sum(axis=1) >= self.value]
+            return counts_stats(experiment, data).observation_sums >= self.value
+
+    def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
             
 class ObservationMinCountFraction(Filter):
-    def __dapply__(self, experiment):
+    axis = 'index'
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, float)
             assert self.value <= 1
-            df = experiment.data_df
-            obs_fractions = df.sum(axis=1) / (df.sum(axis=1).sum())
-            return df[obs_fractions >= self.value]
+            obs_sums = counts_stats(experiment, data).observation_sums
+            obs_fractions = obs_sums / obs_sums.sum()
+            return obs_fractions >= self.value
 
-class ObservationMaxCount(Filter):
     def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
+
+class ObservationMaxCount(Filter):
+    axis = 'index'
+    per_label = True
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, int)
-            df = experiment.data_df
-            return df[df.sum(axis=1) <= self.value]
+            return counts_stats(experiment, data).observation_sums <= self.value
 
-class ObservationMinSamples(Filter):
     def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
+
+class ObservationMinSamples(Filter):
+    axis = 'index'
+    per_label = True
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, int)
-            df = experiment.data_df
-            absence_presence = (df > 0)
-            return df[absence_presence.sum(axis=1) >= self.value]
+            return counts_stats(experiment, data).observation_presence >= self.value
+
+    def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
 
 
 class Observation(TransformObjectsProxy):
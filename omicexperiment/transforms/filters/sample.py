@@ -1,39 +1,59 @@
 import pandas as pd
 from omicexperiment.transforms.transform import Filter, AttributeFilter, GroupByTransform, FlexibleOperatorMixin, AttributeFlexibleOperatorMixin, TransformObjectsProxy
 from omicexperiment.transforms.sample import SampleGroupBy, SampleSumCounts
+from omicexperiment.statistics import counts_stats
 
 
 class SampleMinCount(Filter):
-    def __dapply__(self, experiment):
+    axis = 'columns'
+    per_label = True
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, int)
-            df = experiment.data_df
-            criteria = (df.sum() >= self.value)
-            return df[criteria.index[criteria]]
+            return (counts_stats(experiment, data).sample_sums >= self.value)
+
+    def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
 
 
 class SampleMaxCount(Filter):
-    def __dapply__(self, experiment):
+    axis = 'columns'
+    per_label = True
+
+    def _criteria(self, experiment, data):
         if self.operator == '__eq__':
             assert isinstance(self.value, int)
-            df = experiment.data_df
-            criteria = (df.sum() <= self.value)
-            return df[criteria.index[criteria]]
+            return (counts_stats(experiment, data).sample_sums <= self.value)
+
+    def __dapply__(self, experiment):
+        df = experiment.data
+        return self._select(df, self._criteria(experiment, df))
 
 
 class SampleCount(FlexibleOperatorMixin, Filter):
+    axis = 'columns'
+    per_label = True
+
+    def _criteria(self, experiment, data):
+        _op = self._op_function(counts_stats(experiment, data).sample_sums)
+        return _op(self.value)
+
     def __dapply__(self, experiment):
-        _op = self._op_function(experiment.data_df.sum())
-        criteria = _op(self.value)
-        criteria = _op(self.value)
-        return experiment.data_df.reindex(columns=criteria.index[criteria])
+        return self._select(experiment.data, self._criteria(experiment, experiment.data))
        
        
 class SampleAttributeFilter(AttributeFilter, AttributeFlexibleOperatorMixin):
-    def __dapply__(self, experiment):
+    axis = 'columns'
+    data_dependent = False
+
+    def _criteria(self, experiment, data):
         _op = self._op_function(experiment.mapping_df)
-        criteria = _op(self.value)
-        return experiment.data_df.reindex(columns=criteria.index[criteria])
+        return _op(self.value)
+
+    def __dapply__(self, experiment):
+        return self._select(experiment.data, self._criteria(experiment, experiment.data))
         
 
 class Sample(TransformObjectsProxy):
@@ -1,14 +1,24 @@
+import numpy as np
 import pandas as pd
 from omicexperiment.transforms.transform import Filter, AttributeFilter, AttributeFlexibleOperatorMixin
 
 
 class TaxonomyAttributeFilter(AttributeFilter, AttributeFlexibleOperatorMixin):
+    axis = 'index'
+    data_dependent = False
+
+    def _criteria(self, experiment, data):
+        #evaluate the criteria once per distinct value of the attribute,
+        #then spread it to the observations through their codes
+        rank_index = experiment.taxonomy_rank_index
+        codes, _ = rank_index.taxon_codes(self.attribute)
+        values = rank_index.taxon_values(self.attribute)
+
+        _op = self._op_function(values.to_frame(self.attribute))
+        value_criteria = np.asarray(_op(self.value).fillna(False), dtype=bool)
+        return pd.Series(value_criteria[rank_index.observation_codes(codes, data.index)], index=data.index)
+
     def __dapply__(self, experiment):
-        _op = self._op_function(experiment._counts_with_tax())
-        criteria = _op(self.value)
-        return experiment.data_df[criteria]
-    
-    def __eapply__(self, experiment):
-        filtered_df = self.__dapply__(experiment)
-        return experiment.with_data_df(filtered_df)
-        
+        data = experiment.data
+        return self._select(data, self._criteria(experiment, data))
+
@@ -1,16 +1,24 @@
 from collections import OrderedDict
+from contextlib import closing
+from itertools import islice
 import numpy as np
 import pandas as pd
 from scipy.spatial.distance import pdist, cdist, squareform
 from omicexperiment.transforms.transform import Transform
 from omicexperiment.taxonomy import tax_as_dataframe
+from omicexperiment.sparse import CountsMatrix, is_sparse, as_counts_matrix
+from omicexperiment.rarefaction import rarefy_matrix, rarefy_matrices, rarefaction_curve_matrices, as_seed_sequence
 from omicexperiment.util import hybridmethod
+from omicexperiment.distance import beta_distances, DISTANCE_BLOCK_SIZE
 
 
 class RelativeAbundance(Transform):
+    column_wise = True
+
     @classmethod
     def __dapply__(cls, experiment):
-        rel_counts = experiment.data_df.apply(lambda c: c / c.sum() * 100, axis=0)
+        data = experiment.data
+        rel_counts = data.div(data.sum(), axis='columns').mul(100)
         return rel_counts
 
     @classmethod
@@ -32,11 +40,15 @@ class MeanRelativeAbundance(Transform):
 
 class Prevalence(Transform):
     def __init__(self, obs_presence_cuttoff=0):
-        self.obs_presence_cuttoff = obs_presence_cuttoff
+        self.obs_presence_cutoff = obs_presence_cuttoff
         
     def __dapply__(self, experiment):
-        present_absent_df = (experiment.data_df > self.obs_presence_cutoff)
-        obs_prevalence_series = present_absent_df.astype(int).apply(lambda c: c.sum() / c.count() * 100, axis=1).sort_values(ascending=False)
+        data = experiment.data
+        if self.obs_presence_cutoff == 0:
+            obs_presence_series = experiment.counts_stats.observation_presence
+        else:
+            obs_presence_series = (data > self.obs_presence_cutoff).sum(axis=1)
+        obs_prevalence_series = (obs_presence_series / len(data.columns) * 100).sort_values(ascending=False)
         return obs_prevalence_series.to_frame("prevalence")
 
     def __eapply__(self, experiment):
@@ -45,55 +57,59 @@ class Prevalence(Transform):
 
     
 class Rarefaction(Transform):
-    def __init__(self, n, num_reps=1):
+    block_wise = True
+
+    def __init__(self, n, num_reps=1, replace=True, seed=None, n_jobs=1, executor=None):
         self.n = n
         self.num_reps = num_reps
+        self.replace = replace
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.executor = executor
 
 
     @staticmethod
-    def _rarefy_series(series, n, num_reps=1):
-
-        series_name = series.name
+    def _rarefy_series(series, n, num_reps=1, rng=None):
 
         if n == 0:
             sampled_series = pd.Series(0, index=series.index, name=series.name)
             return sampled_series
 
-        sampled_series = series.sample(n, replace=True, weights=series)
-        sampled_value_counts = sampled_series.index.value_counts()
-        sampled_value_counts.name = series_name
-
-        if num_reps == 1:
-            return sampled_value_counts
-        elif num_reps > 1:
-            for r in range(num_reps - 1):
-                next_sampled_series = series.sample(n, replace=True, weights=series)
-                next_sampled_value_counts = next_sampled_series.index.value_counts()
+        rarefied = rarefy_matrix(series.values.reshape(-1, 1), n, num_reps, replace=True, rng=rng)
+        sampled_series = pd.Series(rarefied.toarray().ravel(), index=series.index, name=series.name)
+        return sampled_series[sampled_series > 0]
 
-                sampled_value_counts = pd.concat([sampled_value_counts, next_sampled_value_counts], axis=1).fillna(0).sum(axis=1)
-                sampled_value_counts.name = series_name
 
-                del next_sampled_series
-                del next_sampled_value_counts
+    @staticmethod
+    def _rarefied_data(data, draws, replace=True, n_jobs=1, executor=None):
+        """Yield data (a CountsMatrix or DataFrame) rarefied for every (n, num_reps, seed[, columns]) of draws.
 
-            sampled_value_counts = sampled_value_counts.sample(n, replace=True, weights=sampled_value_counts).index.value_counts()
-            sampled_value_counts.name = series_name
+        All the draws run on the same pool (see rarefaction.rarefy_matrices).
+        """
+        counts_matrix = data if is_sparse(data) else CountsMatrix.from_dataframe(data)
+        rarefied_matrices = rarefy_matrices(counts_matrix.matrix, draws, replace, n_jobs, executor)
+        for draw, rarefied in zip(draws, rarefied_matrices):
+            n = draw[0]
+            columns = counts_matrix.columns if len(draw) < 4 or draw[3] is None else counts_matrix.columns.take(draw[3])
+            rarefied_matrix = CountsMatrix(rarefied, counts_matrix.index, columns)
 
-            return sampled_value_counts
+            if n != 0:
+                #observations never drawn in any sample are dropped
+                rarefied_matrix = rarefied_matrix.loc[rarefied_matrix.count_nonzero(axis=1) > 0]
 
+            yield rarefied_matrix if is_sparse(data) else rarefied_matrix.to_dataframe()
 
     @staticmethod
-    def _rarefy_dataframe(dataframe, n, num_reps=1):
-        rarefied_df = dataframe.apply(Rarefaction._rarefy_series, n=n, num_reps=num_reps)
-        rarefied_df.fillna(0, inplace=True, downcast='infer')
-        return rarefied_df
+    def _rarefy_dataframe(dataframe, n, num_reps=1, replace=True, seed=None, n_jobs=1, executor=None):
+        with closing(Rarefaction._rarefied_data(dataframe, [(n, num_reps, seed)], replace, n_jobs, executor)) as rarefied:
+            return next(rarefied)
 
 
     def __dapply__(self, experiment):
         n = self.n
         num_reps = self.num_reps
         cutoff_df = experiment.dapply(experiment.Sample.count >= n)
-        rarefied_df = self._rarefy_dataframe(cutoff_df, n, num_reps)
+        rarefied_df = self._rarefy_dataframe(cutoff_df, n, num_reps, self.replace, self.seed, self.n_jobs, self.executor)
         return rarefied_df
 
 
@@ -103,20 +119,23 @@ class Rarefaction(Transform):
 
 
 class RarefactionFunction(Rarefaction):
-    def __init__(self, n, num_reps, func, axis=0, agg_rep=None):
-        Rarefaction.__init__(self, n, num_reps)
+    def __init__(self, n, num_reps, func, axis=0, agg_rep=None, replace=True, seed=None, n_jobs=1, executor=None):
+        Rarefaction.__init__(self, n, num_reps, replace, seed, n_jobs, executor)
         self.func = func
         self.axis = axis
         self.agg_rep = agg_rep
 
-    def rarefy_and_apply_func(self, dataframe):
+    def _draws(self, n, seed):
+        #one independent stream per repetition
+        return [(n, 1, rep_seed) for rep_seed in as_seed_sequence(seed).spawn(self.num_reps)]
 
+    def _apply_func(self, rarefied_dfs, n):
+        """The func of every repetition's rarefied data (rarefied to n), concatenated."""
         concated_df = None
 
-        for rep in range(0, self.num_reps):
-            rarefied_df = Rarefaction._rarefy_dataframe(dataframe, self.n, 1)
+        for rarefied_df in rarefied_dfs:
             func_applied = rarefied_df.apply(self.func, self.axis)
-            func_applied.name = self.n
+            func_applied.name = n
 
             concated_df = pd.concat([concated_df, func_applied], axis=1)#.fillna(0).mean(axis=1)
 
@@ -138,15 +157,21 @@ class RarefactionFunction(Rarefaction):
         else:
             return concated_df
 
+    def _aggregate(self, rarefied_df):
+        if self.agg_rep != None:
+            rarefied_df = rarefied_df.groupby(level='rarefaction').apply(self.agg_rep)
+        return rarefied_df
+
+    def rarefy_and_apply_func(self, dataframe):
+        draws = self._draws(self.n, self.seed)
+        rarefied_dfs = Rarefaction._rarefied_data(dataframe, draws, self.replace, self.n_jobs, self.executor)
+        return self._apply_func(rarefied_dfs, self.n)
+
 
     def __dapply__(self, experiment):
         cutoff_df = experiment.dapply(experiment.Sample.count >= self.n)
         rarefied_df = self.rarefy_and_apply_func(cutoff_df)
-
-        if self.agg_rep != None:
-            rarefied_df = rarefied_df.groupby(level='rarefaction').apply(self.agg_rep)
-
-        return rarefied_df
+        return self._aggregate(rarefied_df)
 
     def __eapply__(self, experiment):
         rarefied_df = self.__dapply__(experiment)
@@ -154,30 +179,38 @@ class RarefactionFunction(Rarefaction):
 
 
 class RarefactionCurveFunction(Transform):
-    def __init__(self, n, num_reps, step, func, axis=0, agg_rep=None):
+    def __init__(self, n, num_reps, step, func, axis=0, agg_rep=None, replace=True, seed=None, n_jobs=1, executor=None):
         self.n = n
         self.num_reps = num_reps
         self.step = step
         self.func = func
         self.axis = axis
         self.agg_rep = agg_rep
+        self.replace = replace
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.executor = executor
 
 
     def __dapply__(self, experiment):
-        cutoff_exp = experiment.apply(experiment.Sample.count >= self.n)
+        cutoff_df = experiment.dapply(experiment.Sample.count >= self.n)
 
+        levels = np.arange(0, self.n, self.step)
+        level_seeds = as_seed_sequence(self.seed).spawn(len(levels))
 
-        concated_df = None
+        RF = RarefactionFunction(n=self.n, num_reps=self.num_reps, func=self.func, axis=self.axis, agg_rep=self.agg_rep,
+                                 replace=self.replace)
 
-        for level in np.arange(0, self.n, self.step):
-            RF = RarefactionFunction(n=level, num_reps=self.num_reps, func=self.func, axis=self.axis, agg_rep=self.agg_rep)
-            rarefied_exp = cutoff_exp.apply(RF)
-            rarefied_df = rarefied_exp.data_df
-            concated_df = pd.concat([concated_df, rarefied_df], levels=['rarefaction', 'rep'])
-            del rarefied_exp
-            del rarefied_df
+        #the repetitions of every level, all drawn on the same pool
+        draws = [RF._draws(level, level_seed) for level, level_seed in zip(levels, level_seeds)]
+        rarefied_dfs = Rarefaction._rarefied_data(cutoff_df, [d for level_draws in draws for d in level_draws],
+                                                  self.replace, self.n_jobs, self.executor)
 
-        return concated_df
+        level_dfs = []
+        for level in levels:
+            level_dfs.append(RF._aggregate(RF._apply_func(islice(rarefied_dfs, self.num_reps), level)))
+
+        return pd.concat(level_dfs)
 
 
     def __eapply__(self, experiment):
@@ -187,22 +220,67 @@ class RarefactionCurveFunction(Transform):
 
 
 class RarefactionCurve(Transform):
-    def __init__(self, n, num_reps, step, transform_to_apply):
+    def __init__(self, n, num_reps, step, transform_to_apply, replace=None, seed=None, n_jobs=1, executor=None, incremental=False):
+        #incremental curves draw every depth as a nested subsample of the next
+        #one, in a single pass without replacement (n_jobs/executor are unused);
+        #replace defaults to True otherwise
+        if replace is None:
+            replace = not incremental
+        elif incremental and replace:
+            raise ValueError("incremental rarefaction curves draw without replacement; pass replace=False.")
+
         self.n = n
         self.num_reps = num_reps
         self.step = step
         self.transform_to_apply = transform_to_apply
+        self.replace = replace
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.incremental = incremental
+
+
+    def _transform_level(self, rarefied_exp, cutoff_level):
+        transformed_exp = rarefied_exp.apply(self.transform_to_apply)
+        transformed_df = transformed_exp.data_df
+        transformed_df.rename(index={self.transform_to_apply.name : cutoff_level}, inplace=True)
+        return transformed_df
+
+
+    def _incremental_levels(self, experiment):
+        counts_matrix = as_counts_matrix(experiment.data)
+        levels = np.arange(0, self.n, self.step)
+
+        for cutoff_level, sample_positions, level_matrix in rarefaction_curve_matrices(counts_matrix.matrix, levels, self.seed):
+            rarefied_data = CountsMatrix(level_matrix, counts_matrix.index, counts_matrix.columns.take(sample_positions))
+            if cutoff_level > 0:
+                rarefied_data = rarefied_data.loc[rarefied_data.count_nonzero(axis=1) > 0]
+            if not experiment.is_sparse:
+                rarefied_data = rarefied_data.to_dataframe()
+
+            yield cutoff_level, experiment.with_data_df(rarefied_data)
 
 
     def __dapply__(self, experiment):
         transformed_rarefied_dataframes = []
 
-        for cutoff_level in np.arange(0, self.n, self.step):
-            rarefied_exp = experiment.apply(Rarefaction(cutoff_level))
-            transformed_exp = rarefied_exp.apply(self.transform_to_apply)
-            transformed_df = transformed_exp.data_df
-            transformed_df.rename(index={self.transform_to_apply.name : cutoff_level}, inplace=True)
-            transformed_rarefied_dataframes.append(transformed_df)
+        if self.incremental:
+            for cutoff_level, rarefied_exp in self._incremental_levels(experiment):
+                transformed_rarefied_dataframes.append(self._transform_level(rarefied_exp, cutoff_level))
+
+            return pd.concat(transformed_rarefied_dataframes, axis=0)
+
+        levels = np.arange(0, self.n, self.step)
+        level_seeds = as_seed_sequence(self.seed).spawn(len(levels))
+
+        #every level rarefies the samples with enough counts for it (as Rarefaction does), all on the same pool
+        sample_sums = experiment.counts_stats.sample_sums.to_numpy()
+        draws = [(level, 1, level_seed, np.flatnonzero(sample_sums >= level)) for level, level_seed in zip(levels, level_seeds)]
+        rarefied_data = Rarefaction._rarefied_data(experiment.data, draws, self.replace, self.n_jobs, self.executor)
+
+        for cutoff_level, rarefied in zip(levels, rarefied_data):
+            rarefied_exp = experiment.with_data_df(rarefied)
+            transformed_rarefied_dataframes.append(self._transform_level(rarefied_exp, cutoff_level))
 
         rarefaction_curve_df = pd.concat(transformed_rarefied_dataframes, axis=0)
 
@@ -219,14 +297,20 @@ class Dereplicate(Transform):
 
 
 class DistanceMatrix(Transform):
-    def __init__(self, distance_metric):
+    def __init__(self, distance_metric, condensed=False, filepath=None, block_size=DISTANCE_BLOCK_SIZE, n_jobs=1, executor=None):
         self.distance_metric = distance_metric
+        self.condensed = condensed
+        self.filepath = filepath
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.executor = executor
 
     def __dapply__(self, experiment):
-        df = experiment.data_df.transpose()
-        dm = cdist(df, df, self.distance_metric)
-        distance_matrix_df = pd.DataFrame(dm, index=df.index, columns=df.index)
-        return distance_matrix_df
+        #any scipy cdist metric, computed in tiles (see distance.beta_distances)
+        distances = beta_distances(experiment.data, self.distance_metric, self.block_size, self.filepath, self.n_jobs, self.executor)
+        if self.condensed or self.filepath is not None:
+            return distances
+        return distances.to_dataframe()
 
     def __eapply__(self, experiment):
         distance_matrix_df = self.__dapply__(experiment)
@@ -2,9 +2,12 @@ from omicexperiment.transforms.transform import Transform
 
 
 class TSS(Transform):
+    column_wise = True
+
     @classmethod
     def __dapply__(cls, experiment):
-        rel_counts = experiment.data_df.apply(lambda c: c / c.sum() * 100, axis=0)
+        data = experiment.data
+        rel_counts = data.div(data.sum(), axis='columns').mul(100)
         return rel_counts
 
     @classmethod
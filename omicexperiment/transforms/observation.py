@@ -1,8 +1,9 @@
 import numpy as np
 from omicexperiment.transforms.transform import Transform
-from omicexperiment.transforms.general import Rarefaction
-from pandas import DataFrame, concat
-from collections import OrderedDict
+from omicexperiment.sparse import CountsMatrix, is_sparse
+from omicexperiment.rarefaction import as_seed_sequence
+from omicexperiment.util import hybridmethod, executor_for, map_tasks
+from pandas import DataFrame, Series
 
 def number_unique_obs(series):
     return (series > 0).sum()
@@ -10,7 +11,7 @@ def number_unique_obs(series):
 
 class ObservationSumCounts(Transform):
     def __dapply__(self, experiment):
-        return experiment.data_df.sum(axis=1).to_frame("sum_counts")
+        return experiment.counts_stats.observation_sums.to_frame("sum_counts")
     
     def __eapply__(self, experiment):
         sums_df = self.__dapply__(experiment)
@@ -26,8 +27,7 @@ class NumberUniqueObservations(Transform):
 
     @classmethod
     def __dapply__(cls, experiment):
-        transformed_series = (experiment.data_df > 0).sum().transpose()
-        transformed_series.name = cls.name
+        transformed_series = experiment.counts_stats.sample_presence.rename(cls.name)
         transposed_transformed_df = DataFrame(transformed_series).transpose()
         return transposed_transformed_df
 
@@ -46,7 +46,17 @@ class ClusterObservations(Transform):
     def clusters_df_dict(self):
         return self.clusters_df.to_dict()['cluster']
     
+    def _cluster_keys(self, observations):
+        #observations without a cluster keep their own name (as with DataFrame.rename)
+        clusters = observations.map(self.clusters_df_dict())
+        keys = np.where(clusters.isnull(), observations, clusters)
+        return Series(keys, name='cluster')
+
     def __dapply__(self, experiment):
+        data = experiment.data
+        if is_sparse(data) and self.aggfunc in (np.sum, sum, 'sum'):
+            return data.groupby_sum(self._cluster_keys(data.index))
+
         #rename the observations according to their clusters
         new_data_df = experiment.data_df.rename(index=self.clusters_df_dict())
         
@@ -75,73 +85,100 @@ class BinObservations(ClusterObservations):
         ClusterObservations.__init__(self, clusters_df, aggfunc)
 
 
+def _af_threshold_task(task):
+    counts, num_reps, seed_sequence = task
+    return AbundanceFilteringWangEtAl.calculate_af_threshold(counts, num_reps, np.random.default_rng(seed_sequence))
+
+
 class AbundanceFilteringWangEtAl(ClusterObservations):
-    
+    num_reps = 1000
+    seed = None
+    n_jobs = 1
+    executor = None
+
+    def __init__(self, num_reps=1000, seed=None, n_jobs=1, executor=None):
+        self.num_reps = num_reps
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.executor = executor
+
     @staticmethod
-    def _bootstrap_series_concatenate(series, num_reps=1):
-        series_sum = series.sum()
-        
-        rarefy = Rarefaction._rarefy_series
-        
-        series_list = [rarefy(series, series_sum, num_reps=1) 
-                    for i in range(num_reps)]
-        
-        return concat(series_list, axis=1).fillna(0)
+    def _bootstrap_counts(counts, num_reps=1, rng=None):
+        #all num_reps bootstrap replicates of the sample's reads in one (num_reps x observations) draw
+        rng = np.random.default_rng(rng)
+        counts = np.asarray(counts, dtype=np.float64)
+        total = counts.sum()
+        return rng.multinomial(int(total), counts / total, size=num_reps)
 
     @staticmethod
-    def calculate_af_threshold(counts_series, num_reps=1000):
-        series = counts_series.sort_values(ascending=False)
+    def calculate_af_threshold(counts_series, num_reps=1000, rng=None):
+        counts = np.asarray(counts_series, dtype=np.float64)
+        #observations absent from the sample are never drawn and never kept
+        counts = counts[counts > 0]
 
-        bootstrap_df = AbundanceFilteringWangEtAl._bootstrap_series_concatenate(series, num_reps)
-        bootstrap_df_transposed = bootstrap_df.transpose()
+        if len(counts) == 0:
+            return 0
 
-        abund_real = series
+        bootstrap = AbundanceFilteringWangEtAl._bootstrap_counts(counts, num_reps, rng)
 
-        abund_boot = bootstrap_df_transposed.mean().sort_values(ascending=False)
-        abund_995 = bootstrap_df_transposed.quantile(0.995)
-        abund_005 = bootstrap_df_transposed.quantile(0.005)
+        abund_real = counts
+
+        abund_boot = bootstrap.mean(axis=0)
+        abund_005 = np.quantile(bootstrap, 0.005, axis=0)
 
         abund_adj = (2 * abund_real) - abund_boot
-        abund_adj = abund_adj.sort_values(ascending=False).fillna(0)
-        
-        ci99_higher = abund_adj + (abund_995 - abund_boot)
-        ci99_higher = ci99_higher.sort_values(ascending=False).fillna(0)
 
         ci99_lower = abund_adj - (abund_boot - abund_005)
-        ci99_lower = ci99_lower.sort_values(ascending=False)
-        
-        unreliable = ci99_lower[ci99_lower <= 0].index
-        
-        if unreliable.shape[0] > 0:
-            threshold = int(series[unreliable].max())
+
+        unreliable = ci99_lower <= 0
+
+        if unreliable.any():
+            threshold = int(counts[unreliable].max())
         else:
             threshold = 0
-            
+
         return threshold
-    
+
     @staticmethod
-    def abundance_filter_dataframe(counts_df, num_reps=1000):
-        
-        calculate_threshold = AbundanceFilteringWangEtAl.calculate_af_threshold
-        
-        new_df_dict = OrderedDict()
-    
-        for col in counts_df.columns:
-            counts_column = counts_df[col]
-            threshold = calculate_threshold(counts_column, num_reps)
-            sequences_to_keep = counts_df[counts_column > threshold].index
-            new_df_dict[col] = counts_column.reindex(sequences_to_keep)
-            
-        return DataFrame.from_dict(new_df_dict).fillna(0)
-    
-    @classmethod
-    def __dapply__(cls, experiment):
+    def abundance_filter_counts_matrix(counts_matrix, num_reps=1000, seed=None, n_jobs=1, executor=None):
+
+        matrix = counts_matrix.matrix.copy()
+        indptr = matrix.indptr
+        num_samples = matrix.shape[1]
+
+        #each sample bootstraps from its own stream, so thresholds for a
+        #given seed do not depend on how the samples are spread over workers
+        sample_seeds = as_seed_sequence(seed).spawn(num_samples)
+        tasks = [(matrix.data[indptr[j]:indptr[j+1]], num_reps, sample_seeds[j])
+                 for j in range(num_samples)]
+
+        with executor_for(n_jobs, executor) as pool:
+            thresholds = map_tasks(_af_threshold_task, tasks, pool)
+
+        entry_thresholds = np.repeat(np.asarray(thresholds, dtype=np.float64), np.diff(indptr))
+        matrix.data = np.where(matrix.data > entry_thresholds, matrix.data, 0)
+
+        filtered = CountsMatrix(matrix, counts_matrix.index, counts_matrix.columns)
+        return filtered.loc[filtered.count_nonzero(axis=1) > 0]
+
+    @staticmethod
+    def abundance_filter_dataframe(counts_df, num_reps=1000, seed=None, n_jobs=1, executor=None):
+
+        if is_sparse(counts_df):
+            return AbundanceFilteringWangEtAl.abundance_filter_counts_matrix(counts_df, num_reps, seed, n_jobs, executor)
+
+        counts_matrix = CountsMatrix.from_dataframe(counts_df)
+        filtered = AbundanceFilteringWangEtAl.abundance_filter_counts_matrix(counts_matrix, num_reps, seed, n_jobs, executor)
+        return filtered.to_dataframe()
+
+    @hybridmethod
+    def __dapply__(self, experiment):
         counts_df = experiment.data
-        return AbundanceFilteringWangEtAl.abundance_filter_dataframe(counts_df)
-     
-    @classmethod
-    def __eapply__(cls, experiment):
-        filtered_df = cls.__dapply__(experiment)
+        return AbundanceFilteringWangEtAl.abundance_filter_dataframe(counts_df, self.num_reps, self.seed, self.n_jobs, self.executor)
+
+    @hybridmethod
+    def __eapply__(self, experiment):
+        filtered_df = self.__dapply__(experiment)
         return experiment.with_data_df(filtered_df)
 
 
@@ -150,11 +187,12 @@ class AbundancePrevalenceStatistics(Transform):
         self.absence_presence_cutoff = absence_presence_cutoff
     
     def __dapply__(self, experiment):
-        rel_abund_df = experiment.counts_df.sum(axis=1).sort_values(ascending=False).to_frame(name="mean_relative_abundance")
+        data = experiment.data
+        rel_abund_df = experiment.counts_stats.observation_sums.sort_values(ascending=False).to_frame(name="mean_relative_abundance")
         rel_abund_df = rel_abund_df.apply(lambda c: c / c.sum() * 100, axis=0)
         
         absence_presence_cutoff = self.absence_presence_cutoff
-        prev_df = (experiment.counts_df >= absence_presence_cutoff).astype(int).apply(lambda c: c.sum() / c.count() * 100, axis=1).sort_values(ascending=False).to_frame("prevalence")
+        prev_df = ((data >= absence_presence_cutoff).sum(axis=1) / len(data.columns) * 100).sort_values(ascending=False).to_frame("prevalence")
         
         abund_prev_df = rel_abund_df.join(prev_df)
         
@@ -196,7 +234,7 @@ class TopAbundantObservations(Transform):
 
     def __dapply__(self, experiment):
         top_taxa = TopAbundantObservations.top_abundant_taxa(experiment, self.n)
-        other_taxa = list(experiment.data_df.index.difference(top_taxa))
+        other_taxa = list(experiment.data.index.difference(top_taxa))
         
         experiment_other = experiment.apply(BinObservations(other_taxa, groupnames='Other'))
         
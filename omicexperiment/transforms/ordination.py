@@ -1,17 +1,41 @@
 from skbio.stats.ordination import pcoa
 from omicexperiment.transforms.transform import Transform
+from omicexperiment.ordination import approximate_pcoa
 
 from omicexperiment.util import hybridmethod
 
 
 class PCoA(Transform):
+    """Principal coordinates of a distance matrix experiment.
+
+    By default (method='eigh') by skbio's pcoa, a full eigendecomposition.
+    method='randomized' or 'eigsh' computes the first dimensions axes only
+    (10 by default), without forming the centred matrix, and works on
+    CondensedDistances (e.g. memory-mapped) without squaring them; see
+    omicexperiment.ordination.approximate_pcoa.
+    """
+    method = 'eigh'
+    dimensions = None
+    seed = None
+
+    def __init__(self, method='eigh', dimensions=None, seed=None, **kwargs):
+        self.method = method
+        self.dimensions = dimensions
+        self.seed = seed
+        self.kwargs = kwargs
+
     @hybridmethod
     def __eapply__(self, experiment):
-        dm = experiment.data_df
-        pcoa_results = pcoa(dm)
+        if self.method == 'eigh':
+            dm = experiment.data_df
+            pcoa_results = pcoa(dm) if self.dimensions is None else pcoa(dm, dimensions=self.dimensions)
+        else:
+            dm = experiment.data
+            pcoa_results = approximate_pcoa(dm, 10 if self.dimensions is None else self.dimensions,
+                                            self.method, seed=self.seed, **self.kwargs)
         pcoa_df = pcoa_results.samples
         pcoa_df.index = dm.index #sample names
         pcoa_df = pcoa_df.transpose()
         pcoa_exp = experiment.with_data_df(pcoa_df)
         pcoa_exp.metadata['pcoa'] = pcoa_results
-        return pcoa_exp
\ No newline at end of file
+        return pcoa_exp
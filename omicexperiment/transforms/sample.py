@@ -1,5 +1,6 @@
 import numpy as np
 from omicexperiment.transforms.transform import TransformObjectsProxy, Transform, ProxiedTransformMixin
+from omicexperiment.sparse import is_sparse
 
 
 class KeepSamples(Transform, ProxiedTransformMixin):
@@ -7,8 +8,8 @@ class KeepSamples(Transform, ProxiedTransformMixin):
         self.sample_names = list(sample_names)
     
     def __dapply__(self, experiment):
-        to_keep = experiment.data_df.columns.intersection(self.sample_names)
-        return experiment.data_df.reindex(columns=to_keep)
+        to_keep = experiment.data.columns.intersection(self.sample_names)
+        return experiment.data.reindex(columns=to_keep)
 
     def __eapply__(self, experiment):
         kept_samples_df = self.__dapply__(experiment)
@@ -21,7 +22,7 @@ class ExcludeSamples(Transform):
         self.errors = errors
     
     def __dapply__(self, experiment):
-        return experiment.data_df.drop(self.sample_names, axis=1, errors=self.errors)
+        return experiment.data.drop(self.sample_names, axis=1, errors=self.errors)
 
     def __eapply__(self, experiment):
         after_exc = self.__dapply__(experiment)
@@ -70,7 +71,23 @@ class SampleGroupBy(Transform):
         df_groupby_obj = joined_df.groupby(self.variable)
         return df_groupby_obj
     
+    def _sparse_groupby(self, experiment):
+        #sums and means of sample groups are computed on the sparse matrix directly
+        data = experiment.data
+        keys = experiment.mapping_df[self.variable].reindex(data.columns)
+        summed = data.groupby_sum(keys, axis=1)
+
+        if self.aggfunc in (np.mean, 'mean'):
+            group_sizes = keys.value_counts().reindex(summed.columns)
+            return summed.div(group_sizes, axis='columns')
+        return summed
+
     def __dapply__(self, experiment):
+        if is_sparse(experiment.data) \
+        and self.variable is not _index \
+        and self.aggfunc in (np.sum, np.mean, 'sum', 'mean'):
+            return self._sparse_groupby(experiment)
+
         agg_df = self.groupby(experiment).apply(self.aggfunc)
         try:
             agg_df.drop(self.variable, axis=1, inplace=True)
@@ -86,7 +103,7 @@ class SampleGroupBy(Transform):
 
 class SampleSumCounts(Transform):
     def __dapply__(self, experiment):
-        return experiment.data_df.sum().to_frame("obs_count").transpose()
+        return experiment.counts_stats.sample_sums.to_frame("obs_count").transpose()
     
     def __eapply__(self, experiment):
         sums_df = self.__dapply__(experiment)
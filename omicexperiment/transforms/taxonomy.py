@@ -1,11 +1,14 @@
 import numpy as np
+import pandas as pd
 from omicexperiment.transforms.transform import TransformObjectsProxy, Transform, GroupByTransform
 from omicexperiment.taxonomy import tax_as_dataframe
+from omicexperiment.sparse import CountsMatrix, is_sparse, group_indicator
 
 
 class TaxonomyGroupBy(GroupByTransform):
     TAX_RANKS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
     TAXONOMY_DATAFRAME_COLUMNS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'rank_resolution', 'tax', 'taxhash', 'otu']
+    column_wise = True
 
     def __init__(self, rank, collapse=True):
         self.rank = rank
@@ -38,27 +41,20 @@ class TaxonomyGroupBy(GroupByTransform):
     
     
     def __dapply__(self, experiment):
-        rank = self.rank
-        taxlevels_to_rank = TaxonomyGroupBy.tax_rank_levels(rank)
+        rank = 'class' if self.rank == 'class_' else self.rank
+        data = experiment.data
 
-        df = experiment._counts_with_tax()
-        df = df.set_index(TaxonomyGroupBy.TAXONOMY_DATAFRAME_COLUMNS)
+        #collapse: group on the rank's taxa; otherwise on the whole lineage,
+        #labelling each group with its rank only
+        codes, taxa = experiment.taxonomy_rank_index.group_codes(rank, data.index, lineage=not self.collapse)
 
-        #groupby_df
-        groupby_df = df.groupby(taxlevels_to_rank).sum()
-        
-        #drop extra levels (now columns)
-        current_index_levels = [l.name for l in groupby_df.index.levels]
-        levels_to_drop = [rnk for rnk in current_index_levels if rnk != rank]
-        groupby_df.reset_index(level=levels_to_drop, drop=True, inplace=True)
-        
-        #further collapse similarly named ranks (e.g. "k__unidentified (Unassigned)")
-        if self.collapse:
-            groupby_df = groupby_df.groupby(rank).sum()
-        else:
-            groupby_df.set_index(rank, drop=True, inplace=True)
+        if is_sparse(data):
+            indicator = group_indicator(codes, len(taxa), data.dtype)
+            return CountsMatrix(indicator @ data.matrix, taxa, data.columns)
 
-        return groupby_df
+        values = data.fillna(0).values
+        indicator = group_indicator(codes, len(taxa), values.dtype)
+        return pd.DataFrame(indicator @ values, index=taxa, columns=data.columns)
 
     def __eapply__(self, experiment):
         groupby_df = self.__dapply__(experiment)
@@ -81,9 +77,9 @@ class AssignTaxonomy(Transform):
 class RemoveUnassigned(Transform):
     @classmethod
     def __dapply__(cls, experiment):
-        unassigned_filter = experiment.data_df.index.str.lower().str.contains('unassigned')
-        to_remove = experiment.data_df[unassigned_filter].index
-        return experiment.data_df.drop(to_remove)
+        data = experiment.data
+        unassigned_filter = data.index.str.lower().str.contains('unassigned')
+        return data.loc[~unassigned_filter]
 
     @classmethod
     def __eapply__(cls, experiment):
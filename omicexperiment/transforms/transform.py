@@ -1,3 +1,7 @@
+import numpy as np
+import pandas as pd
+
+
 
 
 class ProxiedTransformMixin(object):
@@ -20,6 +24,14 @@ class TransformObjectsProxy(object):
     
     
 class Transform(object):
+    #column_wise transforms compute every sample from that sample's counts
+    #alone, so filtering samples before or after them gives the same result
+    column_wise = False
+    #block_wise transforms can also run on blocks of samples separately,
+    #the results being joined side by side (see ChunkedExperiment),
+    #though not necessarily sample by sample; column_wise implies it
+    block_wise = False
+
     def __dapply__(self, experiment):
         return NotImplementedError
 
@@ -41,9 +53,33 @@ class Transform(object):
 
 
 class Filter(Transform):
+    #filters that can express their criteria as a boolean mask over a single
+    #axis ('index' for observations, 'columns' for samples) implement _criteria,
+    #which lets them be fused with neighbouring filters (see FusedFilter).
+    #data_dependent: the criteria are computed from the counts (not only from metadata)
+    #per_label: the criteria of a label only depend on that label's own counts
+    #filters combine with &, | and ~ (see FilterExpression)
+    axis = None
+    data_dependent = True
+    per_label = False
+
     def __init__(self, operator=None, value=None):
         self.operator = operator
         self.value = value
+
+    def _criteria(self, experiment, data):
+        raise NotImplementedError
+
+    def _fusable(self):
+        return self.axis is not None and type(self)._criteria is not Filter._criteria
+
+    def _select(self, data, criteria):
+        if criteria is None:
+            return None
+        elif self.axis == 'columns':
+            return data.reindex(columns=criteria.index[criteria])
+        else:
+            return data.loc[criteria]
     
     def __get__(self, instance, owner):
         return self
@@ -67,10 +103,41 @@ class Filter(Transform):
     def __ge__(self, other):
         return self.__class__('__ge__', other)
 
+    def __and__(self, other):
+        if isinstance(other, FusedFilter):
+            return FusedFilter([self, other])
+        elif not isinstance(other, Filter):
+            return NotImplemented
+        elif self.axis != other.axis:
+            #criteria on samples and on observations: both selections apply
+            return FusedFilter([self, other])
+        return FilterExpression('__and__', [self, other])
+
+    def __or__(self, other):
+        if not isinstance(other, Filter):
+            return NotImplemented
+        return FilterExpression('__or__', [self, other])
+
+    def __invert__(self):
+        return FilterExpression('__invert__', [self])
+
     def __dapply__(self, experiment_obj):
         return NotImplementedError
 
     def __eapply__(self, experiment):
+        if self._fusable():
+            data = experiment.data
+            criteria = self._criteria(experiment, data)
+            labels = data.index if self.axis == 'index' else data.columns
+            if criteria is None or not criteria.index.equals(labels):
+                return experiment.with_data_df(self._select(data, criteria))
+
+            #a selection in the order of the data, which keeps its statistics
+            masks = {'index': np.ones(len(data.index), dtype=bool),
+                     'columns': np.ones(len(data.columns), dtype=bool)}
+            masks[self.axis] = FusedFilter._mask(criteria, labels)
+            return _filtered_experiment(experiment, data, masks)
+
         filtered_df = self.__class__.__dapply__(self, experiment)
         return experiment.with_data_df(filtered_df)
 
@@ -80,6 +147,158 @@ class Filter(Transform):
         return full_repr
 
 
+def _take(data, rows, columns):
+    if hasattr(data, 'iloc'):
+        return data.iloc[rows, columns]
+    return data.take(rows, columns)
+
+
+def _take_masks(data, masks):
+    if masks['index'].all() and masks['columns'].all():
+        return data
+    return _take(data, np.flatnonzero(masks['index']), np.flatnonzero(masks['columns']))
+
+
+def _filtered_experiment(experiment, data, masks):
+    """experiment with the rows and columns of data selected by masks.
+
+    When data is the experiment's counts table and its statistics have
+    been computed, the statistics of the result are derived from them
+    (see CountsStatistics.take).
+    """
+    new_exp = experiment.with_data_df(_take_masks(data, masks))
+    if data is experiment.data and experiment._counts_stats is not None:
+        new_exp._counts_stats = experiment._counts_stats.take(new_exp.data, masks['index'], masks['columns'])
+    return new_exp
+
+
+class FusedFilter(Transform):
+    """A sequence of filters evaluated as boolean masks and applied in one selection.
+
+    The result is that of applying the filters one after the other, except
+    that the samples and observations kept stay in the order of the data.
+    Intermediate tables are only built when a filter depends on counts
+    already removed by the filters before it.
+    """
+    def __init__(self, filters):
+        self.filters = []
+        for f in filters:
+            self.filters.extend(f.filters if isinstance(f, FusedFilter) else [f])
+
+    @staticmethod
+    def _mask(criteria, labels):
+        if not criteria.index.equals(labels):
+            criteria = criteria.reindex(labels)
+        return np.asarray(criteria.fillna(False), dtype=bool)
+
+    def _masks(self, experiment):
+        """(data, masks): the table to select from (the experiment's, unless a filter needed an intermediate one) and the masks of its rows and columns."""
+        data = experiment.data
+        masks = {'index': np.ones(len(data.index), dtype=bool),
+                 'columns': np.ones(len(data.columns), dtype=bool)}
+
+        for f in self.filters:
+            other_axis = 'columns' if f.axis == 'index' else 'index'
+            depends_on_removed = f.data_dependent \
+                                 and not (masks['index'].all() and masks['columns'].all()) \
+                                 and not (f.per_label and masks[other_axis].all())
+
+            if depends_on_removed:
+                data = _take(data, np.flatnonzero(masks['index']), np.flatnonzero(masks['columns']))
+                masks = {'index': np.ones(len(data.index), dtype=bool),
+                         'columns': np.ones(len(data.columns), dtype=bool)}
+
+            criteria = f._criteria(experiment, data)
+            if criteria is None:
+                raise NotImplementedError("{} does not support operator {}".format(f.__class__.__name__, f.operator))
+
+            labels = data.index if f.axis == 'index' else data.columns
+            masks[f.axis] &= self._mask(criteria, labels)
+
+        return data, masks
+
+    def __dapply__(self, experiment):
+        return _take_masks(*self._masks(experiment))
+
+    def __eapply__(self, experiment):
+        data, masks = self._masks(experiment)
+        return _filtered_experiment(experiment, data, masks)
+
+    def __and__(self, other):
+        if not isinstance(other, (Filter, FusedFilter)):
+            return NotImplemented
+        return FusedFilter([self, other])
+
+    def __or__(self, other):
+        if not isinstance(other, (Filter, FusedFilter)):
+            return NotImplemented
+        raise ValueError("__or__ cannot combine a FusedFilter (filters applied one after the other) with other filters")
+
+    __ror__ = __or__
+
+    def __invert__(self):
+        raise ValueError("__invert__ cannot negate a FusedFilter (filters applied one after the other)")
+
+    def __repr__(self):
+        base_repr = object.__repr__(self)[1:-1]
+        return "<{} - filters:{};>".format(base_repr, self.filters)
+
+
+class FilterExpression(Filter):
+    """Filters on the same axis combined with & (__and__), | (__or__) or ~ (__invert__).
+
+    The criteria of every filter are evaluated on the same table and
+    combined as boolean masks, the data being selected from once. Labels
+    a filter gives no criteria for (e.g. samples missing from mapping_df)
+    count as not matching it.
+    """
+    def __init__(self, operator, filters):
+        axes = set(f.axis for f in filters)
+        if len(axes) > 1:
+            raise ValueError("{} cannot combine filters on samples and on observations".format(operator))
+
+        self.operator = operator
+        self.value = None
+        self.filters = []
+        for f in filters:
+            #a & (b & c) is a & b & c
+            nested = isinstance(f, FilterExpression) and f.operator == operator and operator != '__invert__'
+            self.filters.extend(f.filters if nested else [f])
+
+        self.axis = axes.pop()
+        self.data_dependent = any(f.data_dependent for f in self.filters)
+        self.per_label = all(f.per_label for f in self.filters)
+
+    def _fusable(self):
+        return all(f._fusable() for f in self.filters)
+
+    def _criteria(self, experiment, data):
+        labels = data.index if self.axis == 'index' else data.columns
+
+        masks = []
+        for f in self.filters:
+            criteria = f._criteria(experiment, data)
+            if criteria is None:
+                return None
+            masks.append(FusedFilter._mask(criteria, labels))
+
+        if self.operator == '__invert__':
+            mask = ~masks[0]
+        elif self.operator == '__and__':
+            mask = np.logical_and.reduce(masks)
+        else:
+            mask = np.logical_or.reduce(masks)
+
+        return pd.Series(mask, index=labels)
+
+    def __dapply__(self, experiment):
+        return FusedFilter([self]).__dapply__(experiment)
+
+    def __repr__(self):
+        base_repr = object.__repr__(self)[1:-1]
+        return "<{} - operator:{}; filters:{};>".format(base_repr, self.operator, self.filters)
+
+
 class AttributeFilter(Filter):
     def __init__(self, operator=None, value=None, attribute=None):
         Filter.__init__(self, operator, value)
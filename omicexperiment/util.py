@@ -1,4 +1,9 @@
+import os
 import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
 
@@ -11,30 +16,148 @@ def parse_fasta_labels(fasta_filepath):
                 yield desc
 
 
+#size of the blocks read from sequence files
+READ_BUFFER_SIZE = 1 << 22
+
+#number of records per batch yielded by iter_fasta_batches/iter_fastq_batches
+RECORD_BATCH_SIZE = 100000
+
+
+def _iter_blocks(filepath, buffer_size=READ_BUFFER_SIZE):
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(buffer_size)
+            if not block:
+                break
+            yield block
+
+
+def _fasta_columns(records):
+    split_records = [record.partition(b'\n') for record in records]
+    descriptions = [header.rstrip() for header, _, _ in split_records]
+    sequences = [b''.join(sequence.split()) for _, _, sequence in split_records]
+    return descriptions, sequences
+
+
+def _iter_fasta_chunks(fasta_filepath, buffer_size=READ_BUFFER_SIZE):
+    #a leading newline makes the first header a record boundary like the others;
+    #whatever comes before it is not a record
+    remainder = b'\n'
+    preamble = True
+
+    for block in _iter_blocks(fasta_filepath, buffer_size):
+        records = (remainder + block).split(b'\n>')
+        remainder = records.pop()
+
+        if preamble and len(records) > 0:
+            records = records[1:]
+            preamble = False
+
+        yield _fasta_columns(records)
+
+    if not preamble and remainder.strip():
+        yield _fasta_columns([remainder])
+
+
+def _fastq_columns(lines):
+    #every fourth line from the first is a header, and so on; the checks and
+    #the removal of the '@' run on the joined lines rather than line by line
+    headers, sequences, pluses, quals = (lines[i::4] for i in range(4))
+    joined_headers = b'\n' + b'\n'.join(headers)
+    joined_pluses = b'\n' + b'\n'.join(pluses)
+
+    if joined_headers.count(b'\n@') != len(headers) \
+    or joined_pluses.count(b'\n+') != len(pluses):
+        raise ValueError("Malformed FASTQ record in: {!r}".format(joined_headers[:80]))
+
+    descriptions = joined_headers[2:].split(b'\n@') if len(headers) > 0 else []
+
+    if b'\r' in joined_headers or b'\r' in joined_pluses:
+        descriptions = [d.strip() for d in descriptions]
+        sequences = [s.strip() for s in sequences]
+        quals = [q.strip() for q in quals]
+
+    return descriptions, sequences, quals
+
+
+def _iter_fastq_chunks(fastq_filepath, buffer_size=READ_BUFFER_SIZE):
+    remainder = b''
+
+    for block in _iter_blocks(fastq_filepath, buffer_size):
+        lines = (remainder + block).split(b'\n')
+        complete = (len(lines) - 1) // 4 * 4
+        remainder = b'\n'.join(lines[complete:])
+
+        yield _fastq_columns(lines[:complete])
+
+    lines = remainder.rstrip().split(b'\n') if remainder.strip() else []
+    if len(lines) % 4 != 0:
+        raise ValueError("Truncated FASTQ record at the end of {}".format(fastq_filepath))
+
+    yield _fastq_columns(lines)
+
+
+def iter_fasta_records(fasta_filepath, buffer_size=READ_BUFFER_SIZE):
+    """Yield the (description, sequence) of every FASTA record, as bytes.
+
+    The file is read in blocks of buffer_size bytes and split on record
+    boundaries, so multi-line sequences are joined once per record.
+    """
+    for chunk in _iter_fasta_chunks(fasta_filepath, buffer_size):
+        for record in zip(*chunk):
+            yield record
+
+
+def iter_fastq_records(fastq_filepath, buffer_size=READ_BUFFER_SIZE):
+    """Yield the (description, sequence, quality) of every four-line FASTQ record, as bytes."""
+    for chunk in _iter_fastq_chunks(fastq_filepath, buffer_size):
+        for record in zip(*chunk):
+            yield record
+
+
+def _record_batch(columns, values_lists, decode):
+    batch_dict = OrderedDict()
+    for column, values in zip(columns, values_lists):
+        if decode:
+            values = [v.decode('utf-8') for v in values]
+        batch_dict[column] = np.array(values, dtype=object)
+    return pd.DataFrame(batch_dict, columns=columns)
+
+
+def _iter_record_batches(chunks, columns, batch_size, decode):
+    pending = [[] for c in columns]
+
+    for chunk in chunks:
+        for pending_values, values in zip(pending, chunk):
+            pending_values.extend(values)
+
+        while len(pending[0]) >= batch_size:
+            yield _record_batch(columns, [p[:batch_size] for p in pending], decode)
+            pending = [p[batch_size:] for p in pending]
+
+    if len(pending[0]) > 0:
+        yield _record_batch(columns, pending, decode)
+
+
+def iter_fasta_batches(fasta_filepath, batch_size=RECORD_BATCH_SIZE, decode=True, buffer_size=READ_BUFFER_SIZE):
+    """Yield DataFrames (description, sequence) of up to batch_size FASTA records each.
+
+    With decode=False the values are left as bytes, which is all hashing
+    and counting need.
+    """
+    chunks = _iter_fasta_chunks(fasta_filepath, buffer_size)
+    return _iter_record_batches(chunks, ['description', 'sequence'], batch_size, decode)
+
+
+def iter_fastq_batches(fastq_filepath, batch_size=RECORD_BATCH_SIZE, decode=True, buffer_size=READ_BUFFER_SIZE):
+    """Yield DataFrames (description, sequence, qual) of up to batch_size FASTQ records each."""
+    chunks = _iter_fastq_chunks(fastq_filepath, buffer_size)
+    return _iter_record_batches(chunks, ['description', 'sequence', 'qual'], batch_size, decode)
+
+
 def parse_fasta(fasta_filepath):
-    
-    def _parse_fasta(fasta):
-        with open(fasta) as f:
-            seq = ""
-            desc = ""
-
-            for l in f:
-                l = l.strip()
-                if l.startswith(">"):
-                    yield desc, seq
-                    desc = l[1:]
-                    seq = ""
-                    continue
-                else:
-                    seq = seq + l
-                    continue
-            
-            yield desc, seq
-
-    iter_fasta = iter(_parse_fasta(fasta_filepath))
-    next(iter_fasta)
-    for desc, seq in iter_fasta:
-        yield desc, seq
+    for desc, seq in iter_fasta_records(fasta_filepath):
+        yield desc.decode('utf-8'), seq.decode('utf-8')
 
 
 def parse_fasta_relabel(fasta_filepath, relabel_fn=lambda x:x):
@@ -43,20 +166,8 @@ def parse_fasta_relabel(fasta_filepath, relabel_fn=lambda x:x):
 
 
 def parse_fastq(fastq_filepath):
-    with open(fastq_filepath) as f:
-        seq = ""
-        desc = ""
-        qual = ""
-        
-        for l in f:
-            if l.startswith("@"):
-                desc = l[1:].strip()
-                seq = f.readline().strip()
-                plus = f.readline()
-                qual = f.readline().strip()
-                yield desc, seq, qual
-            else:
-                raise
+    for desc, seq, qual in iter_fastq_records(fastq_filepath):
+        yield desc.decode('utf-8'), seq.decode('utf-8'), qual.decode('utf-8')
         
 
 def find_sequence_by_label(fasta_filepaths, label):
@@ -107,10 +218,110 @@ def counts_df_to_repset_fasta(fasta_counts_df, output_fasta, sizes_out=False):
                 f.write(seq + "\n")
                 
 
+class Sha1Cache(object):
+    """A sequence -> sha1 digest cache, optionally persisted to an .npz file.
+
+    Lookups are done for whole batches of sequences at once, through a
+    pandas Index of the cached sequences. Sequences are kept as bytes and
+    digests as 20-byte binary values. The cache is loaded from filepath
+    (if it exists) and only written by save().
+    """
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self._index = pd.Index([], dtype=object)
+        self._digests = np.empty(0, dtype=object)
+
+        if filepath is not None and os.path.exists(filepath):
+            self.load(filepath)
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, sequences):
+        """Return the cached digests of sequences (None if missing) and a found mask."""
+        digests = np.empty(len(sequences), dtype=object)
+        if len(self._index) == 0:
+            return digests, np.zeros(len(sequences), dtype=bool)
+
+        positions = self._index.get_indexer(pd.Index(sequences, dtype=object))
+        found = positions >= 0
+        digests[found] = self._digests[positions[found]]
+        return digests, found
+
+    def update(self, sequences, digests):
+        if len(sequences) == 0:
+            return
+        self._index = self._index.append(pd.Index(sequences, dtype=object))
+        self._digests = np.concatenate([self._digests, np.asarray(digests, dtype=object)])
+
+    def load(self, filepath):
+        with np.load(filepath) as npz:
+            buffer = npz['sequences'].tobytes()
+            offsets = npz['offsets']
+            digest_buffer = npz['digests'].tobytes()
+
+        sequences = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        digests = [digest_buffer[i:i+20] for i in range(0, len(digest_buffer), 20)]
+
+        self._index = pd.Index(sequences, dtype=object)
+        self._digests = np.asarray(digests, dtype=object)
+
+    def save(self, filepath=None):
+        filepath = self.filepath if filepath is None else filepath
+        sequences = list(self._index)
+        offsets = np.concatenate([[0], np.cumsum([len(s) for s in sequences], dtype=np.int64)])
+
+        with open(filepath, 'wb') as f:
+            np.savez(f,
+                     sequences=np.frombuffer(b''.join(sequences), dtype=np.uint8),
+                     offsets=offsets,
+                     digests=np.frombuffer(b''.join(self._digests), dtype=np.uint8))
+
+
+def _sha1_batch(sequences):
+    return [hashlib.sha1(seq).digest() for seq in sequences]
+
+
+def sha1_digests(sequences, binary=False, n_threads=1, cache=None):
+    """The sha1 digest of every sequence (str or bytes), as an object array.
+
+    Each distinct sequence is hashed once, over n_threads threads, and
+    only if it is not in cache (a Sha1Cache, which is updated with the new
+    digests). Digests are hex strings, or 20-byte values with binary=True.
+    """
+    codes, unique_sequences = pd.factorize(np.asarray(sequences, dtype=object))
+    unique_sequences = [seq.encode('utf-8') if isinstance(seq, str) else seq for seq in unique_sequences]
+
+    if cache is not None:
+        digests, found = cache.lookup(unique_sequences)
+    else:
+        digests, found = np.empty(len(unique_sequences), dtype=object), np.zeros(len(unique_sequences), dtype=bool)
+
+    missing = np.flatnonzero(~found)
+    to_hash = [unique_sequences[i] for i in missing]
+
+    if n_threads is None or n_threads == 1 or len(to_hash) == 0:
+        hashed = _sha1_batch(to_hash)
+    else:
+        chunk_size = -(-len(to_hash) // n_threads)
+        chunks = [to_hash[i:i+chunk_size] for i in range(0, len(to_hash), chunk_size)]
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            hashed = [digest for chunk_digests in pool.map(_sha1_batch, chunks) for digest in chunk_digests]
+
+    digests[missing] = hashed
+    if cache is not None:
+        cache.update(to_hash, hashed)
+
+    if not binary:
+        digests = np.asarray([digest.hex() for digest in digests], dtype=object)
+
+    return digests[codes]
+
+
 def sha1_to_sequences(sequence_array):
     seq_series = pd.Series(sequence_array)
     seq_df = pd.DataFrame({'sequence':seq_series})
-    seq_df['sha1'] = seq_df['sequence'].apply(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+    seq_df['sha1'] = sha1_digests(seq_df['sequence'].values)
     seq_df.set_index('sha1', inplace=True)
     return seq_df
 
@@ -162,3 +373,49 @@ class hybridmethod(object):
         else:
             return self.func.__get__(instance, owner)
 
+
+@contextmanager
+def executor_for(n_jobs=1, executor=None):
+    """Yield the executor to run parallel work on, or None to run serially.
+
+    An executor passed in is used (and left open) as is. Otherwise n_jobs
+    worker processes are started for the duration of the block; n_jobs=-1
+    uses one process per CPU.
+    """
+    if executor is not None:
+        yield executor
+    elif n_jobs is None or n_jobs == 1:
+        yield None
+    else:
+        max_workers = os.cpu_count() if n_jobs < 0 else n_jobs
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            yield pool
+
+
+def map_tasks(func, tasks, executor=None):
+    """map func over tasks, in order, on the executor (or serially if None)."""
+    if executor is None:
+        return [func(task) for task in tasks]
+    return list(executor.map(func, tasks))
+
+
+def imap_tasks(func, tasks, executor=None, window=None):
+    """map_tasks yielding the results one at a time, for tasks too large to submit all at once.
+
+    At most window tasks (by default two per CPU) are submitted to the
+    executor ahead of the result being yielded, and tasks is only
+    iterated as far as needed.
+    """
+    if executor is None:
+        for task in tasks:
+            yield func(task)
+        return
+
+    window = 2 * os.cpu_count() if window is None else window
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(func, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()